@@ -0,0 +1,64 @@
+"""
+Band role claims carried in the JWT, so admin checks do not need the band's roster.
+
+Tokens signed at login, registration and /refresh_token list the bands the user administers ("a") and the
+other bands they are a member of ("m"), stamped with the user's roles_version ("v"). Every change to a
+user's memberships bumps roles_version in the same transaction, which makes the claims of tokens signed
+before it stale. A check trusts the claims while their version matches the user's row in the entity cache
+and reads the roster otherwise.
+
+Like the rest of the entity cache, another worker can keep a user's old roles_version for up to
+ENTITY_CACHE_TTL_SECONDS after a change it did not make.
+"""
+from sqlalchemy import select, update
+
+from caching.entity_cache import entity_cache
+from database_models.models import User, BandMember
+from monitoring.metrics import registry
+
+# users in more bands get no claims and are always checked against the rosters, keeps tokens small
+MAX_CLAIMED_BANDS = 100
+
+role_checks = registry.counter("role_checks_total", "Band role checks by source (claims, roster)",
+                               labels=("source",))
+
+
+async def role_claims(db, user):
+    """
+    {"v": roles_version, "a": admin band ids, "m": other band ids} of a User row, None past MAX_CLAIMED_BANDS.
+
+    The version is the one already on the row, read before the memberships: a change landing in between
+    leaves the claims with the older version, so they are never trusted.
+    """
+    version = user.roles_version
+    rows = (await db.execute(select(BandMember.band_id, BandMember.admin).where(
+        BandMember.user_id == user.id).limit(MAX_CLAIMED_BANDS + 1))).all()
+    if len(rows) > MAX_CLAIMED_BANDS:
+        return None
+    return {"v": version, "a": sorted(band_id for band_id, admin in rows if admin),
+            "m": sorted(band_id for band_id, admin in rows if not admin)}
+
+
+def bump_roles_version(user_ids):
+    """UPDATE making the claims of these users stale, user_ids is a list or a select of ids"""
+    return update(User).where(User.id.in_(user_ids)).values(roles_version=User.roles_version + 1).execution_options(
+        synchronize_session=False)
+
+
+async def band_role(db, user, band_id):
+    """"admin", "member" or None for a JwtUser, from the token's claims while they are current"""
+    claims = user.roles
+    if claims is not None:
+        current = await entity_cache.get_user(db, user.user_id)
+        if current is not None and current["roles_version"] == claims["v"]:
+            role_checks.inc("claims")
+            return "admin" if band_id in claims["a"] else "member" if band_id in claims["m"] else None
+    role_checks.inc("roster")
+    roster = await entity_cache.get_roster(db, band_id)
+    if user.user_id not in roster:
+        return None
+    return "admin" if roster[user.user_id] else "member"
+
+
+async def is_band_admin(db, user, band_id):
+    return await band_role(db, user, band_id) == "admin"
@@ -1,6 +1,7 @@
 from fastapi import Request, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from auth.jwt_handler import decode_jwt
+from auth.revocation import token_revocations
 
 
 class JwtBearer(HTTPBearer):
@@ -19,6 +20,6 @@ class JwtBearer(HTTPBearer):
     def _verify_jwt(self, token: str) -> bool:
         payload = decode_jwt(token)
         if payload and payload is not {}:
-            return True
+            return not token_revocations.is_revoked(payload)
         return False
 
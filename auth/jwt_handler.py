@@ -1,26 +1,43 @@
+import functools
 import time
+import uuid
+
 import jwt
 from database_models.models import User
 from jwt.exceptions import DecodeError
 from decouple import config
 
-JWT_SECRET = config("JWT_SECRET")
-JWT_ALGORITHM = config("JWT_ALGORITHM")
+
+@functools.lru_cache(maxsize=1)
+def jwt_settings():
+    """(secret, algorithm), read on first use so importing the app does not need them"""
+    return config("JWT_SECRET"), config("JWT_ALGORITHM")
+
+
+# 30 days
+TOKEN_LIFETIME_IN_SECONDS = 30 * 24 * 60 * 60
 
 
-def sign_jwt(user: User):
+def sign_jwt(user: User, roles: dict | None = None):
+    """roles are the band role claims of auth.claims.role_claims, left out when None"""
+    now = time.time()
     payload = {
         "user_id": user.id,
-        # 30 days
-        "expiration": time.time() + 30 * 24 * 60 * 60 * 1000
+        # unique id so a single token can be revoked
+        "jti": uuid.uuid4().hex,
+        "issued_at": now,
+        "expiration": now + TOKEN_LIFETIME_IN_SECONDS
     }
-    token = jwt.encode(payload, JWT_SECRET)
+    if roles is not None:
+        payload["roles"] = roles
+    token = jwt.encode(payload, jwt_settings()[0])
     return token
 
 
 def decode_jwt(token: str):
     try:
-        decoded_token = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        secret, algorithm = jwt_settings()
+        decoded_token = jwt.decode(token, secret, algorithms=[algorithm])
         return decoded_token if decoded_token['expiration'] >= time.time() else None
     except DecodeError:
         return {}
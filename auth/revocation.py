@@ -0,0 +1,76 @@
+import time
+
+from sqlalchemy import select, update
+
+from database_models.models import User, RevokedToken
+
+
+class TokenRevocationList:
+    """
+    In-memory view of revoked tokens so JwtBearer never has to query the database.
+
+    Holds the per-user "tokens valid after" timestamps and the ids of individually revoked
+    tokens. Revocations made by this process are applied immediately; revocations made by
+    other workers show up on the next refresh().
+    """
+
+    def __init__(self):
+        self._valid_after = {}
+        self._revoked_ids = set()
+        # revocations made while a refresh is reading, merged into its snapshot
+        self._added_during_refresh = None
+        self.refreshed_at = 0
+
+    def is_revoked(self, payload: dict) -> bool:
+        if payload.get("jti") in self._revoked_ids:
+            return True
+        valid_after = self._valid_after.get(payload.get("user_id"))
+        return valid_after is not None and payload.get("issued_at", 0) < valid_after
+
+    async def revoke_token(self, db, payload: dict):
+        jti = payload.get("jti")
+        if jti is None:
+            # tokens from before revocation support can only be revoked per user
+            await self.revoke_user_tokens(db, payload["user_id"])
+            return
+        await db.merge(RevokedToken(jti=jti, user_id=payload["user_id"], expiration=payload["expiration"]))
+        await db.commit()
+        self._add({}, {jti})
+
+    async def revoke_user_tokens(self, db, user_id: int, valid_after: float | None = None):
+        valid_after = valid_after or time.time()
+        await db.execute(update(User).where(User.id == user_id).values(
+            tokens_valid_after=valid_after, version=User.version + 1))
+        await db.commit()
+        self._add({user_id: valid_after}, set())
+
+    def _add(self, valid_after: dict, revoked_ids: set):
+        self._merge(self._valid_after, self._revoked_ids, valid_after, revoked_ids)
+        if self._added_during_refresh is not None:
+            self._merge(*self._added_during_refresh, valid_after, revoked_ids)
+
+    @staticmethod
+    def _merge(into_valid_after, into_revoked_ids, valid_after, revoked_ids):
+        for user_id, timestamp in valid_after.items():
+            into_valid_after[user_id] = max(timestamp, into_valid_after.get(user_id, 0))
+        into_revoked_ids.update(revoked_ids)
+
+    async def refresh(self, db):
+        now = time.time()
+        self._added_during_refresh = ({}, set())
+        try:
+            valid_after = dict((await db.execute(select(User.id, User.tokens_valid_after)
+                                                 .where(User.tokens_valid_after > 0))).all())
+            revoked_ids = set((await db.execute(select(RevokedToken.jti)
+                                                .where(RevokedToken.expiration >= now))).scalars())
+            # a logout that committed after the selects above is not in the rows yet
+            self._merge(valid_after, revoked_ids, *self._added_during_refresh)
+        finally:
+            self._added_during_refresh = None
+        # swap whole structures so readers never see a half built view
+        self._valid_after = valid_after
+        self._revoked_ids = revoked_ids
+        self.refreshed_at = now
+
+
+token_revocations = TokenRevocationList()
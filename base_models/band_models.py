@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, validator, root_validator
 
 
 class PostBandRequest(BaseModel):
@@ -24,6 +24,17 @@ class PostSendInvite(BaseModel):
     band_id: int
 
 
+class PostSendInvites(BaseModel):
+    band_id: int
+    user_ids: list[int] = []
+    # people without an account, an address that belongs to a user is invited as that user
+    emails: list[str] = []
+
+    @validator("emails", each_item=True)
+    def lower_emails(cls, email):
+        return email.lower()
+
+
 class PostAcceptInvite(BaseModel):
     code: str
 
@@ -36,8 +47,46 @@ class GetUserLogin(BaseModel):
 class JwtUser(BaseModel):
     user_id: int | None = None
     email: str | None = None
+    # band role claims of the token, see auth.claims
+    roles: dict | None = None
 
 
 class Message(BaseModel):
     recipient_user_id: int
-    message: str
\ No newline at end of file
+    message: str
+
+class ImportUserRecord(BaseModel):
+    first_name: str
+    last_name: str
+    email: str
+    # a bcrypt hash from the partner's system is stored as is, otherwise password is hashed
+    password: str | None = None
+    password_hash: str | None = Field(None, regex=r"^\$2[aby]\$\d\d\$[./A-Za-z0-9]{53}$")
+    location: str | None = None
+    talents: list[str] = []
+
+    @validator("email")
+    def lower_email(cls, email):
+        return email.lower()
+
+    @root_validator(skip_on_failure=True)
+    def has_password(cls, values):
+        if (values["password"] is None) == (values["password_hash"] is None):
+            raise ValueError("exactly one of password and password_hash is required")
+        return values
+
+
+class ImportBandRecord(BaseModel):
+    name: str
+    location: str
+    admin_email: str
+    member_emails: list[str] = []
+    talents: list[str] = []
+
+    @validator("admin_email")
+    def lower_admin_email(cls, email):
+        return email.lower()
+
+    @validator("member_emails", each_item=True)
+    def lower_member_emails(cls, email):
+        return email.lower()
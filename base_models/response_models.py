@@ -0,0 +1,76 @@
+from typing import Generic, TypeVar
+
+from pydantic import BaseModel
+from pydantic.generics import GenericModel
+
+Item = TypeVar("Item")
+
+
+class UserOut(BaseModel):
+    id: int
+    first_name: str | None = None
+    last_name: str | None = None
+    email: str | None = None
+    location: str | None = None
+    longitude: float | None = None
+    latitude: float | None = None
+    email_verified: bool | None = None
+
+
+class BandOut(BaseModel):
+    id: int
+    name: str | None = None
+    location: str | None = None
+    longitude: float | None = None
+    latitude: float | None = None
+
+
+class BandMemberOut(BaseModel):
+    id: int
+    first_name: str | None = None
+    last_name: str | None = None
+
+
+class RosterEntryOut(BaseModel):
+    user_id: int
+    admin: bool
+
+
+class RosterOut(BaseModel):
+    band_id: int
+    members: list[RosterEntryOut]
+
+
+class BatchOut(BaseModel):
+    users: list[UserOut]
+    bands: list[BandOut]
+    rosters: list[RosterOut]
+
+
+class MessageOut(BaseModel):
+    id: int
+    sender_user_id: int
+    recipient_user_id: int
+    message: str
+    sent: int
+    read: bool
+
+
+class SearchPage(GenericModel, Generic[Item]):
+    items: list[Item]
+    # pass back as ?after= for the next page, None on the last one
+    next: str | None
+
+
+def projection(model, entity):
+    """The entity's columns named by the model's fields, select only these so nothing else is loaded"""
+    return [getattr(entity, name) for name in model.__fields__]
+
+
+def project(model, entity_dict):
+    """Keep only the model's fields of a cached entity dict"""
+    return {name: entity_dict[name] for name in model.__fields__}
+
+
+def rows_as_dicts(result):
+    return [dict(row) for row in result.mappings()]
@@ -0,0 +1,180 @@
+"""
+Synthetic dataset generator for benchmarks, a scaled up main.populate_db.
+
+Users and bands are clustered around real cities with a gaussian spread, band rosters are drawn from
+users of the same city and messages go between users of the same city. Rows are written with batched
+core INSERTs in one transaction and every user shares one precomputed bcrypt hash of --password.
+
+    python -m benchmarks.dataset --database-url sqlite:///./database.db --users 1000000 --bands 200000
+"""
+import argparse
+import json
+import random
+import time
+
+from sqlalchemy import create_engine, func, insert, select
+
+from database_models.db_config import DatabaseConfig
+from database_models.migrations import run_migrations
+from database_models.models import (
+    User, Band, BandMember, LookingForBand, LookingForMember, DBMessage, DBNotification, LocationCache,
+    NotificationPriority
+)
+from security.password_security import hash_password
+
+BATCH_SIZE = 10000
+# degrees, roughly 30 km
+CITY_SPREAD = 0.3
+CITIES = [
+    # name, latitude, longitude, relative population
+    ("New York", 40.71, -74.01, 84), ("Los Angeles", 34.05, -118.24, 39), ("Chicago", 41.88, -87.63, 27),
+    ("Houston", 29.76, -95.37, 23), ("Phoenix", 33.45, -112.07, 16), ("Philadelphia", 39.95, -75.17, 16),
+    ("San Antonio", 29.42, -98.49, 15), ("San Diego", 32.72, -117.16, 14), ("Dallas", 32.78, -96.80, 13),
+    ("Austin", 30.27, -97.74, 10), ("San Francisco", 37.77, -122.42, 9), ("Seattle", 47.61, -122.33, 7),
+    ("Denver", 39.74, -104.99, 7), ("Nashville", 36.16, -86.78, 7), ("Boston", 42.36, -71.06, 7),
+    ("Portland", 45.52, -122.68, 6), ("Atlanta", 33.75, -84.39, 5), ("Miami", 25.76, -80.19, 4),
+    ("New Orleans", 29.95, -90.07, 4), ("Minneapolis", 44.98, -93.27, 4),
+]
+FIRST_NAMES = ["Alex", "Sam", "Jordan", "Taylor", "Morgan", "Casey", "Riley", "Jamie", "Avery", "Quinn",
+               "Charlie", "Dana", "Emery", "Harper", "Jesse", "Kai", "Logan", "Parker", "Reese", "Skyler"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez",
+              "Martinez", "Hernandez", "Lopez", "Wilson", "Anderson", "Thomas", "Moore", "Jackson", "Lee"]
+BAND_WORDS = ["Velvet", "Iron", "Electric", "Midnight", "Static", "Golden", "Hollow", "Neon", "Wild", "Paper",
+              "Wolves", "Echoes", "Machines", "Saints", "Tides", "Ghosts", "Kings", "Lanterns", "Rivers", "Owls"]
+TALENTS = ["guitar", "bass", "drums", "vocals", "piano", "keys", "violin", "saxophone", "trumpet", "dj"]
+NINETY_DAYS_IN_SECONDS = 90 * 24 * 60 * 60
+
+
+def _batched(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(conn, table, rows):
+    count = 0
+    for batch in _batched(rows):
+        conn.execute(insert(table), batch)
+        count += len(batch)
+    return count
+
+
+def _next_id(conn, column):
+    return (conn.execute(select(func.max(column))).scalar() or 0) + 1
+
+
+def _place(rng, city):
+    name, lat, lng, _ = city
+    return name, lng + rng.gauss(0, CITY_SPREAD), lat + rng.gauss(0, CITY_SPREAD)
+
+
+def generate(engine, users=10000, bands=2000, messages=50000, notifications=20000, password="password", seed=0):
+    """Append a synthetic dataset to the database behind engine, returns rows inserted per table"""
+    rng = random.Random(seed)
+    password_hash = hash_password(password)
+    now = int(time.time())
+    weights = [city[3] for city in CITIES]
+    inserted = {}
+    with engine.begin() as conn:
+        first_user = _next_id(conn, User.id)
+        first_band = _next_id(conn, Band.id)
+        user_cities = rng.choices(range(len(CITIES)), weights, k=users)
+        band_cities = rng.choices(range(len(CITIES)), weights, k=bands)
+        users_by_city = [[] for _ in CITIES]
+        for offset, city in enumerate(user_cities):
+            users_by_city[city].append(first_user + offset)
+
+        def user_rows():
+            for offset, city in enumerate(user_cities):
+                location, lng, lat = _place(rng, CITIES[city])
+                user_id = first_user + offset
+                yield {"id": user_id, "first_name": rng.choice(FIRST_NAMES), "last_name": rng.choice(LAST_NAMES),
+                       "email": "user%d@example.com" % user_id, "password_hash": password_hash,
+                       "location": location, "longitude": lng, "latitude": lat,
+                       "email_verified": rng.random() < 0.9, "email_notifications_opt_in": rng.random() < 0.3,
+                       "tokens_valid_after": 0}
+
+        def band_rows():
+            for offset, city in enumerate(band_cities):
+                location, lng, lat = _place(rng, CITIES[city])
+                name = "The %s %s" % (rng.choice(BAND_WORDS), rng.choice(BAND_WORDS))
+                yield {"id": first_band + offset, "name": name,
+                       "location": location, "longitude": lng, "latitude": lat}
+
+        def member_rows():
+            for offset, city in enumerate(band_cities):
+                local_users = users_by_city[city]
+                size = min(len(local_users), rng.randint(1, 6))
+                for position, user_id in enumerate(rng.sample(local_users, size)):
+                    yield {"band_id": first_band + offset, "user_id": user_id, "admin": position == 0}
+
+        def looking_for_band_rows():
+            for offset in range(users):
+                if rng.random() < 0.2:
+                    yield {"user_id": first_user + offset, "talent": rng.choice(TALENTS)}
+
+        def looking_for_member_rows():
+            for offset in range(bands):
+                for talent in rng.sample(TALENTS, rng.randint(0, 2)):
+                    yield {"band_id": first_band + offset, "talent": talent}
+
+        def message_rows():
+            for _ in range(messages if users > 1 else 0):
+                local_users = users_by_city[rng.choice(user_cities)]
+                if len(local_users) < 2:
+                    continue
+                sender, recipient = rng.sample(local_users, 2)
+                yield {"sender_user_id": sender, "recipient_user_id": recipient,
+                       "message": "Want to jam this weekend?", "sent": now - rng.randrange(NINETY_DAYS_IN_SECONDS),
+                       "read": rng.random() < 0.7}
+
+        def notification_rows():
+            priorities = list(NotificationPriority)
+            for _ in range(notifications if users else 0):
+                sent = now - rng.randrange(NINETY_DAYS_IN_SECONDS)
+                yield {"recipient_user_id": first_user + rng.randrange(users), "message": "You have a new invite",
+                       "read": rng.random() < 0.5, "date_sent": sent, "priority": rng.choice(priorities),
+                       "expiration": sent + NINETY_DAYS_IN_SECONDS}
+
+        # geocoding a seeded city name is then a cache hit instead of a google api call
+        known = set(conn.execute(select(LocationCache.location)).scalars())
+        inserted["location_cache"] = _insert(conn, LocationCache, (
+            {"location": name.lower(), "lat": lat, "lng": lng}
+            for name, lat, lng, _ in CITIES if name.lower() not in known))
+        inserted["user"] = _insert(conn, User, user_rows())
+        inserted["band"] = _insert(conn, Band, band_rows())
+        inserted["band_member"] = _insert(conn, BandMember, member_rows())
+        inserted["looking_for_band"] = _insert(conn, LookingForBand, looking_for_band_rows())
+        inserted["looking_for_member"] = _insert(conn, LookingForMember, looking_for_member_rows())
+        inserted["message"] = _insert(conn, DBMessage, message_rows())
+        inserted["notification"] = _insert(conn, DBNotification, notification_rows())
+    return inserted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="defaults to DATABASE_URL")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--bands", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--notifications", type=int, default=20000)
+    parser.add_argument("--password", default="password", help="password of every generated user")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    db_config = DatabaseConfig(url=args.database_url) if args.database_url else DatabaseConfig.from_env()
+    engine = create_engine(db_config.url, **db_config.engine_options())
+    db_config.install(engine)
+    run_migrations(engine)
+    start = time.perf_counter()
+    inserted = generate(engine, args.users, args.bands, args.messages, args.notifications, args.password, args.seed)
+    print(json.dumps({"inserted": inserted, "seconds": round(time.perf_counter() - start, 2)}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Mixed load benchmark for the database layer.
+
+Runs slow, database bound requests (a /login for an unknown email scans the user table)
+concurrently with cheap lookups (/band/1) and reports how long the cheap requests take. With blocking session calls on the
+event loop every cheap request queues behind the slow ones; with the async session they are
+served in between.
+
+Compare revisions by pointing --app-dir at a checkout of each one:
+    git worktree add /tmp/before <revision>
+    python -m benchmarks.db_concurrency --app-dir /tmp/before
+    python -m benchmarks.db_concurrency
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from sqlalchemy import create_engine, insert
+
+from benchmarks.harness import REPO_DIR, running_app, summarize
+from database_models.models import Base, Band, User
+from security.password_security import hash_password
+
+
+def seed(work_dir, users):
+    engine = create_engine("sqlite:///" + os.path.join(work_dir, "database.db"))
+    Base.metadata.create_all(bind=engine)
+    password_hash = hash_password("benchmark")
+    with engine.begin() as conn:
+        conn.execute(insert(Band), [{"name": "Band", "location": "Denver", "longitude": -104.9, "latitude": 39.7}])
+        for offset in range(0, users, 10000):
+            conn.execute(insert(User), [{"first_name": "First%d" % i, "last_name": "Last%d" % i,
+                                         "email": "user%d@example.com" % i, "password_hash": password_hash}
+                                        for i in range(offset, min(users, offset + 10000))])
+
+
+def drive(url, request, deadline, latencies, rate=None):
+    session = requests.Session()
+    method, path, body = request
+    while time.time() < deadline:
+        start = time.perf_counter()
+        session.request(method, url + path, json=body)
+        elapsed = time.perf_counter() - start
+        latencies.append(elapsed)
+        if rate:
+            # paced clients measure waiting time rather than compete for the CPU
+            time.sleep(max(0.0, 1 / rate - elapsed))
+
+
+def run(app_dir, users, slow_clients, fast_clients, fast_rate, duration):
+    work_dir = tempfile.mkdtemp(prefix="bench-db-")
+    seed(work_dir, users)
+    results = {}
+    with running_app(app_dir=app_dir, work_dir=work_dir) as (url, _):
+        missing_login = ("POST", "/login", {"email": "nobody@example.com", "password": "x"})
+        workload = {"slow /login": (slow_clients, missing_login, None),
+                    "fast /band/1": (fast_clients, ("GET", "/band/1", None), fast_rate)}
+        latencies = {name: [] for name in workload}
+        deadline = time.time() + duration
+        threads = [threading.Thread(target=drive, args=(url, request, deadline, latencies[name], rate))
+                   for name, (clients, request, rate) in workload.items() for _ in range(clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        for name in workload:
+            results[name] = summarize(latencies[name], elapsed)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app-dir", default=REPO_DIR)
+    parser.add_argument("--users", type=int, default=500000)
+    parser.add_argument("--slow-clients", type=int, default=2)
+    parser.add_argument("--fast-clients", type=int, default=2)
+    parser.add_argument("--fast-rate", type=float, default=10, help="requests per second per fast client")
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+    print(json.dumps(run(args.app_dir, args.users, args.slow_clients, args.fast_clients,
+                         args.fast_rate, args.duration), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    if not samples:
+        return {"p%d" % p: None for p in points}
+    ordered = sorted(samples)
+    return {"p%d" % p: ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+
+
+def summarize(latencies, elapsed):
+    summary = {"requests": len(latencies), "throughput": len(latencies) / elapsed if elapsed else 0}
+    summary.update({k: round(v * 1000, 3) if v is not None else None
+                    for k, v in percentiles(latencies).items()})
+    return summary
+
+
+def process_stats(pid):
+    """Resident memory in bytes and CPU seconds (user + system) of a linux process, read from /proc"""
+    with open("/proc/%d/status" % pid) as f:
+        rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+    with open("/proc/%d/stat" % pid) as f:
+        # the command name may contain spaces, the fields after it are fixed
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return rss, cpu
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def running_app(app_dir=REPO_DIR, work_dir=None, port=None, env=None):
+    """
+    Run `uvicorn main:app` from app_dir in a subprocess and yield its base url.
+
+    The app resolves ./database.db relative to its working directory, so pointing work_dir at
+    a prepared directory runs any revision of the app against the same dataset.
+    """
+    port = port or free_port()
+    work_dir = work_dir or tempfile.mkdtemp(prefix="bench-")
+    process_env = dict(os.environ, PYTHONPATH=app_dir, **(env or {}))
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                                "--log-level", "warning", "--no-access-log"],
+                               cwd=work_dir, env=process_env, stdout=subprocess.DEVNULL)
+    url = "http://127.0.0.1:%d" % port
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                requests.get(url + "/", timeout=1)
+                break
+            except requests.ConnectionError:
+                if process.poll() is not None or time.time() > deadline:
+                    raise RuntimeError("app did not start")
+                time.sleep(0.1)
+        yield url, process
+    finally:
+        process.terminate()
+        process.wait()
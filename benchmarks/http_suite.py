@@ -0,0 +1,221 @@
+"""
+HTTP load benchmark over the main endpoints against a generated dataset.
+
+Seeds a throwaway database with benchmarks.dataset, starts the app with benchmarks.harness and runs each
+scenario in turn with --concurrency client threads for --duration seconds. Prints per endpoint latency
+percentiles (ms), throughput and status codes as JSON. Save one run as a baseline and pass it to a later run
+with --baseline to get the relative change per endpoint:
+
+    python -m benchmarks.http_suite --output before.json
+    python -m benchmarks.http_suite --app-dir /tmp/after --baseline before.json
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import requests
+from sqlalchemy import create_engine
+
+from auth.jwt_handler import sign_jwt
+from benchmarks import dataset
+from benchmarks.harness import REPO_DIR, free_port, running_app, summarize
+from database_models.migrations import run_migrations
+
+CITY_NAMES = [city[0] for city in dataset.CITIES]
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+
+    def add(self, endpoint, latency, status):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            statuses = self.statuses.setdefault(endpoint, {})
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+
+class Client:
+    """One benchmark client thread: a keep-alive session and a recorder shared by the scenario"""
+
+    def __init__(self, url, recorder, seed):
+        self.url = url
+        self.recorder = recorder
+        self.session = requests.Session()
+        self.rng = random.Random(seed)
+
+    def call(self, endpoint, method, path, json=None, user_id=None):
+        headers = {"Authorization": "Bearer " + sign_jwt(SimpleNamespace(id=user_id))} if user_id else None
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.url + path, json=json, headers=headers)
+        except requests.RequestException:
+            # the server dropped the connection, usually an unhandled exception in the endpoint
+            self.recorder.add(endpoint, time.perf_counter() - start, "error")
+            self.session = requests.Session()
+            return None
+        self.recorder.add(endpoint, time.perf_counter() - start, response.status_code)
+        return response
+
+
+class Dataset:
+    def __init__(self, path, users, bands):
+        self.path = path
+        self.users = users
+        self.bands = bands
+        self.emails = itertools.count()
+        with sqlite3.connect(path) as conn:
+            self.band_admins = dict(conn.execute("SELECT band_id, user_id FROM band_member WHERE admin = 1"))
+            self.message_pairs = conn.execute(
+                "SELECT sender_user_id, recipient_user_id FROM message LIMIT 10000").fetchall()
+
+    def invite_code(self, band_id, user_id):
+        with sqlite3.connect(self.path) as conn:
+            row = conn.execute("SELECT code FROM band_invite WHERE band_id = ? AND user_id = ?",
+                               (band_id, user_id)).fetchone()
+        return row[0] if row else None
+
+
+def login(client, data):
+    user_id = client.rng.randint(1, data.users)
+    client.call("POST /login", "POST", "/login",
+                json={"email": "user%d@example.com" % user_id, "password": "password"})
+
+
+def search(client, data):
+    kind = client.rng.choice(["Band", "Member"])
+    client.call("GET /search", "GET", "/search?location=%s&type=%s&distance=25&roles=guitar,bass" % (
+        client.rng.choice(CITY_NAMES), kind))
+
+
+def messages(client, data):
+    sender, recipient = client.rng.choice(data.message_pairs)
+    client.call("GET /messages/{id}", "GET", "/messages/%d" % recipient, user_id=sender)
+
+
+def band(client, data):
+    client.call("GET /band/{id}", "GET", "/band/%d" % client.rng.randint(1, data.bands))
+
+
+def band_members(client, data):
+    client.call("GET /bandmembers/{id}", "GET", "/bandmembers/%d" % client.rng.randint(1, data.bands))
+
+
+def register(client, data):
+    client.call("POST /register", "POST", "/register", json={
+        "first_name": "Bench", "last_name": "User", "email": "bench%d@example.com" % next(data.emails),
+        "password": "password", "location": client.rng.choice(CITY_NAMES)})
+
+
+def invite(client, data):
+    band_id, admin_id = client.rng.choice(list(data.band_admins.items()))
+    user_id = client.rng.randint(1, data.users)
+    response = client.call("POST /send_invite", "POST", "/send_invite",
+                           json={"band_id": band_id, "user_id": user_id}, user_id=admin_id)
+    if response is None or response.status_code != 200:
+        return
+    code = data.invite_code(band_id, user_id)
+    client.call("GET /verify_band_code", "GET", "/verify_band_code/%d/%s" % (band_id, code), user_id=user_id)
+    client.call("POST /accept_invite", "POST", "/accept_invite", json={"code": code}, user_id=user_id)
+
+
+SCENARIOS = {
+    "login": login,
+    "search": search,
+    "messages": messages,
+    "band": band,
+    "bandmembers": band_members,
+    "register": register,
+    "invite": invite,
+}
+
+
+def drive(client, scenario, data, deadline):
+    while time.time() < deadline:
+        scenario(client, data)
+
+
+def run_scenario(url, scenario, data, concurrency, duration, seed):
+    recorder = Recorder()
+    deadline = time.time() + duration
+    clients = [Client(url, recorder, seed * 1000 + i) for i in range(concurrency)]
+    threads = [threading.Thread(target=drive, args=(client, scenario, data, deadline)) for client in clients]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    results = {}
+    for endpoint, latencies in recorder.latencies.items():
+        results[endpoint] = summarize(latencies, elapsed)
+        results[endpoint]["statuses"] = dict(sorted(recorder.statuses[endpoint].items()))
+    return results
+
+
+def run(app_dir, scenarios, users, bands, messages_count, concurrency, duration, seed=0):
+    work_dir = tempfile.mkdtemp(prefix="bench-http-")
+    path = os.path.join(work_dir, "database.db")
+    engine = create_engine("sqlite:///" + path)
+    run_migrations(engine)
+    dataset.generate(engine, users=users, bands=bands, messages=messages_count, notifications=users // 10, seed=seed)
+    engine.dispose()
+    data = Dataset(path, users, bands)
+    # nothing listens on this port, so emails fail fast instead of reaching a real SMTP server
+    env = {"SMTP_DOMAIN": "127.0.0.1", "EMAIL_PORT": str(free_port())}
+    results = {"settings": {"users": users, "bands": bands, "messages": messages_count,
+                            "concurrency": concurrency, "duration": duration}, "endpoints": {}}
+    with running_app(app_dir=app_dir, work_dir=work_dir, env=env) as (url, _):
+        for name in scenarios:
+            results["endpoints"].update(run_scenario(url, SCENARIOS[name], data, concurrency, duration, seed))
+    return results
+
+
+def compare(baseline, results):
+    """Relative change per endpoint and metric, positive means slower (or more throughput)"""
+    changes = {}
+    for endpoint, summary in results["endpoints"].items():
+        before = baseline["endpoints"].get(endpoint)
+        if before is None:
+            continue
+        changes[endpoint] = {metric: round((summary[metric] - before[metric]) / before[metric] * 100, 1)
+                             for metric in ("p50", "p95", "p99", "throughput")
+                             if before.get(metric) and summary.get(metric) is not None}
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app-dir", default=REPO_DIR)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated, default all")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--bands", type=int, default=20000)
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    args = parser.parse_args()
+    results = run(args.app_dir, args.scenarios.split(","), args.users, args.bands, args.messages,
+                  args.concurrency, args.duration, args.seed)
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["change_percent"] = compare(json.load(f), results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Serialization cost of large result lists, in process.
+
+Loads --rows users from a generated SQLite database and times three ways of turning them into a JSON body:
+    orm_jsonable_encoder  select(User) ORM objects through jsonable_encoder and json.dumps, what an endpoint
+                          returning ORM rows without a response model costs
+    response_model        the same rows validated into list[UserOut], then jsonable_encoder and json.dumps
+    projection_orjson     select only UserOut's columns and orjson.dumps the row dicts, what /search,
+                          /messages/{id} and /users do now
+Each variant reports the query and the encoding separately, best of --repeat runs, in ms.
+
+    python -m benchmarks.serialization --rows 10000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from pydantic import parse_obj_as
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+from base_models.response_models import UserOut, projection
+from benchmarks import dataset
+from database_models.migrations import run_migrations
+from database_models.models import User
+
+
+def orm_jsonable_encoder(session, rows):
+    users = session.execute(select(User).limit(rows)).scalars().all()
+    return users, lambda: json.dumps(jsonable_encoder(users)).encode()
+
+
+def response_model(session, rows):
+    users = session.execute(select(User).limit(rows)).scalars().all()
+    return users, lambda: json.dumps(jsonable_encoder(
+        parse_obj_as(list[UserOut], [{name: getattr(user, name) for name in UserOut.__fields__}
+                                     for user in users]))).encode()
+
+
+def projection_orjson(session, rows):
+    users = [dict(row) for row in session.execute(select(*projection(UserOut, User)).limit(rows)).mappings()]
+    return users, lambda: orjson.dumps(users)
+
+
+VARIANTS = {
+    "orm_jsonable_encoder": orm_jsonable_encoder,
+    "response_model": response_model,
+    "projection_orjson": projection_orjson,
+}
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def run(rows, repeat):
+    work_dir = tempfile.mkdtemp(prefix="bench-serialization-")
+    engine = create_engine("sqlite:///" + os.path.join(work_dir, "database.db"))
+    run_migrations(engine)
+    dataset.generate(engine, users=rows, bands=0, messages=0, notifications=0)
+    results = {}
+    for name, variant in VARIANTS.items():
+        best_query, best_encode, size = None, None, 0
+        for _ in range(repeat):
+            with Session(engine) as session:
+                query_time, (users, encode) = timed(lambda: variant(session, rows))
+                encode_time, body = timed(encode)
+            best_query = min(best_query or query_time, query_time)
+            best_encode = min(best_encode or encode_time, encode_time)
+            size = len(body)
+        results[name] = {"query_ms": round(best_query * 1000, 1), "encode_ms": round(best_encode * 1000, 1),
+                         "bytes": size}
+    engine.dispose()
+    return {"rows": rows, "variants": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.rows, args.repeat), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Import and startup time of the app, each run in a fresh interpreter.
+
+    interpreter_ms  `python -c pass`, the floor every run pays
+    import_ms       `import main`: modules, models, routes and create_app(), nothing connected
+    startup_ms      the startup hooks (schema check, token revocations, scheduler) until the app would serve
+    modules         sys.modules after the import, to spot a heavy dependency creeping back in
+
+Startup is timed against a fresh database (migrations run) and again against the same, now current,
+database (schema check only). Medians of --repeat runs, in ms. With --budget-ms the exit code is 1 when
+import plus startup on a current database exceeds the budget, so it can gate CI.
+
+    python -m benchmarks.startup --repeat 5 --budget-ms 1500
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.harness import REPO_DIR
+
+CHILD = """
+import asyncio, json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+modules = len(sys.modules)
+
+
+async def lifespan():
+    begin = time.perf_counter()
+    await main.app.router.startup()
+    ready = time.perf_counter()
+    await main.app.router.shutdown()
+    return ready - begin
+
+print(json.dumps({"import_ms": (imported - start) * 1000, "startup_ms": asyncio.run(lifespan()) * 1000,
+                  "modules": modules}))
+"""
+
+
+def _run(code, work_dir):
+    output = subprocess.run([sys.executable, "-c", code], cwd=work_dir, check=True, capture_output=True, text=True,
+                            env=dict(os.environ, PYTHONPATH=REPO_DIR)).stdout
+    return json.loads(output) if output.strip() else None
+
+
+def run(repeat):
+    samples = {"interpreter_ms": [], "import_ms": [], "fresh_startup_ms": [], "current_startup_ms": [],
+               "modules": []}
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(prefix="bench-startup-") as work_dir:
+            start = time.perf_counter()
+            _run("pass", work_dir)
+            samples["interpreter_ms"].append((time.perf_counter() - start) * 1000)
+            fresh = _run(CHILD, work_dir)
+            current = _run(CHILD, work_dir)
+        samples["import_ms"].append(current["import_ms"])
+        samples["fresh_startup_ms"].append(fresh["startup_ms"])
+        samples["current_startup_ms"].append(current["startup_ms"])
+        samples["modules"].append(current["modules"])
+    return {name: round(statistics.median(values), 1) for name, values in samples.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, help="fail when import plus current startup takes longer")
+    args = parser.parse_args()
+    report = run(args.repeat)
+    print(json.dumps(report, indent=2))
+    if args.budget_ms is not None and report["import_ms"] + report["current_startup_ms"] > args.budget_ms:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+WebSocket chat load benchmark.
+
+Opens --clients authenticated /ws connections (one user each) from a single asyncio process, sends messages
+between random pairs at --rate messages per second and measures delivery latency from send to the
+recipient's socket, dropped, duplicated and misdelivered messages, and the server's memory and CPU time per
+message from /proc. With --storm-fraction a share of the clients disconnects at once halfway through the run
+and reconnects immediately.
+
+    python -m benchmarks.ws_chat --clients 2000 --rate 200 --storm-fraction 0.5
+
+Latencies include the client's own event loop, check the client CPU in the output before trusting
+percentiles from a run with thousands of clients on one core.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+from types import SimpleNamespace
+
+import websockets
+from sqlalchemy import create_engine
+
+from auth.jwt_handler import sign_jwt
+from benchmarks import dataset
+from benchmarks.harness import REPO_DIR, free_port, process_stats, running_app, summarize
+from database_models.migrations import run_migrations
+
+MB = 1024 * 1024
+
+
+class ChatClient:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.token = sign_jwt(SimpleNamespace(id=user_id))
+        self.socket = None
+        self.reader = None
+
+
+class ChatRun:
+    def __init__(self, url):
+        self.url = url
+        self.connected = {}
+        self.connect_latencies = []
+        self.connect_failures = 0
+        # message id -> (recipient user id, perf_counter when sent)
+        self.sent = {}
+        self.send_failures = 0
+        self.delivered = {}
+        self.duplicates = 0
+        self.misdelivered = 0
+
+    async def connect(self, client):
+        start = time.perf_counter()
+        try:
+            client.socket = await websockets.connect(self.url, ping_interval=None, max_queue=None)
+            await client.socket.send(client.token)
+        except (OSError, websockets.WebSocketException, asyncio.TimeoutError):
+            self.connect_failures += 1
+            return
+        self.connect_latencies.append(time.perf_counter() - start)
+        client.reader = asyncio.create_task(self.read(client))
+        self.connected[client.user_id] = client
+
+    async def disconnect(self, client):
+        self.connected.pop(client.user_id, None)
+        await client.socket.close()
+        await client.reader
+
+    async def read(self, client):
+        try:
+            async for raw in client.socket:
+                received = time.perf_counter()
+                message = json.loads(raw)
+                if message["recipient_user_id"] != client.user_id:
+                    # the sender gets a copy of its own message, anything else went to the wrong socket
+                    if message["sender_user_id"] != client.user_id:
+                        self.misdelivered += 1
+                    continue
+                message_id = int(message["message"])
+                recipient, sent_at = self.sent[message_id]
+                if recipient != client.user_id:
+                    self.misdelivered += 1
+                elif message_id in self.delivered:
+                    self.duplicates += 1
+                else:
+                    self.delivered[message_id] = received - sent_at
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send(self, rng, message_id):
+        sender, recipient = rng.sample(list(self.connected.values()), 2)
+        self.sent[message_id] = (recipient.user_id, time.perf_counter())
+        try:
+            await sender.socket.send(json.dumps({"recipient_user_id": recipient.user_id, "message": str(message_id)}))
+        except websockets.ConnectionClosed:
+            self.send_failures += 1
+
+
+async def connect_all(run, clients, concurrency):
+    limit = asyncio.Semaphore(concurrency)
+
+    async def connect(client):
+        async with limit:
+            await run.connect(client)
+
+    await asyncio.gather(*(connect(client) for client in clients))
+
+
+async def storm(run, rng, fraction, concurrency):
+    """Drop a share of the connections at once and reconnect them, returns reconnect latencies"""
+    victims = rng.sample(list(run.connected.values()), int(len(run.connected) * fraction))
+    await asyncio.gather(*(run.disconnect(client) for client in victims))
+    before = len(run.connect_latencies)
+    start = time.perf_counter()
+    await connect_all(run, victims, concurrency)
+    return run.connect_latencies[before:], time.perf_counter() - start
+
+
+async def chat(url, pid, clients, rate, duration, storm_fraction, connect_concurrency, seed):
+    rng = random.Random(seed)
+    run = ChatRun(url)
+    rss_idle, _ = process_stats(pid)
+    start = time.perf_counter()
+    await connect_all(run, [ChatClient(user_id) for user_id in range(1, clients + 1)], connect_concurrency)
+    connect_elapsed = time.perf_counter() - start
+    # the server registers a socket after reading its token, give it a moment before sending to it
+    await asyncio.sleep(1)
+    rss_connected, cpu_before = process_stats(pid)
+    client_cpu_before = time.process_time()
+
+    storm_task = None
+    if storm_fraction:
+        async def delayed_storm():
+            await asyncio.sleep(duration / 2)
+            return await storm(run, rng, storm_fraction, connect_concurrency)
+        storm_task = asyncio.create_task(delayed_storm())
+
+    loop = asyncio.get_running_loop()
+    next_send = loop.time()
+    deadline = next_send + duration
+    message_id = 0
+    while loop.time() < deadline:
+        if len(run.connected) >= 2:
+            await run.send(rng, message_id)
+            message_id += 1
+        next_send += 1 / rate
+        await asyncio.sleep(max(0.0, next_send - loop.time()))
+    send_elapsed = duration
+    storm_result = await storm_task if storm_task else None
+    # let in flight messages arrive
+    await asyncio.sleep(2)
+    rss_end, cpu_after = process_stats(pid)
+    client_cpu = time.process_time() - client_cpu_before
+    await asyncio.gather(*(run.disconnect(client) for client in list(run.connected.values())))
+
+    delivered = len(run.delivered)
+    results = {
+        "connections": dict(summarize(run.connect_latencies[:clients], connect_elapsed),
+                            failures=run.connect_failures),
+        "messages": dict(summarize(list(run.delivered.values()), send_elapsed),
+                         sent=len(run.sent), delivered=delivered, send_failures=run.send_failures,
+                         dropped=len(run.sent) - delivered - run.send_failures,
+                         duplicates=run.duplicates, misdelivered=run.misdelivered),
+        "server": {"rss_idle_mb": round(rss_idle / MB, 1), "rss_connected_mb": round(rss_connected / MB, 1),
+                   "rss_end_mb": round(rss_end / MB, 1),
+                   "rss_per_connection_kb": round((rss_connected - rss_idle) / 1024 / max(1, clients), 1),
+                   "cpu_seconds": round(cpu_after - cpu_before, 2),
+                   "cpu_ms_per_message": round((cpu_after - cpu_before) * 1000 / max(1, len(run.sent)), 3)},
+        "client_cpu_seconds": round(client_cpu, 2),
+    }
+    if storm_result:
+        latencies, elapsed = storm_result
+        results["storm"] = dict(summarize(latencies, elapsed), reconnected=len(latencies))
+    return results
+
+
+def run(app_dir, clients, rate, duration, storm_fraction, connect_concurrency, seed=0):
+    work_dir = tempfile.mkdtemp(prefix="bench-ws-")
+    engine = create_engine("sqlite:///" + os.path.join(work_dir, "database.db"))
+    run_migrations(engine)
+    dataset.generate(engine, users=clients, bands=0, messages=0, notifications=0, seed=seed)
+    engine.dispose()
+    # every connection is a file descriptor on both ends, the server inherits this limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    env = {"SMTP_DOMAIN": "127.0.0.1", "EMAIL_PORT": str(free_port())}
+    with running_app(app_dir=app_dir, work_dir=work_dir, env=env) as (url, process):
+        ws_url = url.replace("http://", "ws://") + "/ws"
+        return asyncio.run(chat(ws_url, process.pid, clients, rate, duration, storm_fraction,
+                                connect_concurrency, seed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app-dir", default=REPO_DIR)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=100, help="messages per second across all clients")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--storm-fraction", type=float, default=0, help="share of clients reconnecting at once")
+    parser.add_argument("--connect-concurrency", type=int, default=100, help="handshakes in flight")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(run(args.app_dir, args.clients, args.rate, args.duration, args.storm_fraction,
+                         args.connect_concurrency, args.seed), indent=2))
+
+
+if __name__ == "__main__":
+    main()
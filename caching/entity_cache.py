@@ -0,0 +1,171 @@
+import collections
+import time
+
+from decouple import config
+from sqlalchemy import select
+
+from database_models.models import User, Band, BandMember
+
+# upper bound on how stale an entry changed by another worker can be, this worker invalidates on write
+ENTITY_CACHE_TTL_SECONDS = config("ENTITY_CACHE_TTL_SECONDS", default=60, cast=float)
+ENTITY_CACHE_MAX_ENTRIES = config("ENTITY_CACHE_MAX_ENTRIES", default=10000, cast=int)
+
+
+def _columns(row):
+    return {column.key: getattr(row, column.key) for column in row.__mapper__.column_attrs}
+
+
+class TtlCache:
+    """
+    LRU dict whose entries expire after ttl seconds.
+
+    A value read from the database is only stored if nothing was invalidated since the read started,
+    so a read that raced a write cannot put the old row back after the write invalidated it.
+    """
+
+    def __init__(self, ttl=ENTITY_CACHE_TTL_SECONDS, max_entries=ENTITY_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.invalidations = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, invalidations):
+        if invalidations != self.invalidations:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.invalidations += 1
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.invalidations += 1
+        self.entries.clear()
+
+
+class EntityCache:
+    """
+    Read-through cache of users, bands and band rosters (user id -> admin) as plain dicts.
+
+    Missing rows are not cached, so an id created later is never served as missing. Write endpoints call
+    the invalidate_* methods after they commit.
+    """
+
+    def __init__(self):
+        self.users = TtlCache()
+        self.bands = TtlCache()
+        self.rosters = TtlCache()
+
+    async def get_users(self, db, user_ids):
+        """Users by id in one query for the ones not cached, ids that do not exist are left out"""
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            user = self.users.get(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                found[user_id] = user
+        if missing:
+            invalidations = self.users.invalidations
+            for row in (await db.execute(select(User).where(User.id.in_(missing)))).scalars():
+                found[row.id] = _columns(row)
+                self.users.set(row.id, found[row.id], invalidations)
+        return found
+
+    async def get_user(self, db, user_id):
+        return (await self.get_users(db, [user_id])).get(user_id)
+
+    async def get_bands(self, db, band_ids):
+        """Bands by id in one query for the ones not cached, ids that do not exist are left out"""
+        found = {}
+        missing = []
+        for band_id in band_ids:
+            band = self.bands.get(band_id)
+            if band is None:
+                missing.append(band_id)
+            else:
+                found[band_id] = band
+        if missing:
+            invalidations = self.bands.invalidations
+            for row in (await db.execute(select(Band).where(Band.id.in_(missing)))).scalars():
+                found[row.id] = _columns(row)
+                self.bands.set(row.id, found[row.id], invalidations)
+        return found
+
+    async def get_band(self, db, band_id):
+        return (await self.get_bands(db, [band_id])).get(band_id)
+
+    async def get_rosters(self, db, band_ids):
+        """Rosters by band id in one query for the ones not cached, a band without members gets {}"""
+        found = {}
+        missing = []
+        for band_id in band_ids:
+            roster = self.rosters.get(band_id)
+            if roster is None:
+                missing.append(band_id)
+                found[band_id] = {}
+            else:
+                found[band_id] = roster
+        if missing:
+            invalidations = self.rosters.invalidations
+            for band_id, user_id, admin in (await db.execute(select(
+                    BandMember.band_id, BandMember.user_id, BandMember.admin).where(
+                    BandMember.band_id.in_(missing)))).all():
+                found[band_id][user_id] = admin
+            for band_id in missing:
+                if found[band_id]:
+                    self.rosters.set(band_id, found[band_id], invalidations)
+        return found
+
+    async def get_roster(self, db, band_id):
+        return (await self.get_rosters(db, [band_id]))[band_id]
+
+    async def is_member(self, db, band_id, user_id):
+        return user_id in await self.get_roster(db, band_id)
+
+    async def is_admin(self, db, band_id, user_id):
+        return bool((await self.get_roster(db, band_id)).get(user_id))
+
+    def invalidate_user(self, user_id):
+        self.users.invalidate(user_id)
+
+    def invalidate_band(self, band_id):
+        self.bands.invalidate(band_id)
+        self.rosters.invalidate(band_id)
+
+    def invalidate_roster(self, band_id):
+        self.rosters.invalidate(band_id)
+
+    def invalidate_member(self, user_id):
+        """Drop the user and every cached roster they are on, for when a user is deleted"""
+        self.users.invalidate(user_id)
+        for band_id, (_, roster) in list(self.rosters.entries.items()):
+            if user_id in roster:
+                self.rosters.invalidate(band_id)
+
+    def clear(self):
+        for cache in (self.users, self.bands, self.rosters):
+            cache.clear()
+
+    def hit_ratio(self):
+        hits = sum(cache.hits for cache in (self.users, self.bands, self.rosters))
+        lookups = hits + sum(cache.misses for cache in (self.users, self.bands, self.rosters))
+        return hits / lookups if lookups else 0.0
+
+
+entity_cache = EntityCache()
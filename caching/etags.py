@@ -0,0 +1,28 @@
+import hashlib
+
+from starlette.responses import Response
+
+
+def version_etag(kind, entity):
+    """Strong ETag of a cached user or band dict, changes whenever its version column is bumped"""
+    return '"%s-%d-%d"' % (kind, entity["id"], entity["version"])
+
+
+def roster_etag(band_id, roster, users):
+    """Strong ETag of a roster view, covers who is on it, their role and the version of each member"""
+    members = sorted((user_id, bool(admin), users[user_id]["version"])
+                     for user_id, admin in roster.items() if user_id in users)
+    return '"roster-%d-%s"' % (band_id, hashlib.sha1(repr(members).encode()).hexdigest()[:16])
+
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match uses the weak comparison, a W/ prefix on the client's copy still matches
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def not_modified(etag):
+    return Response(status_code=304, headers={"ETag": etag})
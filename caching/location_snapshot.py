@@ -0,0 +1,94 @@
+"""
+Read-only snapshot of location_cache in a memory map, shared by pre-forked workers.
+
+A dict of every geocode built before fork would be shared too, but only until the workers read it: every
+lookup updates the reference counts stored in the dict's objects, which dirties their pages and gives each
+worker its own copy. The snapshot keeps the entries in a file-backed map the workers only ever read, so the
+kernel keeps a single copy however many workers there are.
+
+Layout, little endian, entries sorted by the UTF-8 bytes of the lowercased location:
+    header   magic b"LOCSNAP1", entry count (uint32)
+    entries  string offset (uint32), string length (uint32), lng, lat (float64), cached_at (int64)
+    strings  the locations, back to back
+"""
+import mmap
+import struct
+import tempfile
+import time
+
+from sqlalchemy import select
+
+from database_models.models import LocationCache
+
+MAGIC = b"LOCSNAP1"
+HEADER = struct.Struct("<8sI")
+ENTRY = struct.Struct("<IIddq")
+
+# the snapshot the workers read, set by the prefork server before it forks
+active = None
+
+
+class LocationSnapshot:
+    def __init__(self, buffer):
+        magic, self.count = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("not a location snapshot")
+        self.buffer = buffer
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Snapshot of (location, lng, lat, cached_at) rows in an unlinked temporary file, mapped read only"""
+        latest = {}
+        for location, lng, lat, cached_at in rows:
+            key = location.lower().encode()
+            if key not in latest or latest[key][2] < cached_at:
+                latest[key] = (lng, lat, int(cached_at))
+        keys = sorted(latest)
+        strings_start = HEADER.size + ENTRY.size * len(keys)
+        with tempfile.TemporaryFile() as file:
+            file.write(HEADER.pack(MAGIC, len(keys)))
+            offset = strings_start
+            for key in keys:
+                file.write(ENTRY.pack(offset, len(key), *latest[key]))
+                offset += len(key)
+            for key in keys:
+                file.write(key)
+            file.flush()
+            # the map keeps the pages alive after the file is closed
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def from_database(cls, conn):
+        return cls.from_rows(conn.execute(select(
+            LocationCache.location, LocationCache.lng, LocationCache.lat, LocationCache.cached_at)).all())
+
+    def _entry(self, index):
+        return ENTRY.unpack_from(self.buffer, HEADER.size + ENTRY.size * index)
+
+    def _key(self, entry):
+        return self.buffer[entry[0]:entry[0] + entry[1]]
+
+    def get(self, location, max_age=None):
+        """(lng, lat) of a location, None when missing or cached more than max_age seconds ago"""
+        key = location.lower().encode()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(self._entry(middle)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.count:
+            return None
+        entry = self._entry(low)
+        if self._key(entry) != key or (max_age is not None and entry[4] < time.time() - max_age):
+            return None
+        return entry[2], entry[3]
+
+    def __len__(self):
+        return self.count
+
+
+def activate(snapshot):
+    global active
+    active = snapshot
@@ -0,0 +1,115 @@
+import time
+import zlib
+
+import orjson
+from decouple import config
+from sqlalchemy import select, delete, insert, update, or_
+
+from database_models.models import DBMessage, MessageArchiveBlock
+
+# messages older than this move from the message table to message_archive
+MESSAGE_RETENTION_DAYS = config("MESSAGE_RETENTION_DAYS", default=90, cast=int)
+ARCHIVE_BLOCK_MESSAGES = 500
+# messages moved per transaction
+ARCHIVE_BATCH_SIZE = 5000
+# archived rows are [id, sender_user_id, recipient_user_id, message, sent, read]
+FIELDS = ("id", "sender_user_id", "recipient_user_id", "message", "sent", "read")
+
+
+def conversation(user_id, other_user_id):
+    return min(user_id, other_user_id), max(user_id, other_user_id)
+
+
+def encode_block(rows):
+    return zlib.compress(orjson.dumps(rows))
+
+
+def decode_block(data):
+    return [dict(zip(FIELDS, row)) for row in orjson.loads(zlib.decompress(data))]
+
+
+async def archive_boundary(db, cutoff):
+    """
+    First message id that stays hot: every message below it was sent before cutoff.
+
+    Archiving only a prefix of the id space keeps every archived message older than every hot one, per
+    conversation too, which is what lets get_messages page from the hot table straight into the archive.
+    The scan runs in primary key order and stops at the first recent message.
+    """
+    boundary = (await db.execute(select(DBMessage.id).where(DBMessage.sent >= cutoff)
+                                 .order_by(DBMessage.id).limit(1))).scalar()
+    if boundary is None:
+        boundary = ((await db.execute(select(DBMessage.id).order_by(DBMessage.id.desc()).limit(1))).scalar() or 0) + 1
+    return boundary
+
+
+async def _append(db, low, high, rows):
+    """Append id ordered rows to the conversation's last block while it has room, then to new blocks"""
+    last = (await db.execute(select(MessageArchiveBlock.id, MessageArchiveBlock.count, MessageArchiveBlock.data).where(
+        MessageArchiveBlock.user_low == low, MessageArchiveBlock.user_high == high).order_by(
+        MessageArchiveBlock.last_id.desc()).limit(1))).first()
+    if last is not None and last.count < ARCHIVE_BLOCK_MESSAGES:
+        room = ARCHIVE_BLOCK_MESSAGES - last.count
+        merged = orjson.loads(zlib.decompress(last.data)) + rows[:room]
+        await db.execute(update(MessageArchiveBlock).where(MessageArchiveBlock.id == last.id).values(
+            last_id=merged[-1][0], count=len(merged), data=encode_block(merged)))
+        rows = rows[room:]
+    blocks = [rows[start:start + ARCHIVE_BLOCK_MESSAGES] for start in range(0, len(rows), ARCHIVE_BLOCK_MESSAGES)]
+    if blocks:
+        await db.execute(insert(MessageArchiveBlock), [
+            {"user_low": low, "user_high": high, "first_id": block[0][0], "last_id": block[-1][0],
+             "count": len(block), "data": encode_block(block)} for block in blocks])
+
+
+async def archive_old_messages(db, deadline, retention_days=MESSAGE_RETENTION_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Move messages older than retention_days into compressed per conversation blocks, batch_size messages per
+    transaction, until none are left or the monotonic deadline has passed. Returns the messages moved.
+    """
+    boundary = await archive_boundary(db, time.time() - retention_days * 24 * 3600)
+    moved = 0
+    while True:
+        rows = (await db.execute(select(*(getattr(DBMessage, field) for field in FIELDS)).where(
+            DBMessage.id < boundary).order_by(DBMessage.id).limit(batch_size))).all()
+        if not rows:
+            await db.commit()
+            return moved
+        by_conversation = {}
+        for row in rows:
+            by_conversation.setdefault(conversation(row.sender_user_id, row.recipient_user_id), []).append(
+                [row.id, row.sender_user_id, row.recipient_user_id, row.message, row.sent, bool(row.read)])
+        for (low, high), conversation_rows in by_conversation.items():
+            await _append(db, low, high, conversation_rows)
+        await db.execute(delete(DBMessage).where(DBMessage.id <= rows[-1].id))
+        await db.commit()
+        moved += len(rows)
+        if len(rows) < batch_size or time.monotonic() >= deadline:
+            return moved
+
+
+async def archived_messages(db, user_id, other_user_id, before=None, limit=None):
+    """
+    The newest `limit` archived messages of a conversation with an id below `before` (all of them when
+    limit is None), oldest first as MessageOut dicts. Only the blocks needed for the page are decompressed.
+    """
+    low, high = conversation(user_id, other_user_id)
+    statement = select(MessageArchiveBlock.data).where(
+        MessageArchiveBlock.user_low == low, MessageArchiveBlock.user_high == high).order_by(
+        MessageArchiveBlock.last_id.desc())
+    if before is not None:
+        statement = statement.where(MessageArchiveBlock.first_id < before)
+    if limit is not None:
+        # the newest block may be cut by before, the ones behind it are full
+        statement = statement.limit(limit // ARCHIVE_BLOCK_MESSAGES + 2)
+    messages = []
+    for data in (await db.execute(statement)).scalars():
+        block = [message for message in decode_block(data) if before is None or message["id"] < before]
+        messages = block + messages
+        if limit is not None and len(messages) >= limit:
+            return messages[-limit:]
+    return messages
+
+
+def delete_user_archive(user_id):
+    return delete(MessageArchiveBlock).where(or_(MessageArchiveBlock.user_low == user_id,
+                                                 MessageArchiveBlock.user_high == user_id))
@@ -0,0 +1,109 @@
+import logging
+import random
+
+from decouple import config
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+sql_logger = logging.getLogger("database_models.sql")
+
+# async drivers used when DATABASE_ASYNC_URL is not set explicitly
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+
+class DatabaseConfig:
+    def __init__(self, url="sqlite:///./database.db", async_url=None, pool_size=5, max_overflow=10,
+                 pool_recycle=1800, pool_timeout=30, sqlite_mmap_size=256 * 1024 * 1024,
+                 sqlite_cache_size=-64 * 1024, sqlite_busy_timeout=5000, log_sample_rate=0.0):
+        self.url = url
+        self.async_url = async_url or self._default_async_url(url)
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_recycle = pool_recycle
+        self.pool_timeout = pool_timeout
+        self.sqlite_mmap_size = sqlite_mmap_size
+        # negative values are KiB rather than pages
+        self.sqlite_cache_size = sqlite_cache_size
+        self.sqlite_busy_timeout = sqlite_busy_timeout
+        self.log_sample_rate = log_sample_rate
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            url=config("DATABASE_URL", default="sqlite:///./database.db"),
+            async_url=config("DATABASE_ASYNC_URL", default=None),
+            pool_size=config("DB_POOL_SIZE", default=5, cast=int),
+            max_overflow=config("DB_MAX_OVERFLOW", default=10, cast=int),
+            pool_recycle=config("DB_POOL_RECYCLE", default=1800, cast=int),
+            pool_timeout=config("DB_POOL_TIMEOUT", default=30, cast=int),
+            sqlite_mmap_size=config("DB_SQLITE_MMAP_SIZE", default=256 * 1024 * 1024, cast=int),
+            sqlite_cache_size=config("DB_SQLITE_CACHE_SIZE", default=-64 * 1024, cast=int),
+            sqlite_busy_timeout=config("DB_SQLITE_BUSY_TIMEOUT", default=5000, cast=int),
+            log_sample_rate=config("DB_LOG_SAMPLE_RATE", default=0.0, cast=float),
+        )
+
+    @staticmethod
+    def _default_async_url(url):
+        parsed = make_url(url)
+        backend = parsed.get_backend_name()
+        if backend not in ASYNC_DRIVERS:
+            raise ValueError("Set DATABASE_ASYNC_URL, no default async driver for " + backend)
+        return str(parsed.set(drivername=ASYNC_DRIVERS[backend]))
+
+    @property
+    def is_sqlite(self):
+        return make_url(self.url).get_backend_name() == "sqlite"
+
+    def engine_options(self, is_async=False):
+        options = {
+            "pool_size": self.pool_size,
+            "max_overflow": self.max_overflow,
+            "pool_recycle": self.pool_recycle,
+            "pool_timeout": self.pool_timeout,
+            "pool_pre_ping": not self.is_sqlite,
+        }
+        if self.is_sqlite:
+            # sqlite dialects default to NullPool for files, which reconnects and re-applies pragmas per session.
+            # Every session must be short lived (the WebSocket loop opens one per message) and the engines are
+            # disposed on shutdown, see db_connector.dispose_engines
+            options["poolclass"] = AsyncAdaptedQueuePool if is_async else QueuePool
+            if not is_async:
+                options["connect_args"] = {"check_same_thread": False}
+        return options
+
+    def install(self, engine):
+        """Register the connect and logging hooks on a (sync) Engine, for async engines pass engine.sync_engine"""
+        if self.is_sqlite:
+            event.listen(engine, "connect", self._apply_sqlite_pragmas)
+        if self.log_sample_rate > 0:
+            event.listen(engine, "before_cursor_execute", self._sample_statement)
+            self._enable_sql_logger()
+
+    def _apply_sqlite_pragmas(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers proceed while a writer commits instead of serializing on the rollback journal
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # fsync on checkpoint only, a crash can lose the last transactions but never corrupts the database
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA mmap_size=%d" % self.sqlite_mmap_size)
+        cursor.execute("PRAGMA cache_size=%d" % self.sqlite_cache_size)
+        cursor.execute("PRAGMA busy_timeout=%d" % self.sqlite_busy_timeout)
+        cursor.close()
+
+    @staticmethod
+    def _enable_sql_logger():
+        # the app does not configure logging, without this sampled statements would stop at the WARNING root
+        sql_logger.setLevel(logging.INFO)
+        if not sql_logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+            sql_logger.addHandler(handler)
+
+    def _sample_statement(self, conn, cursor, statement, parameters, context, executemany):
+        if random.random() < self.log_sample_rate:
+            sql_logger.info("%s %r", statement, parameters)
@@ -1,21 +1,71 @@
+import functools
+
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-DATABASE_URL = "sqlite:///./database.db"
-
-engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}, echo=True
-)
+from database_models.db_config import DatabaseConfig
 
-DbSession = sessionmaker(bind=engine)
+# Nothing here connects or reads settings at import: the engines are created on first use, so importing
+# the app (tests, scripts, the multi-worker preload) costs no connections and needs no environment
+_engines = {}
 
 Base = declarative_base()
 
 
-def get_database():
-    try:
-        db = DbSession()
+@functools.lru_cache(maxsize=1)
+def get_db_config():
+    return DatabaseConfig.from_env()
+
+
+def get_engine():
+    """Synchronous engine for schema management and scripts that run outside the event loop"""
+    if "sync" not in _engines:
+        db_config = get_db_config()
+        engine = create_engine(db_config.url, **db_config.engine_options())
+        db_config.install(engine)
+        _engines["sync"] = engine
+    return _engines["sync"]
+
+
+def get_async_engine():
+    """Request handlers use the async engine so a query never blocks the event loop"""
+    if "async" not in _engines:
+        db_config = get_db_config()
+        engine = create_async_engine(db_config.async_url, **db_config.engine_options(is_async=True))
+        db_config.install(engine.sync_engine)
+        _engines["async"] = engine
+    return _engines["async"]
+
+
+@functools.lru_cache(maxsize=1)
+def _session_factory():
+    return sessionmaker(bind=get_engine())
+
+
+@functools.lru_cache(maxsize=1)
+def _async_session_factory():
+    # Objects stay usable after commit, attribute refreshes would need an await
+    return sessionmaker(bind=get_async_engine(), class_=AsyncSession, expire_on_commit=False)
+
+
+def DbSession():
+    return _session_factory()()
+
+
+def AsyncDbSession():
+    return _async_session_factory()()
+
+
+async def get_database():
+    async with AsyncDbSession() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
+
+
+async def dispose_engines():
+    # pooled aiosqlite connections each own a non-daemon thread, the process cannot exit until they close
+    if "async" in _engines:
+        await _engines["async"].dispose()
+    if "sync" in _engines:
+        _engines["sync"].dispose()
@@ -0,0 +1,87 @@
+import time
+
+from sqlalchemy import delete, insert, select, literal, or_
+
+from auth.claims import bump_roles_version
+from database_models.archive import delete_user_archive
+from database_models.models import (
+    User, Band, BandMember, BandInvite, BandInviteByEmail, EmailVerification, DBNotification, DBMessage,
+    LookingForBand, LookingForMember, RevokedToken, NotificationPriority
+)
+
+
+async def _delete_all(db, statements):
+    """Run the DELETE statements in order on the session's transaction, returns rows affected per table"""
+    deleted = {}
+    for statement in statements:
+        result = await db.execute(statement)
+        # quoted_name is a str subclass that orjson refuses as a key
+        table = str(statement.table.name)
+        deleted[table] = deleted.get(table, 0) + result.rowcount
+    return deleted
+
+
+async def delete_user_cascade(db, user_id: int):
+    """
+    Delete a user and every row that references them with one statement per table.
+
+    Runs on the caller's transaction and commits once, nothing is left behind if a statement fails.
+    """
+    try:
+        deleted = await _delete_all(db, [
+            delete(RevokedToken).where(RevokedToken.user_id == user_id),
+            delete(EmailVerification).where(EmailVerification.user_id == user_id),
+            delete(BandInvite).where(BandInvite.user_id == user_id),
+            delete(DBNotification).where(DBNotification.recipient_user_id == user_id),
+            delete(DBMessage).where(or_(DBMessage.sender_user_id == user_id, DBMessage.recipient_user_id == user_id)),
+            delete_user_archive(user_id),
+            delete(BandMember).where(BandMember.user_id == user_id),
+            delete(LookingForBand).where(LookingForBand.user_id == user_id),
+            delete(User).where(User.id == user_id),
+        ])
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    return deleted
+
+
+async def delete_band_cascade(db, band_id: int, notice: str = None, priority=NotificationPriority.high,
+                              expiration: float = None):
+    """
+    Delete a band, its roster, invites and listings in one transaction.
+
+    When notice is given every member gets a notification from a single INSERT ... SELECT over the roster
+    before it is removed. Returns (rows affected per table, emails of members who opted into email
+    notifications) so the caller can send emails after the commit.
+    """
+    try:
+        emails = []
+        deleted = {}
+        if notice is not None:
+            emails = list((await db.execute(select(User.email).join(BandMember, BandMember.user_id == User.id).where(
+                BandMember.band_id == band_id, User.email_notifications_opt_in == True))).scalars())
+            notified = await db.execute(insert(DBNotification).from_select(
+                ["recipient_user_id", "message", "read", "date_sent", "priority", "expiration"],
+                select(BandMember.user_id,
+                       literal(notice),
+                       literal(False),
+                       literal(int(time.time())),
+                       literal(priority, DBNotification.priority.type),
+                       literal(expiration, DBNotification.expiration.type))
+                .where(BandMember.band_id == band_id)))
+            deleted["notifications_sent"] = notified.rowcount
+        # the members' role claims name the band
+        await db.execute(bump_roles_version(select(BandMember.user_id).where(BandMember.band_id == band_id)))
+        deleted.update(await _delete_all(db, [
+            delete(BandMember).where(BandMember.band_id == band_id),
+            delete(BandInvite).where(BandInvite.band_id == band_id),
+            delete(BandInviteByEmail).where(BandInviteByEmail.band_id == band_id),
+            delete(LookingForMember).where(LookingForMember.band_id == band_id),
+            delete(Band).where(Band.id == band_id),
+        ]))
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    return deleted, emails
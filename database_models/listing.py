@@ -0,0 +1,79 @@
+import orjson
+from sqlalchemy import select, tuple_
+
+from base_models.response_models import UserOut, BandOut, projection
+from database_models.models import (
+    User, Band, BandMember, EmailVerification, LookingForMember, LookingForBand, BandInviteByEmail
+)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+EXPORT_CHUNK_SIZE = 1000
+
+# listing name -> (model, selected columns), the primary key must be among the columns
+LISTINGS = {
+    "users": (User, projection(UserOut, User)),
+    "bands": (Band, projection(BandOut, Band)),
+    "band_members": (BandMember, list(BandMember.__table__.columns)),
+    "verifications": (EmailVerification, list(EmailVerification.__table__.columns)),
+    "lfms": (LookingForMember, list(LookingForMember.__table__.columns)),
+    "lfbs": (LookingForBand, list(LookingForBand.__table__.columns)),
+    "bibe": (BandInviteByEmail, list(BandInviteByEmail.__table__.columns)),
+}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _primary_key(model):
+    return list(model.__table__.primary_key.columns)
+
+
+def encode_cursor(row, primary_key):
+    return ",".join(str(row[column.key]) for column in primary_key)
+
+
+def decode_cursor(cursor, primary_key):
+    values = cursor.split(",")
+    if len(values) != len(primary_key):
+        raise InvalidCursor(cursor)
+    try:
+        return [int(value) for value in values]
+    except ValueError:
+        raise InvalidCursor(cursor)
+
+
+async def keyset_page(db, name, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    One page of a listing in primary key order, starting after the cursor of the previous page.
+
+    Seeks with WHERE pk > cursor on the primary key index, so page n costs the same as page 1
+    (OFFSET would read and throw away every earlier row). "next" is None on the last page.
+    """
+    model, columns = LISTINGS[name]
+    primary_key = _primary_key(model)
+    statement = select(*columns).order_by(*primary_key).limit(min(limit, MAX_PAGE_SIZE))
+    if after:
+        values = decode_cursor(after, primary_key)
+        if len(primary_key) == 1:
+            statement = statement.where(primary_key[0] > values[0])
+        else:
+            statement = statement.where(tuple_(*primary_key) > tuple_(*values))
+    items = [dict(row) for row in (await db.execute(statement)).mappings()]
+    full_page = len(items) == min(limit, MAX_PAGE_SIZE)
+    return {"items": items, "next": encode_cursor(items[-1], primary_key) if full_page else None}
+
+
+async def stream_ndjson(db, name, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Every row of a listing as newline delimited JSON, read from a server side cursor chunk_size rows at a time.
+
+    Memory stays at one chunk whatever the table size, and the event loop serves other requests while the
+    driver fetches the next chunk.
+    """
+    model, columns = LISTINGS[name]
+    result = await db.stream(select(*columns).order_by(*_primary_key(model))
+                             .execution_options(yield_per=chunk_size))
+    async for chunk in result.mappings().partitions():
+        yield b"".join(orjson.dumps(dict(row)) + b"\n" for row in chunk)
@@ -0,0 +1,161 @@
+import logging
+import time
+
+from sqlalchemy import inspect, Table, Column, Integer, String, BigInteger, MetaData, select, insert
+
+from database_models.models import Base, User, Band
+from database_models.search import install_full_text_search
+
+logger = logging.getLogger(__name__)
+
+schema_version = Table(
+    "schema_version", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", BigInteger, nullable=False),
+)
+
+
+def add_token_revocation_column(conn):
+    user_columns = {column["name"] for column in inspect(conn).get_columns(User.__tablename__)}
+    if "tokens_valid_after" not in user_columns:
+        conn.exec_driver_sql('ALTER TABLE "user" ADD COLUMN tokens_valid_after FLOAT NOT NULL DEFAULT 0')
+
+
+def add_version_columns(conn):
+    for table in (User.__tablename__, Band.__tablename__):
+        columns = {column["name"] for column in inspect(conn).get_columns(table)}
+        if "version" not in columns:
+            conn.exec_driver_sql('ALTER TABLE "%s" ADD COLUMN version INTEGER NOT NULL DEFAULT 1' % table)
+
+
+def convert_message_timestamps(conn):
+    # only SQLite accepted text in the BigInteger column
+    if conn.dialect.name == "sqlite":
+        conn.exec_driver_sql(
+            "UPDATE message SET sent = CAST(strftime('%s', sent) AS INTEGER) WHERE typeof(sent) = 'text'")
+
+
+# Names match the Index/index=True declarations in models.py, so databases built by create_all
+# and databases upgraded here end up with the same schema
+HOT_PATH_INDEXES = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_user_email ON "user" (email)',
+    "CREATE INDEX IF NOT EXISTS ix_band_member_user_id ON band_member (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_band_invite_code ON band_invite (code)",
+    "CREATE INDEX IF NOT EXISTS ix_email_verification_code ON email_verification (code)",
+    "CREATE INDEX IF NOT EXISTS ix_band_invite_by_email_email ON band_invite_by_email (email)",
+    "CREATE INDEX IF NOT EXISTS ix_notification_recipient_user_id ON notification (recipient_user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_message_sender_recipient_sent ON message (sender_user_id, recipient_user_id, sent)",
+    "CREATE INDEX IF NOT EXISTS ix_message_recipient_sender_sent ON message (recipient_user_id, sender_user_id, sent)",
+    "CREATE INDEX IF NOT EXISTS ix_location_cache_location ON location_cache (location)",
+]
+
+# the scheduler's purges find expired rows through these
+EXPIRY_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_band_invite_expiration ON band_invite (expiration)",
+    "CREATE INDEX IF NOT EXISTS ix_band_invite_by_email_expiration ON band_invite_by_email (expiration)",
+    "CREATE INDEX IF NOT EXISTS ix_email_verification_expiration ON email_verification (expiration)",
+    "CREATE INDEX IF NOT EXISTS ix_notification_expiration ON notification (expiration)",
+    "CREATE INDEX IF NOT EXISTS ix_location_cache_cached_at ON location_cache (cached_at)",
+]
+
+
+def add_hot_path_indexes(conn):
+    # location_to_coords looks up lower(location) but used to store it as typed
+    conn.exec_driver_sql("UPDATE location_cache SET location = lower(location) WHERE location != lower(location)")
+    for statement in HOT_PATH_INDEXES:
+        conn.exec_driver_sql(statement)
+
+
+def index_invites_by_email_and_expiration(conn):
+    # the composite index also serves lookups by email alone
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_band_invite_by_email_email_expiration "
+                         "ON band_invite_by_email (email, expiration)")
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_band_invite_by_email_email")
+
+
+def add_expiry_columns_and_indexes(conn):
+    verification_columns = {column["name"] for column in inspect(conn).get_columns("email_verification")}
+    if "expiration" not in verification_columns:
+        conn.exec_driver_sql("ALTER TABLE email_verification ADD COLUMN expiration BIGINT")
+    cache_columns = {column["name"] for column in inspect(conn).get_columns("location_cache")}
+    if "cached_at" not in cache_columns:
+        conn.exec_driver_sql("ALTER TABLE location_cache ADD COLUMN cached_at BIGINT NOT NULL DEFAULT 0")
+        # existing geocodes count as fresh from now instead of being purged on the first sweep
+        conn.exec_driver_sql("UPDATE location_cache SET cached_at = %d" % int(time.time()))
+    for statement in EXPIRY_INDEXES:
+        conn.exec_driver_sql(statement)
+
+
+def add_roles_version_column(conn):
+    user_columns = {column["name"] for column in inspect(conn).get_columns(User.__tablename__)}
+    if "roles_version" not in user_columns:
+        conn.exec_driver_sql('ALTER TABLE "user" ADD COLUMN roles_version INTEGER NOT NULL DEFAULT 1')
+
+
+def add_full_text_search(conn):
+    # FTS5 is SQLite's, other databases need their own full text indexes
+    if conn.dialect.name == "sqlite":
+        install_full_text_search(conn)
+
+
+# (version, name, upgrade(conn)), append only: a released migration is never edited
+MIGRATIONS = [
+    (1, "token revocation column", add_token_revocation_column),
+    (2, "hot path indexes", add_hot_path_indexes),
+    (3, "user and band version columns", add_version_columns),
+    (4, "message timestamps as unix seconds", convert_message_timestamps),
+    (5, "band invite by email and expiration index", index_invites_by_email_and_expiration),
+    (6, "expiry columns and indexes for scheduled purges", add_expiry_columns_and_indexes),
+    (7, "full text search indexes", add_full_text_search),
+    (8, "user roles version column", add_roles_version_column),
+]
+
+
+def applied_versions(engine):
+    with engine.connect() as conn:
+        return set(conn.execute(select(schema_version.c.version)).scalars())
+
+
+def pending_migrations(engine, migrations=None):
+    """Versions the database has not applied yet, an up to date database costs two small queries"""
+    migrations = MIGRATIONS if migrations is None else migrations
+    done = applied_versions(engine) if inspect(engine).has_table(schema_version.name) else set()
+    return sorted(version for version, _, _ in migrations if version not in done)
+
+
+def run_migrations(engine, migrations=None):
+    """
+    Apply every migration newer than the database, one transaction per migration.
+
+    Tables that do not exist yet are created from the models first, so a fresh database only records
+    the migrations as applied. Index builds take SQLite's write lock while they run but readers carry on
+    in WAL mode, nothing is dropped or rebuilt.
+    """
+    migrations = MIGRATIONS if migrations is None else migrations
+    schema_version.create(bind=engine, checkfirst=True)
+    Base.metadata.create_all(bind=engine)
+    done = applied_versions(engine)
+    applied = []
+    for version, name, upgrade in sorted(migrations, key=lambda migration: migration[0]):
+        if version in done:
+            continue
+        start = time.time()
+        with engine.begin() as conn:
+            upgrade(conn)
+            conn.execute(insert(schema_version).values(version=version, name=name, applied_at=int(time.time())))
+        logger.info("Applied migration %d %s in %.2fs", version, name, time.time() - start)
+        applied.append(version)
+    return applied
+
+
+def ensure_schema(engine):
+    """
+    Check the schema at startup and only migrate when it is behind.
+
+    run_migrations reflects every table through create_all, checking schema_version first keeps that off
+    the startup of every worker once the database is current.
+    """
+    if pending_migrations(engine):
+        return run_migrations(engine)
+    return []
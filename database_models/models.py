@@ -1,11 +1,16 @@
 import enum
 import json
+import time
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, String, Integer, Boolean, Float, ForeignKey, BigInteger, DateTime, func, Enum
+from sqlalchemy import (
+    Column, String, Integer, Boolean, Float, ForeignKey, BigInteger, DateTime, func, Enum, Index, LargeBinary
+)
 
 Base = declarative_base()
 
+THIRTY_DAYS_IN_SECONDS = 30 * 24 * 60 * 60
+
 
 class Band(Base):
     __tablename__ = 'band'
@@ -14,6 +19,8 @@ class Band(Base):
     location = Column(String)
     longitude = Column(Float)
     latitude = Column(Float)
+    # bumped on every change, part of the ETag
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
 
 class User(Base):
@@ -21,19 +28,35 @@ class User(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     first_name = Column(String)
     last_name = Column(String)
-    email = Column(String)
+    email = Column(String, unique=True, index=True)
     password_hash = Column(String(60))
     location = Column(String)
     longitude = Column(Float)
     latitude = Column(Float)
     email_verified = Column(Boolean, default=False)
     email_notifications_opt_in = Column(Boolean, default=False)
+    # tokens issued before this unix timestamp are rejected
+    tokens_valid_after = Column(Float, nullable=False, default=0)
+    # bumped on every change, part of the ETag
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    # bumped whenever the user's band memberships change, makes the role claims of older tokens stale
+    roles_version = Column(Integer, nullable=False, default=1, server_default="1")
+
+
+class RevokedToken(Base):
+    __tablename__ = "revoked_token"
+    jti = Column(String(32), primary_key=True)
+    user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    # once the token itself has expired the row can be purged
+    expiration = Column(BigInteger, nullable=False)
 
 
 class EmailVerification(Base):
     __tablename__ = "email_verification"
     user_id = Column(Integer, ForeignKey("user.id"), primary_key=True)
-    code = Column(String(8))
+    code = Column(String(8), index=True)
+    # unverified codes are purged after this, rows from before the column have none and are kept
+    expiration = Column(BigInteger, default=lambda: int(time.time()) + THIRTY_DAYS_IN_SECONDS, index=True)
 
 
 class BandMember(Base):
@@ -42,14 +65,18 @@ class BandMember(Base):
     user_id = Column(Integer, ForeignKey("user.id"), primary_key=True)
     admin = Column(Boolean, default=False)
 
+    # the primary key covers lookups by band, this covers lookups by user
+    __table_args__ = (Index("ix_band_member_user_id", "user_id"),)
+
 
 class BandInvite(Base):
     __tablename__ = "band_invite"
     band_id = Column(Integer, ForeignKey("band.id"), primary_key=True)
     user_id = Column(Integer, ForeignKey("user.id"), primary_key=True, nullable=True)
     code = Column(String(8), primary_key=True)
-    # 30 days
-    expiration = Column(BigInteger, default=func.now()+30*24*60*60)
+    expiration = Column(BigInteger, default=lambda: int(time.time()) + THIRTY_DAYS_IN_SECONDS)
+
+    __table_args__ = (Index("ix_band_invite_code", "code"), Index("ix_band_invite_expiration", "expiration"))
 
 
 class NotificationPriority(enum.Enum):
@@ -61,12 +88,12 @@ class NotificationPriority(enum.Enum):
 class DBNotification(Base):
     __tablename__ = "notification"
     id = Column(Integer, primary_key=True, autoincrement=True)
-    recipient_user_id = Column(Integer, ForeignKey("user.id"), nullable=True)
+    recipient_user_id = Column(Integer, ForeignKey("user.id"), nullable=True, index=True)
     message = Column(String, nullable=False)
     read = Column(Boolean, nullable=False, default=False)
     date_sent = Column(BigInteger, nullable=False)
     priority = Column(Enum(NotificationPriority), nullable=False)
-    expiration = Column(BigInteger)
+    expiration = Column(BigInteger, index=True)
 
 class LookingForBand(Base):
     __tablename__ = "looking_for_band"
@@ -86,25 +113,45 @@ class LocationCache(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     lng = Column(Float, nullable=False)
     lat = Column(Float, nullable=False)
-    location = Column(String, nullable=False)
+    location = Column(String, nullable=False, index=True)
+    # geocodes older than LOCATION_CACHE_MAX_AGE_SECONDS are purged and looked up again
+    cached_at = Column(BigInteger, nullable=False, default=lambda: int(time.time()), server_default="0", index=True)
 
 class BandInviteByEmail(Base):
     __tablename__ = "band_invite_by_email"
+    # registration redeems unexpired invites by email, a range scan on one index
+    __table_args__ = (Index("ix_band_invite_by_email_email_expiration", "email", "expiration"),
+                      Index("ix_band_invite_by_email_expiration", "expiration"))
     id = Column(Integer, primary_key=True, autoincrement=True)
     email = Column(String, nullable=False)
     band_id = Column(Integer, ForeignKey("band.id"), nullable=False)
     expiration = Column(BigInteger)
 
 
+class JobLock(Base):
+    """Lease on a scheduled job, the worker holding an unexpired lease is the one that runs it"""
+    __tablename__ = "job_lock"
+    name = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires_at = Column(Float, nullable=False)
+
+
 class DBMessage(Base):
     __tablename__ = "message"
     id = Column(Integer, primary_key=True, autoincrement=True)
     sender_user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
     recipient_user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
     message = Column(String, nullable=False)
-    sent = Column(BigInteger, nullable=False, default=func.now())
+    # unix seconds, func.now() used to store SQLite's CURRENT_TIMESTAMP text in this integer column
+    sent = Column(BigInteger, nullable=False, default=lambda: int(time.time()))
     read = Column(BigInteger, nullable=False, default=False)
 
+    # one index per direction of a conversation, get_messages ORs both
+    __table_args__ = (
+        Index("ix_message_sender_recipient_sent", "sender_user_id", "recipient_user_id", "sent"),
+        Index("ix_message_recipient_sender_sent", "recipient_user_id", "sender_user_id", "sent"),
+    )
+
     def json(self):
         return {
             "sender_user_id": self.sender_user_id,
@@ -112,4 +159,25 @@ class DBMessage(Base):
             "message": self.message,
             "date_sent": self.sent,
             "read": self.read
-        }
\ No newline at end of file
+        }
+
+
+class MessageArchiveBlock(Base):
+    """
+    Up to ARCHIVE_BLOCK_MESSAGES consecutive messages of one conversation, moved out of the message table once
+    older than the retention age. data is zlib compressed JSON rows, see database_models.archive
+    """
+    __tablename__ = "message_archive"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # the conversation's user ids, lower one first
+    user_low = Column(Integer, ForeignKey("user.id"), nullable=False)
+    user_high = Column(Integer, ForeignKey("user.id"), nullable=False)
+    first_id = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (
+        Index("ix_message_archive_conversation", "user_low", "user_high", "last_id"),
+        Index("ix_message_archive_user_high", "user_high"),
+    )
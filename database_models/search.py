@@ -0,0 +1,116 @@
+import re
+
+from sqlalchemy import select, table, column, or_, and_
+
+from base_models.response_models import UserOut, BandOut, MessageOut, projection
+from database_models.models import User, Band, DBMessage
+
+DEFAULT_SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+
+# index name -> (content table, indexed columns). External content tables: the FTS index stores only the
+# tokens and reads the text back from the content table, the triggers keep it in sync on every write
+FULL_TEXT_INDEXES = {
+    "band_fts": ("band", ("name",)),
+    "user_fts": ("user", ("first_name", "last_name")),
+    "message_fts": ("message", ("message",)),
+}
+
+band_fts = table("band_fts", column("rowid"), column("rank"), column("band_fts"))
+user_fts = table("user_fts", column("rowid"), column("rank"), column("user_fts"))
+message_fts = table("message_fts", column("rowid"), column("rank"), column("message_fts"))
+
+
+class FullTextSearchUnavailable(Exception):
+    pass
+
+
+def _fts_statements(index, content, columns):
+    names = ", ".join(columns)
+    new = ", ".join("new." + name for name in columns)
+    old = ", ".join("old." + name for name in columns)
+    delete_old = "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.id, %s);" % (index, index, names, old)
+    insert_new = "INSERT INTO %s(rowid, %s) VALUES (new.id, %s);" % (index, names, new)
+    return [
+        # prefix indexes answer 2 and 3 character prefix queries without scanning every term
+        "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, content='%s', content_rowid='id', "
+        "prefix='2 3', tokenize='unicode61 remove_diacritics 2')" % (index, names, content),
+        'CREATE TRIGGER IF NOT EXISTS %s_ai AFTER INSERT ON "%s" BEGIN %s END' % (index, content, insert_new),
+        'CREATE TRIGGER IF NOT EXISTS %s_ad AFTER DELETE ON "%s" BEGIN %s END' % (index, content, delete_old),
+        'CREATE TRIGGER IF NOT EXISTS %s_au AFTER UPDATE OF %s ON "%s" BEGIN %s %s END'
+        % (index, names, content, delete_old, insert_new),
+        # indexes the rows written before the triggers existed
+        "INSERT INTO %s(%s) VALUES ('rebuild')" % (index, index),
+    ]
+
+
+def install_full_text_search(conn):
+    """Create the FTS5 indexes and their sync triggers, SQLite only"""
+    for index, (content, columns) in FULL_TEXT_INDEXES.items():
+        for statement in _fts_statements(index, content, columns):
+            conn.exec_driver_sql(statement)
+
+
+def match_expression(text):
+    """
+    FTS5 query for user input, every word must match as a prefix: 'gree da' -> '"gree"* "da"*'
+
+    Only word characters are kept, so quotes and FTS operators in the input cannot change the query.
+    Returns None when there is nothing to search for.
+    """
+    words = re.findall(r"\w+", text)
+    return " ".join('"%s"*' % word for word in words) or None
+
+
+async def _check_available(db):
+    if (await db.connection()).dialect.name != "sqlite":
+        raise FullTextSearchUnavailable()
+
+
+def _page(items, offset, limit):
+    return {"items": items, "next": str(offset + limit) if len(items) == limit else None}
+
+
+async def search_bands(db, text, offset=0, limit=DEFAULT_SEARCH_PAGE_SIZE):
+    """Bands whose name matches, best match first (bm25), "next" is the offset of the following page"""
+    await _check_available(db)
+    limit = min(limit, MAX_SEARCH_PAGE_SIZE)
+    statement = select(*projection(BandOut, Band)).select_from(
+        band_fts.join(Band, Band.id == band_fts.c.rowid)).where(
+        band_fts.c.band_fts.op("MATCH")(match_expression(text))).order_by(band_fts.c.rank).offset(offset).limit(limit)
+    return _page([dict(row) for row in (await db.execute(statement)).mappings()], offset, limit)
+
+
+async def search_users(db, text, offset=0, limit=DEFAULT_SEARCH_PAGE_SIZE):
+    """Users whose first or last name matches, best match first"""
+    await _check_available(db)
+    limit = min(limit, MAX_SEARCH_PAGE_SIZE)
+    statement = select(*projection(UserOut, User)).select_from(
+        user_fts.join(User, User.id == user_fts.c.rowid)).where(
+        user_fts.c.user_fts.op("MATCH")(match_expression(text))).order_by(user_fts.c.rank).offset(offset).limit(limit)
+    return _page([dict(row) for row in (await db.execute(statement)).mappings()], offset, limit)
+
+
+async def search_messages(db, user_id, text, with_user_id=None, before=None, limit=DEFAULT_SEARCH_PAGE_SIZE):
+    """
+    A user's sent and received messages that match, newest first. "next" is the id to pass as before,
+    seeking on the id instead of an offset keeps deep pages as cheap as the first.
+
+    Walks the user's messages on the sender/recipient indexes and probes the FTS index per message by rowid,
+    a common word matching most of the table is then as cheap as a rare one.
+    """
+    await _check_available(db)
+    limit = min(limit, MAX_SEARCH_PAGE_SIZE)
+    if with_user_id is None:
+        own = or_(DBMessage.sender_user_id == user_id, DBMessage.recipient_user_id == user_id)
+    else:
+        own = or_(and_(DBMessage.sender_user_id == user_id, DBMessage.recipient_user_id == with_user_id),
+                  and_(DBMessage.sender_user_id == with_user_id, DBMessage.recipient_user_id == user_id))
+    matches = select(message_fts.c.rowid).where(
+        message_fts.c.rowid == DBMessage.id, message_fts.c.message_fts.op("MATCH")(match_expression(text)))
+    statement = select(*projection(MessageOut, DBMessage)).where(own, matches.exists()).order_by(
+        DBMessage.id.desc()).limit(limit)
+    if before is not None:
+        statement = statement.where(DBMessage.id < before)
+    items = [dict(row) for row in (await db.execute(statement)).mappings()]
+    return {"items": items, "next": str(items[-1]["id"]) if len(items) == limit else None}
@@ -1,8 +1,13 @@
+import logging
 import smtplib
 from email.message import EmailMessage
 from decouple import config
+from starlette.concurrency import run_in_threadpool
 
-from database_models.models import User
+logger = logging.getLogger(__name__)
+
+# emails scheduled with Email.schedule and not sent yet
+queued_emails = 0
 
 
 class Email:
@@ -12,33 +17,67 @@ class Email:
         self.port = config('EMAIL_PORT')
         self.smtp_domain = config('SMTP_DOMAIN')
 
-    async def send_email(self, to, subject, message):
-        msg = EmailMessage()
-        msg.set_content(message)
-        msg['From'] = self.sender
-        msg['To'] = to
-        msg['Subject'] = subject
+    def send_email(self, to, subject, message):
+        """Blocking SMTP round trips, call send_email_async from request handlers"""
+        self.send_emails([(to, subject, message)])
+
+    def send_emails(self, messages):
+        """Send (to, subject, message) tuples over one SMTP session, blocking"""
+        try:
+            mailserver = smtplib.SMTP(self.smtp_domain, self.port)
+            # identify ourselves to smtp gmail client
+            mailserver.ehlo()
+            # secure our email with tls encryption
+            mailserver.starttls()
+            # re-identify ourselves as an encrypted connection
+            mailserver.ehlo()
+            mailserver.login(self.sender, self.email_pw)
+        except (smtplib.SMTPException, OSError):
+            # a mail outage should not fail the request that triggered the email
+            logger.exception("Could not send %d emails", len(messages))
+            return
+
+        for to, subject, message in messages:
+            msg = EmailMessage()
+            msg.set_content(message)
+            msg['From'] = self.sender
+            msg['To'] = to
+            msg['Subject'] = subject
+            try:
+                mailserver.sendmail(self.sender, to, msg.as_string())
+            except (smtplib.SMTPException, OSError):
+                logger.exception("Could not send email to %s", to)
+        try:
+            mailserver.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    async def send_email_async(self, to, subject, message):
+        await run_in_threadpool(self.send_email, to, subject, message)
+
+    async def send_emails_async(self, messages):
+        await run_in_threadpool(self.send_emails, messages)
 
-        mailserver = smtplib.SMTP(self.smtp_domain, self.port)
-        # identify ourselves to smtp gmail client
-        mailserver.ehlo()
-        # secure our email with tls encryption
-        mailserver.starttls()
-        # re-identify ourselves as an encrypted connection
-        mailserver.ehlo()
-        mailserver.login(self.sender, self.email_pw)
+    def schedule(self, background_tasks, send, *args):
+        """Run the coroutine function `send` after the response, counted in queued_emails until it finishes"""
+        global queued_emails
+        queued_emails += 1
 
-        mailserver.sendmail(self.sender, to, msg.as_string())
+        async def send_and_count():
+            global queued_emails
+            try:
+                await send(*args)
+            finally:
+                queued_emails -= 1
 
-        mailserver.quit()
+        background_tasks.add_task(send_and_count)
 
-    def send_invite_email(self, code, email):
+    async def send_invite_email(self, code, email):
         # TODO Change localhost to configured domain url
         url = "localhost:8000/activate/" + code
         subject = "Welcome"
         message = "Click on the following link to activate your account. " + url
-        self.send_email(email, subject, message)
+        await self.send_email_async(email, subject, message)
 
-    def send_notification_email(self, user_id, subject, message):
-        user = User.query.get(user_id)
-        self.send_email(user.email, subject, message)
\ No newline at end of file
+    async def send_notification_email(self, email, subject, message):
+        await self.send_email_async(email, subject, message)
@@ -0,0 +1,17 @@
+import functools
+
+from decouple import config
+
+
+@functools.lru_cache(maxsize=1)
+def google_client():
+    # googlemaps pulls in requests, about a sixth of the app's import time, and the key is only needed once a
+    # location misses location_cache, so both wait for the first lookup
+    import googlemaps
+    return googlemaps.Client(key=config("GEOCODE_API_KEY"))
+
+
+def google_geocode(location):
+    """{"lng", "lat"} of a location or None, blocking"""
+    result = google_client().geocode(location)
+    return result[0]["geometry"]["location"] if result else None
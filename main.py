@@ -1,27 +1,41 @@
+import asyncio
 import json
 import logging.config
 import string
 import time
 from types import SimpleNamespace
 
-import uvicorn
-import googlemaps
-from fastapi import FastAPI, Depends, HTTPException, Request
-from sqlalchemy import or_, and_
+from fastapi import APIRouter, FastAPI, Depends, HTTPException, Request, BackgroundTasks, Header, Query
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import or_, and_, select, delete, insert, literal, false
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
 from starlette.websockets import WebSocket, WebSocketDisconnect
 
 from database_models.db_connector import get_database
-from sqlalchemy.orm import Session
 
+import emails
 from emails import Email
 from base_models.band_models import (
     PostUserRequest,
     PostBandRequest,
     PostSendInvite,
+    PostSendInvites,
     PostAcceptInvite, GetUserLogin,
     JwtUser, Message
 )
-from database_models.db_connector import engine, DbSession
+from base_models.response_models import (
+    UserOut, BandOut, BandMemberOut, MessageOut, BatchOut, SearchPage, projection, project, rows_as_dicts
+)
+from database_models.db_connector import get_engine, get_db_config, DbSession, AsyncDbSession, dispose_engines
+from database_models.migrations import ensure_schema
+from database_models.archive import archived_messages
+from database_models.deletion import delete_user_cascade, delete_band_cascade
+from database_models.listing import LISTINGS, DEFAULT_PAGE_SIZE, InvalidCursor, keyset_page, stream_ndjson
+from database_models.search import (
+    DEFAULT_SEARCH_PAGE_SIZE, FullTextSearchUnavailable, match_expression, search_bands, search_users, search_messages
+)
 from database_models.models import (
     Base,
     User,
@@ -32,48 +46,100 @@ from database_models.models import (
     NotificationPriority
 )
 from auth.jwt_handler import sign_jwt, decode_jwt
+from auth.claims import role_claims, bump_roles_version, is_band_admin
 from auth.jwt_bearer import JwtBearer
+from auth.revocation import token_revocations
+from caching import location_snapshot
+from caching.entity_cache import entity_cache
+from caching.etags import version_etag, roster_etag, etag_matches, not_modified
 from sqlalchemy.orm import exc
 
+from maintenance.jobs import LOCATION_CACHE_MAX_AGE_SECONDS, add_maintenance_jobs
+from maintenance.scheduler import Scheduler
+from monitoring import sql_stats
+from monitoring.sql_stats import SqlStatsMiddleware, install_sql_instrumentation
+from monitoring.metrics import MetricsMiddleware, RateMeter, registry
+from monitoring import profiler
+from monitoring.profiler import LoopWatchdog, ProfilerMiddleware
+from geocoding.geocoder import google_geocode
 from notifications.notifications import Notification
-from security.password_security import hash_password, verify_password
+from onboarding import bulk_import
+from security.password_security import (
+    hash_password, hash_password_async, verify_password_async, bcrypt_pool_utilization
+)
 import random
 from fastapi.middleware.cors import CORSMiddleware
 from decouple import config
 
-GEOCODE_API_KEY = config("GEOCODE_API_KEY")
 # TODO make this work
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# every endpoint, create_app mounts it on a new app
+router = APIRouter()
 
 origins = [
     "http://localhost:8000",
     "http://localhost:3000"
 ]
-app.add_middleware(CORSMiddleware,
-                   allow_origins=origins,
-                   allow_credentials=True,
-                   allow_methods=["*"],
-                   allow_headers=["*"])
 
 ONE_DAY_IN_SECONDS = 60 * 60 * 24
 THIRTY_DAYS_IN_SECONDS = 30 * ONE_DAY_IN_SECONDS
+# ids per entity type accepted by /batch
+MAX_BATCH_IDS = 200
+# user ids plus emails accepted by /send_invites
+MAX_BULK_INVITES = 500
+# how stale another worker's token revocations may be
+REVOCATION_REFRESH_SECONDS = 30
+# event loop stalls longer than this are logged with the blocking stack
+LOOP_BLOCK_THRESHOLD_MS = config("LOOP_BLOCK_THRESHOLD_MS", default=100, cast=int)
 
 open_sockets = {}
-
-
-def location_to_coords(location: str, db):
-    # TODO Check with stored cache before going to google
-    dup = db.query(LocationCache).where(LocationCache.location == location.lower()).first()
+loop_watchdog = LoopWatchdog(LOOP_BLOCK_THRESHOLD_MS / 1000)
+
+messages_sent = registry.counter("messages_sent_total", "Chat messages stored")
+messages_per_second = RateMeter()
+geocode_lookups = registry.counter("geocode_lookups_total", "Location lookups by cache result", labels=("cache",))
+
+
+def geocode_cache_hit_ratio():
+    hits, misses = geocode_lookups.get("hit"), geocode_lookups.get("miss")
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+registry.gauge("websocket_connections", "Open chat websockets",
+               lambda: sum(len(sockets) for sockets in open_sockets.values()))
+registry.gauge("messages_per_second", "Chat messages stored per second over the last minute",
+               messages_per_second.rate)
+registry.gauge("geocode_cache_hit_ratio", "Share of location lookups served from location_cache",
+               geocode_cache_hit_ratio)
+registry.gauge("email_queue_depth", "Emails scheduled after a response and not sent yet",
+               lambda: emails.queued_emails)
+registry.gauge("notification_queue_depth", "Notifications staged and not committed yet",
+               lambda: Notification.queue_depth)
+registry.gauge("bcrypt_pool_utilization", "Busy share of the bcrypt worker threads", bcrypt_pool_utilization)
+registry.gauge("entity_cache_hit_ratio", "Share of user, band and roster lookups served from the entity cache",
+               entity_cache.hit_ratio)
+registry.gauge("event_loop_stalls", "Times the event loop was blocked past LOOP_BLOCK_THRESHOLD_MS",
+               lambda: loop_watchdog.stalls)
+
+
+async def location_to_coords(location: str, db):
+    # pre-forked workers share a snapshot of location_cache taken at startup, rows added since are in the table
+    if location_snapshot.active is not None:
+        cached = location_snapshot.active.get(location, LOCATION_CACHE_MAX_AGE_SECONDS)
+        if cached is not None:
+            geocode_lookups.inc("hit")
+            return {"lng": cached[0], "lat": cached[1]}
+    dup = (await db.execute(select(LocationCache).where(LocationCache.location == location.lower()))).scalars().first()
     if dup:
+        geocode_lookups.inc("hit")
         return {"lng": dup.lng, "lat": dup.lat}
 
-    geocode_api = googlemaps.Client(key=GEOCODE_API_KEY)
-    result = geocode_api.geocode(location)
-    coordinates = result[0]['geometry']['location']
-    if result:
-        db.add(LocationCache(lng=coordinates['lng'], lat=coordinates['lat'], location=location))
+    geocode_lookups.inc("miss")
+    # the google client is blocking
+    coordinates = await run_in_threadpool(google_geocode, location)
+    if coordinates:
+        db.add(LocationCache(lng=coordinates['lng'], lat=coordinates['lat'], location=location.lower()))
     return coordinates
 
 
@@ -88,8 +154,8 @@ def get_current_user(token: str = Depends(JwtBearer())):
         decoded = decode_jwt(token)
     except:
         return None
-    if decoded != {}:
-        return JwtUser(user_id=decoded['user_id'])
+    if decoded and not token_revocations.is_revoked(decoded):
+        return JwtUser(user_id=decoded['user_id'], roles=decoded.get('roles'))
     return None
 
 
@@ -104,59 +170,91 @@ def get_current_user_partially_protected(request: Request):
     token = has_auth_header()
     if token:
         decoded = decode_jwt(token)
-        if decoded == {}:
+        if not decoded or token_revocations.is_revoked(decoded):
             raise HTTPException(status_code=401, detail="Invalid token")
         return JwtUser(user_id=decoded['user_id'])
     else:
         return None
 
 
-@app.get("/")
+async def refresh_token_revocations():
+    async with AsyncDbSession() as db:
+        await token_revocations.refresh(db)
+
+
+async def refresh_token_revocations_job(db, deadline):
+    await token_revocations.refresh(db)
+
+
+def create_scheduler():
+    scheduler = Scheduler(AsyncDbSession)
+    # every worker keeps its own in-memory revocation list, so this one is not leader only
+    scheduler.add("refresh_token_revocations", REVOCATION_REFRESH_SECONDS, refresh_token_revocations_job,
+                  leader_only=False)
+    add_maintenance_jobs(scheduler, get_db_config().is_sqlite)
+    return scheduler
+
+
+@router.get("/")
 async def root():
     return {"message": "Hello World"}
 
 
-@app.get("/band/{id}")
-async def get_band(id: int, db: Session = Depends(get_database)):
+@router.get("/band/{id}", response_model=BandOut | None)
+async def get_band(id: int, response: Response, db: AsyncSession = Depends(get_database),
+                   if_none_match: str = Header(None)):
     try:
-        band = db.query(Band).where(Band.id == id).first()
+        band = await entity_cache.get_band(db, id)
     except exc.sa_exc.SQLAlchemyError:
         raise HTTPException(status_code=500, detail="Unable to get band")
-    return band
-
-
-@app.get("/bandmembers/{band_id}")
-async def get_band_members(band_id: int, db: Session = Depends(get_database)):
+    if band is None:
+        return band
+    etag = version_etag("band", band)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return project(BandOut, band)
+
+
+@router.get("/bandmembers/{band_id}", response_model=list[BandMemberOut])
+async def get_band_members(band_id: int, response: Response, db: AsyncSession = Depends(get_database),
+                           if_none_match: str = Header(None)):
     try:
-        members = db.query(User.id, User.first_name, User.last_name).where(User.id.in_(
-            db.query(BandMember.user_id).where(band_id == BandMember.band_id))).all()
+        roster = await entity_cache.get_roster(db, band_id)
+        users = await entity_cache.get_users(db, roster)
     except exc.sa_exc.SQLAlchemyError:
         raise HTTPException(status_code=500, detail="Unable get band members")
-    return members
+    etag = roster_etag(band_id, roster, users)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return [project(BandMemberOut, user) for _, user in sorted(users.items())]
 
 
-@app.post("/band")
+@router.post("/band")
 async def post_create_band(post_band_request: PostBandRequest, user: JwtUser = Depends(get_current_user),
-                           db: Session = Depends(get_database)):
+                           db: AsyncSession = Depends(get_database)):
     band = Band(
         name=post_band_request.name,
         location=post_band_request.location
     )
     try:
-        add_and_flush(db, band)
+        await add_and_flush(db, band)
         bm = BandMember(user_id=user.user_id, band_id=band.id, admin=True)
         db.add(bm)
-        db.commit()
+        await db.execute(bump_roles_version([user.user_id]))
+        await db.commit()
     except exc.sa_exc.SQLAlchemyError:
         raise HTTPException(status_code=500, detail="Unable to create band")
+    entity_cache.invalidate_user(user.user_id)
     return {"Success"}
 
 
-@app.get("/verify_band_code/{band_id}/{invite_code}")
-async def verify_band_code(band_id: int, invite_code: str, db: Session = Depends(get_database),
+@router.get("/verify_band_code/{band_id}/{invite_code}")
+async def verify_band_code(band_id: int, invite_code: str, db: AsyncSession = Depends(get_database),
                            user: JwtUser = Depends(get_current_user_partially_protected)):
-    band_invite = db.query(BandInvite).where(BandInvite.band_id == band_id). \
-        where(BandInvite.code == invite_code).first()
+    band_invite = (await db.execute(select(BandInvite).where(BandInvite.band_id == band_id).
+                                    where(BandInvite.code == invite_code))).scalars().first()
 
     if band_invite is None:
         raise HTTPException(status_code=404, detail="Invalid invite")
@@ -180,26 +278,27 @@ async def verify_band_code(band_id: int, invite_code: str, db: Session = Depends
             raise HTTPException(status_code=403, detail="Invalid invite")
 
 
-@app.get("/test/{location}", tags=['test'])
-async def geotest(location: str):
-    return location_to_coords(location)
+@router.get("/test/{location}", tags=['test'])
+async def geotest(location: str, db: AsyncSession = Depends(get_database)):
+    return await location_to_coords(location, db)
 
 
-@app.post("/register")
-async def register_user(user_request: PostUserRequest, db: Session = Depends(get_database)):
+@router.post("/register")
+async def register_user(user_request: PostUserRequest, background_tasks: BackgroundTasks,
+                        db: AsyncSession = Depends(get_database)):
     user_request.email = user_request.email.lower()
-    dup = db.query(User).where(User.email == user_request.email).first()
+    dup = (await db.execute(select(User).where(User.email == user_request.email))).scalars().first()
     if dup:
         raise HTTPException(status_code=400, detail="Email already exists")
     lng_lat = None
     if user_request.location is not None:
-        lng_lat = location_to_coords(user_request.location, db)
+        lng_lat = await location_to_coords(user_request.location, db)
 
     user = User(
         first_name=user_request.first_name,
         last_name=user_request.last_name,
         email=user_request.email,
-        password_hash=hash_password(user_request.password),
+        password_hash=await hash_password_async(user_request.password),
         location=user_request.location,
         longitude=lng_lat['lng'] if lng_lat else None,
         latitude=lng_lat['lat'] if lng_lat else None
@@ -207,88 +306,143 @@ async def register_user(user_request: PostUserRequest, db: Session = Depends(get
     )
 
     try:
-        add_and_flush(db, user)
+        await add_and_flush(db, user)
         try:
             code = generate_code()
             ev = EmailVerification(user_id=user.id, code=code)
-            add_and_flush(db, ev)
+            await add_and_flush(db, ev)
             try:
-                band_invites = db.query(BandInviteByEmail).where(BandInviteByEmail.email == user.email,
-                                                                 time.time() < BandInviteByEmail.expiration).all()
-                if band_invites:
-                    for invite in band_invites:
-                        db.add(BandMember(user_id=user.id, band_id=invite.band_id))
-                    db.delete(BandInviteByEmail).where(BandInviteByEmail.email == user.email)
+                invited_band_ids = await redeem_email_invites(db, user)
             except exc.sa_exc.SQLAlchemyError as err:
-                db.rollback()
+                await db.rollback()
                 raise HTTPException(status_code=500, detail="Inviting to band error")
         except exc.sa_exc.SQLAlchemyError as err:
-            db.rollback()
+            await db.rollback()
             raise HTTPException(status_code=500, detail="Could not create verification code entry")
     except exc.sa_exc.SQLAlchemyError as err:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Could not create user entry")
 
-    db.commit()
+    await db.commit()
+    for band_id in invited_band_ids:
+        entity_cache.invalidate_roster(band_id)
 
     # TODO get new app password for gmail
     mail = Email()
-    mail.send_invite_email(ev.code, user_request.email)
+    # SMTP runs after the response is sent
+    mail.schedule(background_tasks, mail.send_invite_email, ev.code, user_request.email)
 
     # TODO redirect to login page or return JWT
     # from starlette.responses import RedirectResponse
     # response = RedirectResponse(url='/login')
-    return sign_jwt(user)
+    return sign_jwt(user, await role_claims(db, user))
 
 
-def add_and_flush(db, row):
+async def redeem_email_invites(db, user):
+    """
+    Make a new user a member of every band that invited their email and has not expired, returns the band ids.
+
+    The unexpired invites are one range scan of the (email, expiration) index feeding an INSERT ... SELECT,
+    then one DELETE drops all of the email's invites, expired ones included.
+    """
+    unexpired = select(BandInviteByEmail.band_id, literal(user.id), false()).where(
+        BandInviteByEmail.email == user.email, BandInviteByEmail.expiration > time.time()).distinct()
+    redeemed = (await db.execute(insert(BandMember).from_select(
+        [BandMember.band_id, BandMember.user_id, BandMember.admin], unexpired))).rowcount
+    await db.execute(delete(BandInviteByEmail).where(BandInviteByEmail.email == user.email))
+    if not redeemed:
+        return []
+    return (await db.execute(select(BandMember.band_id).where(BandMember.user_id == user.id))).scalars().all()
+
+
+async def add_and_flush(db, row):
     db.add(row)
-    db.flush()
+    await db.flush()
 
 
-@app.get("/user/{id}")
-async def get_user(id: int, db: Session = Depends(get_database)):
+@router.get("/user/{id}", response_model=UserOut | None)
+async def get_user(id: int, response: Response, db: AsyncSession = Depends(get_database),
+                   if_none_match: str = Header(None)):
     try:
-        user = db.query(User).where(User.id == id).first()
+        user = await entity_cache.get_user(db, id)
     except exc.sa_exc.SQLAlchemyError as err:
         raise HTTPException(status_code=500, detail="Could not get user")
-    return user
-
-
-@app.delete("/user/")
-async def delete_user(db: Session = Depends(get_database),
+    if user is None:
+        return user
+    etag = version_etag("user", user)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return project(UserOut, user)
+
+
+@router.get("/batch", response_model=BatchOut)
+async def get_batch(user_ids: list[int] = Query([]), band_ids: list[int] = Query([]), rosters: bool = False,
+                    db: AsyncSession = Depends(get_database)):
+    """
+    Users and bands by id in one round trip, e.g. /batch?user_ids=1&user_ids=2&band_ids=7&rosters=true.
+
+    With rosters=true every requested band's roster is included and its members are added to users.
+    At most one query per entity type, cached entities cost none. Unknown ids are left out.
+    """
+    if len(user_ids) > MAX_BATCH_IDS or len(band_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail="At most %d ids per type" % MAX_BATCH_IDS)
+    user_ids = list(dict.fromkeys(user_ids))
+    band_ids = list(dict.fromkeys(band_ids))
+    try:
+        band_rosters = await entity_cache.get_rosters(db, band_ids) if rosters else {}
+        for roster in band_rosters.values():
+            user_ids.extend(user_id for user_id in roster if user_id not in user_ids)
+        users = await entity_cache.get_users(db, user_ids)
+        bands = await entity_cache.get_bands(db, band_ids)
+    except exc.sa_exc.SQLAlchemyError:
+        raise HTTPException(status_code=500, detail="Could not get batch")
+    return ORJSONResponse({
+        "users": [project(UserOut, users[user_id]) for user_id in user_ids if user_id in users],
+        "bands": [project(BandOut, bands[band_id]) for band_id in band_ids if band_id in bands],
+        "rosters": [{"band_id": band_id,
+                     "members": [{"user_id": user_id, "admin": bool(admin)} for user_id, admin in roster.items()]}
+                    for band_id, roster in band_rosters.items() if band_id in bands],
+    })
+
+
+@router.delete("/user/")
+async def delete_user(db: AsyncSession = Depends(get_database),
                       user: JwtUser = Depends(get_current_user)):
     try:
-        db.delete(BandInvite).where(BandInvite.user_id == user.user_id)
-        db.delete(DBNotification).where(DBNotification.recipient_user_id == user.user_id)
-        db.delete(BandMember).where(BandMember.user_id == user.user_id)
-        db.delete(LookingForBand).where(LookingForBand.user_id == user.user_id)
-        db.delete(User).where(User.id == user.user_id)
+        deleted = await delete_user_cascade(db, user.user_id)
     except exc.sa_exc.SQLAlchemyError:
-        db.rollback()
-        raise HTTPException(status_code=500, detail="Could not get user")
-    db.commit()
-    return {"Success"}
+        raise HTTPException(status_code=500, detail="Could not delete user")
+    entity_cache.invalidate_member(user.user_id)
+    return {"deleted": deleted}
 
 
-@app.put("/update_user")
-async def update_user(user_request: PostUserRequest, db: Session = Depends(get_database),
+@router.put("/update_user")
+async def update_user(user_request: PostUserRequest, db: AsyncSession = Depends(get_database),
                       user: JwtUser = Depends(get_current_user)):
     try:
-        dbuser = db.query(User).where(User.id == user.user_id).first()
+        dbuser = (await db.execute(select(User).where(User.id == user.user_id))).scalars().first()
         dbuser.first_name = user_request.first_name
         dbuser.last_name = user_request.last_name
         dbuser.email = user_request.email
-        if user_request.password:
-            dbuser.password_hash = hash_password(user_request.password)
+        password_changed = user_request.password and not await verify_password_async(user_request.password,
+                                                                                      dbuser.password_hash)
+        if password_changed:
+            dbuser.password_hash = await hash_password_async(user_request.password)
         if user_request.location and dbuser.location != user_request.location:
             dbuser.location = user_request.location
-            lng_lat = location_to_coords(user_request.location, db)
+            lng_lat = await location_to_coords(user_request.location, db)
             dbuser.longitude = lng_lat.lng
             dbuser.latitude = lng_lat.lat
-        db.commit()
+        dbuser.version = User.version + 1
+        await db.commit()
+        entity_cache.invalidate_user(user.user_id)
+        if password_changed:
+            # log out every session that was using the old password, the caller gets a fresh token
+            await token_revocations.revoke_user_tokens(db, user.user_id)
+            entity_cache.invalidate_user(user.user_id)
+            return sign_jwt(dbuser)
 
-        # TODO To revoke tokens, add date column to user for rejecting tokens given before x date
         # TODO update long/lat with new updated location
         # TODO if email changes set verified to false
         #  and send out new verification code + email
@@ -298,62 +452,88 @@ async def update_user(user_request: PostUserRequest, db: Session = Depends(get_d
     return {"Success"}
 
 
-@app.put("/update_band")
-async def update_band(band_request: PostBandRequest, db: Session = Depends(get_database),
+@router.post("/logout")
+async def logout(token: str = Depends(JwtBearer()), db: AsyncSession = Depends(get_database)):
+    try:
+        await token_revocations.revoke_token(db, decode_jwt(token))
+    except exc.sa_exc.SQLAlchemyError:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail="Could not log out")
+    return {"Success"}
+
+
+@router.post("/logout_all")
+async def logout_all(db: AsyncSession = Depends(get_database), user: JwtUser = Depends(get_current_user)):
+    try:
+        await token_revocations.revoke_user_tokens(db, user.user_id)
+    except exc.sa_exc.SQLAlchemyError:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail="Could not log out")
+    entity_cache.invalidate_user(user.user_id)
+    return {"Success"}
+
+
+@router.put("/update_band")
+async def update_band(band_request: PostBandRequest, db: AsyncSession = Depends(get_database),
                       user: JwtUser = Depends(get_current_user)):
     try:
-        bm = db.query(BandMember).where(BandMember.band_id == band_request.id).where(
-            BandMember.user_id == user.user_id).first()
-        if not bm.admin:
+        if not await is_band_admin(db, user, band_request.id):
             raise HTTPException(status_code=400, detail="Not and admin")
-        band = db.query(Band).where(Band.id == band_request.id).first()
+        band = (await db.execute(select(Band).where(Band.id == band_request.id))).scalars().first()
 
         band.name = band_request.name
+        band.version = Band.version + 1
 
         if band.location != band_request.location:
             band.location = band_request.location
-            lng_lat = location_to_coords(band.location, db)
+            lng_lat = await location_to_coords(band.location, db)
             band.longitude = lng_lat.lng
             band.latitude = lng_lat.lat
 
-        db.commit()
+        await db.commit()
     except exc.sa_exc.SQLAlchemyError as err:
         raise HTTPException(status_code=500, detail="Could not update band")
+    entity_cache.invalidate_band(band_request.id)
     return {"Success"}
 
 
-@app.delete("/delete_band")
-async def delete_band(band_request: PostBandRequest, db: Session = Depends(get_database),
-                      user: JwtUser = Depends(get_current_user)):
+@router.delete("/delete_band")
+async def delete_band(band_request: PostBandRequest, background_tasks: BackgroundTasks,
+                      db: AsyncSession = Depends(get_database), user: JwtUser = Depends(get_current_user)):
     try:
-        bm = db.query(BandMember).where(BandMember.band_id == band_request.id).where(
-            BandMember.user_id == user.user_id).first()
-        if not bm.admin:
+        if not await is_band_admin(db, user, band_request.id):
             raise HTTPException(status_code=400, detail="Not and admin")
-        band = db.query(Band).where(Band.id == band_request.id).first()
-        usr = db.query(User).where(User.id == user.user_id).first()
-        members = db.query(User).where(
-            User.id.in_(db.query(BandMember).where(BandMember.band_id == band_request.id)).all())
-        notify_band_members(members, band.name + " has been disbanded by " + usr.first_name + " " + usr.last_name, NotificationPriority.high, THIRTY_DAYS_IN_SECONDS)
-        db.delete(BandMember).where(
-            BandMember.user_id.in_(db.query(BandMember.user_id).where(BandMember.band_id == band_request.id)))
-        db.delete(LookingForMember).where(LookingForMember.band_id == band_request.id)
-        db.delete(band)
-        db.commit()
+        band = await entity_cache.get_band(db, band_request.id)
+        usr = await entity_cache.get_user(db, user.user_id)
+        members = list(await entity_cache.get_roster(db, band_request.id))
+        notice = band["name"] + " has been disbanded by " + usr["first_name"] + " " + usr["last_name"]
+        deleted, emails = await delete_band_cascade(db, band_request.id, notice, NotificationPriority.high,
+                                                    time.time() + THIRTY_DAYS_IN_SECONDS)
     except exc.sa_exc.SQLAlchemyError:
         raise HTTPException(status_code=500, detail="Could not delete band")
-    return {"Success"}
+    entity_cache.invalidate_band(band_request.id)
+    # the cascade bumped their roles_version
+    for member_id in members:
+        entity_cache.invalidate_user(member_id)
+    mail = Email()
+    for email in emails:
+        mail.schedule(background_tasks, mail.send_notification_email, email, "Disbanded", notice)
+    return {"deleted": deleted}
 
 
-@app.get("/verify/{code}")
-async def verify_user_email(code: str, db: Session = Depends(get_database)):
+@router.get("/verify/{code}")
+async def verify_user_email(code: str, db: AsyncSession = Depends(get_database)):
     try:
-        email_verification = db.query(EmailVerification).where(EmailVerification.code == code).first()
+        email_verification = (await db.execute(select(EmailVerification).where(
+            EmailVerification.code == code))).scalars().first()
         if email_verification:
-            user = db.query(User).where(User.id == email_verification.id).first()
+            user = (await db.execute(select(User).where(
+                User.id == email_verification.user_id))).scalars().first()
             user.email_verified = True
-            db.delete(email_verification)
-            db.commit()
+            user.version = User.version + 1
+            await db.delete(email_verification)
+            await db.commit()
+            entity_cache.invalidate_user(user.id)
         else:
             raise HTTPException(status_code=400, detail="Invalid verification code")
     except exc.sa_exc.SQLAlchemyError:
@@ -361,21 +541,25 @@ async def verify_user_email(code: str, db: Session = Depends(get_database)):
     return "Success"
 
 
-@app.post("/accept_invite")
-async def accept_invite(pai: PostAcceptInvite, db: Session = Depends(get_database),
+@router.post("/accept_invite")
+async def accept_invite(pai: PostAcceptInvite, db: AsyncSession = Depends(get_database),
                         user: JwtUser = Depends(get_current_user)):
     try:
-        invite = db.query(BandInvite).where(BandInvite.code == pai.code).where(
-            user.user_id == BandInvite.user_id).first()
+        invite = (await db.execute(select(BandInvite).where(BandInvite.code == pai.code).where(
+            user.user_id == BandInvite.user_id))).scalars().first()
         if invite:
-            band = db.query(Band).where(Band.id == invite.band_id).first()
-            username = db.query(User.first_name, User.last_name).where(User.id == user.user_id).first()
-            notify_band_admins(db, invite.band_id, "Accepted",
-                               username.first_name + " " + username.last_name + " has joined " + band.name + "!")
+            band = (await db.execute(select(Band).where(Band.id == invite.band_id))).scalars().first()
+            username = (await db.execute(select(User.first_name, User.last_name).where(
+                User.id == user.user_id))).first()
+            await notify_band_admins(db, invite.band_id, "Accepted",
+                                     username.first_name + " " + username.last_name + " has joined " + band.name + "!")
             bm = BandMember(band_id=invite.band_id, user_id=user.user_id, admin=False)
             db.add(bm)
-            db.delete(invite)
-            db.commit()
+            await db.delete(invite)
+            await db.execute(bump_roles_version([user.user_id]))
+            await db.commit()
+            entity_cache.invalidate_roster(invite.band_id)
+            entity_cache.invalidate_user(user.user_id)
         else:
             raise HTTPException(status_code=400, detail="Invalid invite")
     except exc.sa_exc.SQLAlchemyError:
@@ -383,20 +567,21 @@ async def accept_invite(pai: PostAcceptInvite, db: Session = Depends(get_databas
     pass
 
 
-@app.post("/decline_invite")
-async def decline_invite(pai: PostAcceptInvite, db: Session = Depends(get_database),
+@router.post("/decline_invite")
+async def decline_invite(pai: PostAcceptInvite, db: AsyncSession = Depends(get_database),
                          user: JwtUser = Depends(get_current_user)):
     try:
-        invite = db.query(BandInvite).where(BandInvite.code == pai.code).where(
-            user.user_id == BandInvite.user_id).first()
+        invite = (await db.execute(select(BandInvite).where(BandInvite.code == pai.code).where(
+            user.user_id == BandInvite.user_id))).scalars().first()
         if invite:
-            db.delete(invite)
-            db.commit()
-
-            band = db.query(Band).where(Band.id == invite.band_id).first()
-            username = db.query(User.first_name, User.last_name).where(User.id == user.user_id).first()
-            notify_band_admins(db, invite.band_id, "Declined",
-                               username.first_name + " " + username.last_name + " has declined your invite to join " + band.name + ".")
+            await db.delete(invite)
+            await db.commit()
+
+            band = (await db.execute(select(Band).where(Band.id == invite.band_id))).scalars().first()
+            username = (await db.execute(select(User.first_name, User.last_name).where(
+                User.id == user.user_id))).first()
+            await notify_band_admins(db, invite.band_id, "Declined",
+                                     username.first_name + " " + username.last_name + " has declined your invite to join " + band.name + ".")
         else:
             raise HTTPException(status_code=400, detail="Invalid invite")
     except exc.sa_exc.SQLAlchemyError:
@@ -404,67 +589,148 @@ async def decline_invite(pai: PostAcceptInvite, db: Session = Depends(get_databa
     pass
 
 
-def notify_band_admins(db, band_id, subject, body, priority=NotificationPriority.normal, expiry=THIRTY_DAYS_IN_SECONDS):
-    admins = db.query(User).where(User.id.in_(
-        db.query(BandMember.user_id).where(BandMember.band_id == band_id, BandMember.admin == True))).all()
-    notify_users(admins, subject, body, priority, expiry)
+async def notify_band_admins(db, band_id, subject, body, priority=NotificationPriority.normal,
+                             expiry=THIRTY_DAYS_IN_SECONDS):
+    admins = (await db.execute(select(User).where(User.id.in_(
+        select(BandMember.user_id).where(BandMember.band_id == band_id, BandMember.admin == True))))).scalars().all()
+    await notify_users(db, admins, subject, body, priority, expiry)
 
 
-def notify_band_members(db, band_id, subject, body, priority=NotificationPriority.normal,
-                        expiry=THIRTY_DAYS_IN_SECONDS):
-    members = db.query(User).where(User.id.in_(
-        db.query(BandMember.user_id).where(BandMember.band_id == band_id))).all()
-    notify_users(members, subject, body, priority, expiry)
+async def notify_band_members(db, band_id, subject, body, priority=NotificationPriority.normal,
+                              expiry=THIRTY_DAYS_IN_SECONDS):
+    members = (await db.execute(select(User).where(User.id.in_(
+        select(BandMember.user_id).where(BandMember.band_id == band_id))))).scalars().all()
+    await notify_users(db, members, subject, body, priority, expiry)
 
 
-def notify_users(users, subject, msg, priority=NotificationPriority.normal, expiration=ONE_DAY_IN_SECONDS * 7):
-    notification = Notification()
+async def notify_users(db, users, subject, msg, priority=NotificationPriority.normal,
+                       expiration=ONE_DAY_IN_SECONDS * 7):
     email = Email()
     for user in users:
-        if user.email_notification_opt_in:
-            email.send_notification_email(user.id, subject, msg)
-        notification.send(user.id, msg, time.time() + expiration, priority)
+        if user.email_notifications_opt_in:
+            await email.send_notification_email(user.email, subject, msg)
+    # one commit for the whole fan-out
+    await Notification(db).send_many([user.id for user in users], msg, time.time() + expiration, priority)
 
 
-@app.post("/send_invite")
-async def send_invite(psi: PostSendInvite, db: Session = Depends(get_database),
-                      user: JwtUser = Depends(get_current_user())):
+@router.post("/send_invite")
+async def send_invite(psi: PostSendInvite, db: AsyncSession = Depends(get_database),
+                      user: JwtUser = Depends(get_current_user)):
     try:
-        band_member = db.query(BandMember).where(BandMember.user_id == user.user_id). \
-            where(BandMember.band_id == psi.band_id).first()
-        if not band_member.admin:
+        if not await is_band_admin(db, user, psi.band_id):
             raise HTTPException(status_code=400, detail="Not admin")
-        is_current_band_member = db.query(BandMember).where(BandMember.band_id == psi.band_id). \
-            where(BandMember.user_id == psi.user_id).first()
-        if is_current_band_member:
+        if await entity_cache.is_member(db, psi.band_id, psi.user_id):
             raise HTTPException(status_code=400, detail="Already a member")
 
-        invite = BandInvite(band_id=psi.band_id, user_id=psi.user_id, code=generate_code())
+        invite = BandInvite(band_id=psi.band_id, user_id=psi.user_id, code=generate_code(),
+                            expiration=time.time() + THIRTY_DAYS_IN_SECONDS)
         db.add(invite)
-        db.commit()
+        await db.commit()
     except exc.sa_exc.SQLAlchemyError:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Some database error")
 
 
-@app.post("/login")
-async def user_login(gul: GetUserLogin, db: Session = Depends(get_database)):
-    user = db.query(User).where(User.email == gul.email).first()
-    if user and verify_password(gul.password, user.password_hash):
-        return sign_jwt(user)
+@router.post("/send_invites")
+async def send_invites(psi: PostSendInvites, background_tasks: BackgroundTasks,
+                       db: AsyncSession = Depends(get_database), user: JwtUser = Depends(get_current_user)):
+    """
+    Invite many users and email addresses to a band at once. Members and people with a pending invite
+    are skipped, invited users get a notification and the email invites go out over one SMTP session.
+    """
+    user_ids = list(dict.fromkeys(psi.user_ids))
+    addresses = list(dict.fromkeys(psi.emails))
+    if len(user_ids) + len(addresses) > MAX_BULK_INVITES:
+        raise HTTPException(status_code=400, detail="At most %d invites per request" % MAX_BULK_INVITES)
+    try:
+        if not await is_band_admin(db, user, psi.band_id):
+            raise HTTPException(status_code=400, detail="Not admin")
+        band = await entity_cache.get_band(db, psi.band_id)
+        roster = await entity_cache.get_roster(db, psi.band_id)
+        now = time.time()
+
+        invitees = {}
+        if user_ids or addresses:
+            invitees = {row.id: row for row in (await db.execute(
+                select(User.id, User.email, User.email_notifications_opt_in).where(
+                    or_(User.id.in_(user_ids), User.email.in_(addresses))))).all()}
+        registered = {row.email for row in invitees.values()}
+        pending_users = set((await db.execute(select(BandInvite.user_id).where(
+            BandInvite.band_id == psi.band_id, BandInvite.user_id.in_(list(invitees)),
+            BandInvite.expiration > now))).scalars())
+        pending_emails = set((await db.execute(select(BandInviteByEmail.email).where(
+            BandInviteByEmail.band_id == psi.band_id, BandInviteByEmail.email.in_(addresses),
+            BandInviteByEmail.expiration > now))).scalars())
+
+        invited_users = [row for user_id, row in invitees.items()
+                         if user_id not in roster and user_id not in pending_users]
+        invited_emails = [address for address in addresses
+                          if address not in registered and address not in pending_emails]
+        expiration = now + THIRTY_DAYS_IN_SECONDS
+        if invited_users:
+            await db.execute(insert(BandInvite), [
+                {"band_id": psi.band_id, "user_id": row.id, "code": generate_code(), "expiration": expiration}
+                for row in invited_users])
+        if invited_emails:
+            await db.execute(insert(BandInviteByEmail), [
+                {"band_id": psi.band_id, "email": address, "expiration": expiration} for address in invited_emails])
+        notification = Notification(db)
+        for row in invited_users:
+            notification.add(row.id, "You have been invited to join " + band["name"] + "!", expiration)
+        # invites and notifications in one commit
+        await notification.commit()
+    except exc.sa_exc.SQLAlchemyError:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail="Some database error")
+
+    messages = [(row.email, "Band invite", "You have been invited to join " + band["name"] + "!")
+                for row in invited_users if row.email_notifications_opt_in]
+    # TODO Change localhost to configured domain url
+    messages += [(address, "Band invite", "You have been invited to join " + band["name"] +
+                  ". Sign up with this email address at localhost:8000/register to accept.")
+                 for address in invited_emails]
+    if messages:
+        mail = Email()
+        mail.schedule(background_tasks, mail.send_emails_async, messages)
+    return {
+        "invited_user_ids": [row.id for row in invited_users],
+        "invited_emails": invited_emails,
+        "already_members": [user_id for user_id in invitees if user_id in roster],
+        "already_invited": sorted(pending_users - set(roster)) + sorted(pending_emails),
+        "unknown_user_ids": [user_id for user_id in user_ids if user_id not in invitees],
+    }
+
+
+@router.post("/login")
+async def user_login(gul: GetUserLogin, db: AsyncSession = Depends(get_database)):
+    user = (await db.execute(select(User).where(User.email == gul.email))).scalars().first()
+    if user and await verify_password_async(gul.password, user.password_hash):
+        return sign_jwt(user, await role_claims(db, user))
     raise HTTPException(status_code=400, detail="Email/Password does not exist")
 
 
-@app.put("/read_notification/{id}")
-async def read_notification(id: int, db: Session = Depends(get_database), user: JwtUser = Depends(get_current_user)):
-    notif: DBNotification = db.query(DBNotification).where(DBNotification.id == id,
-                                                           DBNotification.recipient_user_id == user.user_id).first()
+@router.post("/refresh_token")
+async def refresh_token(db: AsyncSession = Depends(get_database), user: JwtUser = Depends(get_current_user)):
+    """A new token with current band role claims, for after joining or creating a band"""
+    if user is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    row = (await db.execute(select(User).where(User.id == user.user_id))).scalars().first()
+    if row is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return sign_jwt(row, await role_claims(db, row))
+
+
+@router.put("/read_notification/{id}")
+async def read_notification(id: int, db: AsyncSession = Depends(get_database),
+                            user: JwtUser = Depends(get_current_user)):
+    notif: DBNotification = (await db.execute(select(DBNotification).where(
+        DBNotification.id == id, DBNotification.recipient_user_id == user.user_id))).scalars().first()
     if notif is None:
         raise HTTPException(status_code=404, detail="DBNotification does not exist")
     if notif.recipient_user_id != user.user_id:
         raise HTTPException(status_code=401, detail="That is not your message, but you already know this")
     notif.read = True
-    db.commit()
+    await db.commit()
     return {"Success"}
 
 
@@ -474,35 +740,74 @@ def get_range_coordinates(lat, lng, range):
     return (lat - lat_offset, lat + lat_offset), (lng - lng_offset, lng + lng_offset)
 
 
-@app.get("/search")
-async def search(location: str, type: str, distance: int, roles, db: Session = Depends(get_database)):
-    loc = location_to_coords(location, db)
+# List endpoints select only the response model's columns and return an ORJSONResponse, which skips
+# FastAPI's per row validation and jsonable_encoder, response_model documents the shape
+@router.get("/search", response_model=list[BandOut] | list[UserOut])
+async def search(location: str, type: str, distance: int, roles, db: AsyncSession = Depends(get_database)):
+    loc = await location_to_coords(location, db)
     coord_range = get_range_coordinates(loc['lat'], loc['lng'], distance)
     arr_roles = roles.split(",")
     lat_range = coord_range[0]
     lng_range = coord_range[1]
     if type == "Band":
-        res = db.query(Band).where(
-            Band.id.in_(db.query(LookingForMember.band_id).where(LookingForMember.talent.in_(arr_roles)))). \
+        res = rows_as_dicts(await db.execute(select(*projection(BandOut, Band)).where(
+            Band.id.in_(select(LookingForMember.band_id).where(LookingForMember.talent.in_(arr_roles)))).
             where(lat_range[0] < Band.latitude, Band.latitude < lat_range[1],
-                  lng_range[0] < Band.longitude, Band.longitude < lng_range[1]).all()
+                  lng_range[0] < Band.longitude, Band.longitude < lng_range[1])))
     elif type == "Member":
-        res = db.query(User).where(
-            User.id.in_(db.query(LookingForBand.band_id).where(LookingForBand.talent.in_(arr_roles)))). \
+        res = rows_as_dicts(await db.execute(select(*projection(UserOut, User)).where(
+            User.id.in_(select(LookingForBand.user_id).where(LookingForBand.talent.in_(arr_roles)))).
             where(lat_range[0] < User.latitude, User.latitude < lat_range[1],
-                  lng_range[0] < User.longitude, User.longitude < lng_range[1]).all()
+                  lng_range[0] < User.longitude, User.longitude < lng_range[1])))
     else:
         raise HTTPException(status_code=400, detail="Bruh, that's not a priority")
-    return res
+    return ORJSONResponse(res)
+
+
+@router.get("/search/bands", response_model=SearchPage[BandOut])
+async def search_bands_by_name(q: str, after: int = 0, limit: int = DEFAULT_SEARCH_PAGE_SIZE,
+                               db: AsyncSession = Depends(get_database)):
+    """Bands by name, every word matches as a prefix, best match first"""
+    check_search(q, limit)
+    return await search_page(search_bands(db, q, after, limit))
+
+
+@router.get("/search/users", response_model=SearchPage[UserOut])
+async def search_users_by_name(q: str, after: int = 0, limit: int = DEFAULT_SEARCH_PAGE_SIZE,
+                               db: AsyncSession = Depends(get_database)):
+    """Users by first and last name, every word matches as a prefix, best match first"""
+    check_search(q, limit)
+    return await search_page(search_users(db, q, after, limit))
+
+
+@router.get("/search/messages", response_model=SearchPage[MessageOut])
+async def search_own_messages(q: str, with_user_id: int = None, after: int = None,
+                              limit: int = DEFAULT_SEARCH_PAGE_SIZE, db: AsyncSession = Depends(get_database),
+                              user: JwtUser = Depends(get_current_user)):
+    """The caller's chat history, optionally with one user, newest first"""
+    check_search(q, limit)
+    return await search_page(search_messages(db, user.user_id, q, with_user_id, after, limit))
+
+
+def check_search(q, limit):
+    if match_expression(q) is None or limit < 1:
+        raise HTTPException(status_code=400, detail="Search needs a word and a positive limit")
+
+
+async def search_page(search):
+    try:
+        return ORJSONResponse(await search)
+    except FullTextSearchUnavailable:
+        raise HTTPException(status_code=501, detail="Full text search needs SQLite FTS5")
 
 
-@app.get("/user_online/{id}")
+@router.get("/user_online/{id}")
 async def user_online(id: int):
     user = open_sockets.get(id)
     return user is not None
 
 
-async def send_message(sender_user_id: int, message: Message, db: Session):
+async def send_message(sender_user_id: int, message: Message, db: AsyncSession):
     # get recipient_user_id
     recipient_user_id = message.recipient_user_id
     # get message text
@@ -512,7 +817,11 @@ async def send_message(sender_user_id: int, message: Message, db: Session):
     if recipient_ws:
         db_msg.read = True
     db.add(db_msg)
-    db.commit()
+    await db.commit()
+    # server side defaults are not loaded after commit without an await
+    await db.refresh(db_msg)
+    messages_sent.inc()
+    messages_per_second.mark()
 
     # notify all open websockets of recipient and sender of new message
     sender_ws = open_sockets.get(sender_user_id)
@@ -529,10 +838,10 @@ async def send_message(sender_user_id: int, message: Message, db: Session):
             for broken_link in broken_links:
                 recipient_ws.remove(broken_link)
     else:
-        notif = Notification()
-        user = db.query(User).where(User.id == sender_user_id).first()
-        notif.send(recipient_user_id, "You have a new message from " + user.first_name + " " + user.last_name,
-                   time.time() + ONE_DAY_IN_SECONDS * 7, NotificationPriority.normal)
+        notif = Notification(db)
+        user = (await db.execute(select(User).where(User.id == sender_user_id))).scalars().first()
+        await notif.send(recipient_user_id, "You have a new message from " + user.first_name + " " + user.last_name,
+                         time.time() + ONE_DAY_IN_SECONDS * 7, NotificationPriority.normal)
     if sender_ws:
         broken_links = []
         for socket in sender_ws:
@@ -547,19 +856,32 @@ async def send_message(sender_user_id: int, message: Message, db: Session):
                 sender_ws.remove(broken_link)
 
 
-@app.get("/messages/{target_user_id}")
-async def get_messages(target_user_id: int, db: Session = Depends(get_database),
-                       user: JwtUser = Depends(get_current_user)):
-    messages = db.query(DBMessage).where(or_(and_(DBMessage.recipient_user_id == user.user_id,
-                                                  DBMessage.sender_user_id == target_user_id),
-                                             and_(DBMessage.sender_user_id == user.user_id,
-                                                  DBMessage.recipient_user_id == target_user_id))) \
-        .order_by(DBMessage.sent.asc()).all()
-    return messages
-
-
-@app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_database)):
+@router.get("/messages/{target_user_id}", response_model=list[MessageOut])
+async def get_messages(target_user_id: int, before: int = None, limit: int = None,
+                       db: AsyncSession = Depends(get_database), user: JwtUser = Depends(get_current_user)):
+    """
+    The conversation oldest first, or with limit its newest `limit` messages with an id below before. Pass the
+    first id of a page as before to page back, past the retention age the page continues from the archive.
+    """
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    statement = select(*projection(MessageOut, DBMessage)).where(
+        or_(and_(DBMessage.recipient_user_id == user.user_id, DBMessage.sender_user_id == target_user_id),
+            and_(DBMessage.sender_user_id == user.user_id, DBMessage.recipient_user_id == target_user_id))
+    ).order_by(DBMessage.id.desc()).limit(limit)
+    if before is not None:
+        statement = statement.where(DBMessage.id < before)
+    messages = rows_as_dicts(await db.execute(statement))[::-1]
+    # every archived message is older than every hot one, so the archive is only read past the hot rows
+    if limit is None or len(messages) < limit:
+        messages = await archived_messages(db, user.user_id, target_user_id,
+                                           before=messages[0]["id"] if messages else before,
+                                           limit=None if limit is None else limit - len(messages)) + messages
+    return ORJSONResponse(messages)
+
+
+@router.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     jwt = await websocket.receive_text()
     user = get_current_user(jwt)
@@ -577,8 +899,10 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_dat
     while True:
         try:
             message: Message = json.loads(await websocket.receive_text(), object_hook=lambda d: SimpleNamespace(**d))
-            await send_message(user_id, Message(recipient_user_id=message.recipient_user_id, message=message.message),
-                               db)
+            # a session per message, an idle socket must not hold a pooled connection
+            async with AsyncDbSession() as db:
+                await send_message(user_id, Message(recipient_user_id=message.recipient_user_id,
+                                                    message=message.message), db)
         except WebSocketDisconnect:
             try:
                 user_sockets.remove(websocket)
@@ -588,51 +912,151 @@ async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_dat
             break
 
 
+@router.get("/metrics", tags=['test'])
+async def get_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.post("/debug/profile", tags=['test'])
+async def start_profile(seconds: float = 10, x_profile_token: str = Header(None)):
+    if not profiler.authorized(x_profile_token):
+        raise HTTPException(status_code=403, detail="Profiling is not enabled")
+    profile = profiler.profile_window(seconds)
+    return {"profile_id": profile.id}
+
+
+@router.get("/debug/profile/{profile_id}", tags=['test'])
+async def get_profile(profile_id: str, x_profile_token: str = Header(None)):
+    if not profiler.authorized(x_profile_token):
+        raise HTTPException(status_code=403, detail="Profiling is not enabled")
+    profile = profiler.profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Unknown profile")
+    # collapsed stacks, pipe into flamegraph.pl or load in speedscope
+    return PlainTextResponse(profile.collapsed())
+
+
+@router.get("/debug/sql_stats", tags=['test'])
+async def get_sql_stats():
+    return sql_stats.snapshot()
+
+
 # =====TESTING =====
-@app.get("/users", tags=['test'])
-async def print_users(db: Session = Depends(get_database)):
-    results = db.query(User).all()
-    return results
+@router.get("/users", tags=['test'])
+async def print_users(after: str = None, limit: int = DEFAULT_PAGE_SIZE,
+                      db: AsyncSession = Depends(get_database)):
+    return await listing_page(db, "users", after, limit)
+
+
+@router.get("/bands", tags=['test'])
+async def print_bands(after: str = None, limit: int = DEFAULT_PAGE_SIZE,
+                      db: AsyncSession = Depends(get_database)):
+    return await listing_page(db, "bands", after, limit)
+
+
+@router.get("/band_members", tags=['test'])
+async def print_band_members(after: str = None, limit: int = DEFAULT_PAGE_SIZE,
+                             db: AsyncSession = Depends(get_database)):
+    return await listing_page(db, "band_members", after, limit)
 
 
-@app.get("/bands", tags=['test'])
-async def print_bands(db: Session = Depends(get_database)):
-    results = db.query(Band).all()
-    return results
+@router.get("/verifications", tags=['test'])
+async def print_verifications(after: str = None, limit: int = DEFAULT_PAGE_SIZE,
+                              db: AsyncSession = Depends(get_database)):
+    return await listing_page(db, "verifications", after, limit)
 
 
-@app.get("/band_members", tags=['test'])
-async def print_band_members(db: Session = Depends(get_database)):
-    results = db.query(BandMember).all()
-    return results
+@router.get("/lfms", tags=['test'])
+async def print_looking_for_members(after: str = None, limit: int = DEFAULT_PAGE_SIZE,
+                                    db: AsyncSession = Depends(get_database)):
+    return await listing_page(db, "lfms", after, limit)
 
 
-@app.get("/verifications", tags=['test'])
-async def print_verifications(db: Session = Depends(get_database)):
-    results = db.query(EmailVerification).all()
-    return results
+@router.get("/lfbs", tags=['test'])
+async def print_looking_for_bands(after: str = None, limit: int = DEFAULT_PAGE_SIZE,
+                                  db: AsyncSession = Depends(get_database)):
+    return await listing_page(db, "lfbs", after, limit)
 
 
-@app.get("/lfms", tags=['test'])
-async def print_looking_for_members(db: Session = Depends(get_database)):
-    results = db.query(LookingForMember).all()
-    return results
+@router.get("/bibe", tags=['test'])
+async def print_band_invite_by_email(after: str = None, limit: int = DEFAULT_PAGE_SIZE,
+                                     db: AsyncSession = Depends(get_database)):
+    return await listing_page(db, "bibe", after, limit)
+
+
+async def listing_page(db, name, after, limit):
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    try:
+        return ORJSONResponse(await keyset_page(db, name, after, limit))
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.get("/export/{name}", tags=['test'])
+async def export_listing(name: str, db: AsyncSession = Depends(get_database)):
+    """A whole listing (users, bands, band_members, ...) as NDJSON, streamed in chunks"""
+    if name not in LISTINGS:
+        raise HTTPException(status_code=404, detail="Unknown listing")
+    return StreamingResponse(stream_ndjson(db, name), media_type="application/x-ndjson")
+
+
+@router.post("/import")
+async def post_import(request: Request, x_import_token: str = Header(None),
+                      db: AsyncSession = Depends(get_database)):
+    """Users and bands from an NDJSON or CSV (Content-Type: text/csv) body, see onboarding.bulk_import"""
+    if not bulk_import.authorized(x_import_token):
+        raise HTTPException(status_code=403, detail="Bulk import is not enabled")
+    fmt = "csv" if request.headers.get("content-type", "").startswith("text/csv") else "ndjson"
+    return await bulk_import.import_records(db, (await request.body()).decode("utf-8"), fmt)
+
+
+def create_app():
+    """
+    The app with its middleware and routes. The startup hook checks the schema and starts the scheduler and
+    the loop watchdog, the shutdown hook stops them and disposes the engines.
+
+    Building an app opens nothing: the engines, the geocoding client and the JWT and email settings are created
+    or read on first use, so importing main costs no connections and needs no environment.
+    """
+    app = FastAPI(default_response_class=ORJSONResponse)
+    app.add_middleware(CORSMiddleware,
+                       allow_origins=origins,
+                       allow_credentials=True,
+                       allow_methods=["*"],
+                       allow_headers=["*"])
+    install_sql_instrumentation()
+    app.add_middleware(SqlStatsMiddleware)
+    app.add_middleware(MetricsMiddleware)
+    app.add_middleware(ProfilerMiddleware)
+    app.include_router(router)
+    scheduler = app.state.scheduler = create_scheduler()
+
+    @app.on_event("startup")
+    async def start_resources():
+        try:
+            await run_in_threadpool(ensure_schema, get_engine())
+            await refresh_token_revocations()
+        except exc.sa_exc.SQLAlchemyError:
+            # serve anyway, the periodic refresh retries
+            logger.exception("Could not load token revocations")
+        scheduler.start()
+        await loop_watchdog.start()
 
+    @app.on_event("shutdown")
+    async def stop_resources():
+        await scheduler.stop()
+        await loop_watchdog.stop()
+        await dispose_engines()
 
-@app.get("/lfbs", tags=['test'])
-async def print_looking_for_bands(db: Session = Depends(get_database)):
-    results = db.query(LookingForBand).all()
-    return results
+    return app
 
 
-@app.get("/bibe", tags=['test'])
-async def print_band_invite_by_email(db: Session = Depends(get_database)):
-    results = db.query(BandInviteByEmail).all()
-    return results
+app = create_app()
 
 
 def populate_db():
-    db = next(get_database())
+    db = DbSession()
     user1 = User(
         first_name="Jason",
         last_name="Bourne",
@@ -673,7 +1097,12 @@ def populate_db():
 
 
 if __name__ == "__main__":
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
-    populate_db()
+    # only the dev server needs uvicorn in this process, `uvicorn main:app` imports it itself
+    import uvicorn
+
+    ensure_schema(get_engine())
+    with DbSession() as session:
+        is_empty = session.query(User.id).first() is None
+    if is_empty:
+        populate_db()
     uvicorn.run(app, host="localhost", port=8000)
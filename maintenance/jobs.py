@@ -0,0 +1,85 @@
+import time
+
+from decouple import config
+from sqlalchemy import select, delete
+
+from database_models.archive import MESSAGE_RETENTION_DAYS, archive_old_messages
+from database_models.models import (
+    BandInvite, BandInviteByEmail, EmailVerification, DBNotification, LocationCache, RevokedToken
+)
+
+PURGE_INTERVAL_SECONDS = config("SCHEDULER_PURGE_INTERVAL_SECONDS", default=3600, cast=int)
+ANALYZE_INTERVAL_SECONDS = config("SCHEDULER_ANALYZE_INTERVAL_SECONDS", default=24 * 3600, cast=int)
+# VACUUM rewrites the whole SQLite file and blocks writers while it runs, 0 turns it off
+VACUUM_INTERVAL_SECONDS = config("SCHEDULER_VACUUM_INTERVAL_SECONDS", default=7 * 24 * 3600, cast=int)
+# the geocoding terms allow caching coordinates for 30 days
+LOCATION_CACHE_MAX_AGE_SECONDS = 30 * 24 * 3600
+# rows per DELETE, each batch is its own short transaction so requests can write in between
+PURGE_BATCH_SIZE = 1000
+
+# job name -> (model, timestamp column, seconds before now that rows expire)
+EXPIRY_PURGES = {
+    "purge_band_invites": (BandInvite, BandInvite.expiration, 0),
+    "purge_email_invites": (BandInviteByEmail, BandInviteByEmail.expiration, 0),
+    "purge_email_verifications": (EmailVerification, EmailVerification.expiration, 0),
+    "purge_notifications": (DBNotification, DBNotification.expiration, 0),
+    "purge_revoked_tokens": (RevokedToken, RevokedToken.expiration, 0),
+    "purge_location_cache": (LocationCache, LocationCache.cached_at, LOCATION_CACHE_MAX_AGE_SECONDS),
+}
+
+
+async def purge_older_than(db, model, column, cutoff, deadline, batch_size=PURGE_BATCH_SIZE):
+    """
+    Delete rows whose column is below cutoff, about batch_size rows per transaction, until none are left
+    or the monotonic deadline has passed. Returns the rows deleted.
+
+    Each batch ends at the batch_size-th oldest expired value, found on the column's index, so it works
+    the same for tables with composite or nullable primary keys.
+    """
+    deleted = 0
+    while True:
+        bound = (await db.execute(select(column).where(column < cutoff).order_by(column)
+                                  .offset(batch_size - 1).limit(1))).scalar()
+        batch = delete(model).where(column < cutoff)
+        if bound is not None:
+            batch = batch.where(column <= bound)
+        deleted += (await db.execute(batch)).rowcount
+        await db.commit()
+        if bound is None or time.monotonic() >= deadline:
+            return deleted
+
+
+def expiry_purge(model, column, max_age):
+    async def purge(db, deadline):
+        return await purge_older_than(db, model, column, time.time() - max_age, deadline)
+    return purge
+
+
+async def analyze(db, deadline):
+    """Refresh the query planner's statistics"""
+    conn = await db.connection()
+    if conn.dialect.name == "sqlite":
+        # only analyzes tables whose statistics are missing or out of date
+        await conn.exec_driver_sql("PRAGMA optimize")
+    elif conn.dialect.name == "postgresql":
+        await conn.exec_driver_sql("ANALYZE")
+    await db.commit()
+
+
+async def vacuum(db, deadline):
+    """Give the pages freed by the purges back to the file system, SQLite only"""
+    await db.commit()
+    conn = await db.connection(execution_options={"isolation_level": "AUTOCOMMIT"})
+    if conn.dialect.name == "sqlite":
+        await conn.exec_driver_sql("VACUUM")
+        await conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def add_maintenance_jobs(scheduler, is_sqlite):
+    for name, (model, column, max_age) in EXPIRY_PURGES.items():
+        scheduler.add(name, PURGE_INTERVAL_SECONDS, expiry_purge(model, column, max_age))
+    if MESSAGE_RETENTION_DAYS:
+        scheduler.add("archive_messages", PURGE_INTERVAL_SECONDS, archive_old_messages)
+    scheduler.add("analyze", ANALYZE_INTERVAL_SECONDS, analyze)
+    if is_sqlite and VACUUM_INTERVAL_SECONDS:
+        scheduler.add("vacuum", VACUUM_INTERVAL_SECONDS, vacuum)
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+
+from sqlalchemy import update, insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from database_models.models import JobLock
+from monitoring.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# first runs are spread over this many seconds so workers started together do not all race for the locks
+STARTUP_JITTER_SECONDS = 30
+
+job_runs = registry.counter("scheduler_job_runs_total", "Scheduled job runs by result (ok, error, not_leader)",
+                            labels=("job", "result"))
+job_duration = registry.histogram("scheduler_job_duration_seconds", "Run time of scheduled jobs", labels=("job",))
+job_rows = registry.counter("scheduler_job_rows_total", "Rows deleted or refreshed by scheduled jobs",
+                            labels=("job",))
+
+
+class Job:
+    def __init__(self, name, interval, function, leader_only=True, time_budget=10):
+        self.name = name
+        self.interval = interval
+        # async function(db, deadline) returning the number of rows it touched or None
+        self.function = function
+        # leader_only jobs run on one worker per interval, others (cache refreshes) on every worker
+        self.leader_only = leader_only
+        # monotonic seconds a run may take, batched jobs stop between batches once it is spent
+        self.time_budget = time_budget
+        self.last_run = None
+
+
+class Scheduler:
+    """
+    Runs jobs every `interval` seconds on the event loop, started and stopped with the app.
+
+    A leader_only job first takes a lease in job_lock that lasts one interval. Whichever worker gets it runs
+    the job, the others skip that round. The lease is not released after the run, which is what keeps the
+    other workers from running the job again in the same interval. A crashed leader's lease simply expires.
+    """
+
+    def __init__(self, session_factory, owner=None):
+        self.session_factory = session_factory
+        self.owner = owner or "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.jobs = {}
+        self.tasks = set()
+
+    def add(self, name, interval, function, leader_only=True, time_budget=10):
+        self.jobs[name] = Job(name, interval, function, leader_only, time_budget)
+
+    def start(self):
+        for job in self.jobs.values():
+            self.tasks.add(asyncio.create_task(self._loop(job)))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+
+    async def _loop(self, job):
+        await asyncio.sleep(random.uniform(0, min(job.interval, STARTUP_JITTER_SECONDS)))
+        while True:
+            await self.run(job.name)
+            await asyncio.sleep(job.interval)
+
+    async def acquire(self, db, name, lease):
+        """Take or extend the lease on a job, False while another worker holds an unexpired one"""
+        now = time.time()
+        taken = await db.execute(update(JobLock).where(
+            JobLock.name == name, (JobLock.owner == self.owner) | (JobLock.expires_at < now)).values(
+            owner=self.owner, expires_at=now + lease))
+        if taken.rowcount == 0:
+            try:
+                await db.execute(insert(JobLock).values(name=name, owner=self.owner, expires_at=now + lease))
+            except IntegrityError:
+                await db.rollback()
+                return False
+        await db.commit()
+        return True
+
+    async def run(self, name):
+        """Run a job once now if this worker may, returns the result label"""
+        job = self.jobs[name]
+        start = time.monotonic()
+        try:
+            async with self.session_factory() as db:
+                if job.leader_only and not await self.acquire(db, job.name, job.interval):
+                    job_runs.inc(job.name, "not_leader")
+                    return "not_leader"
+                rows = await job.function(db, start + job.time_budget)
+        except (SQLAlchemyError, OSError):
+            logger.exception("Scheduled job %s failed", job.name)
+            job_runs.inc(job.name, "error")
+            return "error"
+        finally:
+            job.last_run = time.time()
+        elapsed = time.monotonic() - start
+        job_duration.observe(elapsed, job.name)
+        job_runs.inc(job.name, "ok")
+        if rows:
+            job_rows.inc(job.name, amount=rows)
+        logger.debug("Scheduled job %s took %.2fs, %s rows", job.name, elapsed, rows)
+        return "ok"
@@ -0,0 +1,160 @@
+import bisect
+import time
+
+from monitoring.sql_stats import route_name
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, _escape(value)) for name, value in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.values.get(label_values, 0)
+
+    def samples(self):
+        for label_values, value in sorted(self.values.items()):
+            yield self.name + _labels(self.label_names, label_values), value
+
+
+class Gauge:
+    """A value read from callback when scraped, so nothing is updated on the hot path"""
+    kind = "gauge"
+
+    def __init__(self, name, help, callback):
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def samples(self):
+        yield self.name, self.callback()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = buckets
+        # label values -> [per bucket counts (+Inf last), sum, count]
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket" + _labels(self.label_names, label_values, [("le", bound)]), cumulative
+            yield self.name + "_sum" + _labels(self.label_names, label_values), total
+            yield self.name + "_count" + _labels(self.label_names, label_values), count
+
+
+class RateMeter:
+    """Events per second over the last `window` seconds, kept as one bucket per second"""
+
+    def __init__(self, window=60):
+        self.window = window
+        self.buckets = [0] * window
+        self.bucket_seconds = [0] * window
+
+    def mark(self, amount=1):
+        second = int(time.time())
+        index = second % self.window
+        if self.bucket_seconds[index] != second:
+            self.bucket_seconds[index] = second
+            self.buckets[index] = 0
+        self.buckets[index] += amount
+
+    def rate(self):
+        oldest = int(time.time()) - self.window
+        return sum(count for count, second in zip(self.buckets, self.bucket_seconds) if second > oldest) / self.window
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, callback):
+        return self.register(Gauge(name, help, callback))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append("%s %s" % (name, repr(float(value)) if isinstance(value, float) else value))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_latency = registry.histogram("http_request_duration_seconds", "HTTP request latency by route",
+                                     labels=("route",))
+request_status = registry.counter("http_requests_total", "HTTP responses by route and status",
+                                  labels=("route", "status"))
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = route_name(scope)
+            request_latency.observe(time.perf_counter() - start, route)
+            request_status.inc(route, str(status[0]))
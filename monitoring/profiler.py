@@ -0,0 +1,200 @@
+import asyncio
+import collections
+import hmac
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from decouple import config
+
+logger = logging.getLogger(__name__)
+
+# profiling is off unless a token is configured, requests opt in with "X-Profile: <token>"
+PROFILER_TOKEN = config("PROFILER_TOKEN", default="")
+SAMPLE_INTERVAL_SECONDS = 0.005
+PROFILES_KEPT = 20
+MAX_WINDOW_SECONDS = 300
+# stacks whose innermost frame is in one of these files are threads waiting for work, not spending time
+IDLE_FILES = ("selectors.py", "threading.py", "queue.py")
+
+
+def authorized(token):
+    return bool(PROFILER_TOKEN) and token is not None and hmac.compare_digest(token, PROFILER_TOKEN)
+
+
+def collapse(thread_name, frame):
+    """One sample as a flamegraph.pl collapsed stack: thread;outermost;...;innermost"""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    frames.append(thread_name)
+    return ";".join(reversed(frames))
+
+
+class Profile:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.started = time.time()
+        self.finished = None
+        self.samples = collections.Counter()
+
+    def collapsed(self):
+        return "".join("%s %d\n" % (stack, count) for stack, count in self.samples.most_common())
+
+
+class SamplingProfiler:
+    """
+    Samples every thread with sys._current_frames while at least one profile is active.
+
+    Samples are added to every active profile, so a per-request profile also sees whatever the
+    other requests on the event loop were doing at the same time.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.active = set()
+        self.finished = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        profile = Profile()
+        with self.lock:
+            self.active.add(profile)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+                self.thread.start()
+        return profile
+
+    def stop(self, profile):
+        with self.lock:
+            if profile not in self.active:
+                return
+            self.active.discard(profile)
+            profile.finished = time.time()
+            self.finished[profile.id] = profile
+            while len(self.finished) > PROFILES_KEPT:
+                self.finished.popitem(last=False)
+
+    def get(self, profile_id):
+        with self.lock:
+            for profile in self.active:
+                if profile.id == profile_id:
+                    return profile
+            return self.finished.get(profile_id)
+
+    def _sample(self):
+        own_thread = threading.get_ident()
+        while True:
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+                profiles = list(self.active)
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_thread or os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+                    continue
+                stack = collapse(names.get(ident, str(ident)), frame)
+                for profile in profiles:
+                    profile.samples[stack] += 1
+            time.sleep(self.interval)
+
+
+profiler = SamplingProfiler()
+
+
+class ProfilerMiddleware:
+    """Profiles a request sent with a valid X-Profile header, the result id is returned in X-Profile-Id"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not PROFILER_TOKEN:
+            await self.app(scope, receive, send)
+            return
+        token = dict(scope["headers"]).get(b"x-profile")
+        if token is None or not authorized(token.decode("latin-1")):
+            await self.app(scope, receive, send)
+            return
+
+        profile = profiler.start()
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"].append((b"x-profile-id", profile.id.encode()))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profiler.stop(profile)
+
+
+def profile_window(seconds):
+    """Profile the whole process for `seconds`, must be called on the event loop"""
+    profile = profiler.start()
+    asyncio.get_running_loop().call_later(min(seconds, MAX_WINDOW_SECONDS), profiler.stop, profile)
+    return profile
+
+
+class LoopWatchdog:
+    """
+    Logs the event loop thread's stack when the loop has not run a heartbeat for longer than threshold.
+
+    A blocking call inside an async handler (bcrypt, SMTP, geocoding) stops the heartbeat, the watchdog
+    thread notices while the call is still running and logs where the loop is stuck.
+    """
+
+    def __init__(self, threshold=0.1):
+        self.threshold = threshold
+        self.stalls = 0
+        self.last_beat = time.monotonic()
+        self.loop_thread = None
+        self.beat_task = None
+        self.thread = None
+        self.stopping = threading.Event()
+
+    async def start(self):
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.stopping.clear()
+        self.beat_task = asyncio.create_task(self._beat())
+        self.thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    async def stop(self):
+        self.stopping.set()
+        if self.beat_task is not None:
+            self.beat_task.cancel()
+            await asyncio.gather(self.beat_task, return_exceptions=True)
+        if self.thread is not None:
+            self.thread.join()
+
+    async def _beat(self):
+        while True:
+            self.last_beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+
+    def _watch(self):
+        reported = False
+        # the heartbeat sleeps threshold / 4 between beats
+        limit = self.threshold * 1.25
+        while not self.stopping.wait(self.threshold / 4):
+            blocked = time.monotonic() - self.last_beat
+            if blocked <= limit:
+                reported = False
+            elif not reported:
+                reported = True
+                self.stalls += 1
+                frame = sys._current_frames().get(self.loop_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+                logger.warning("Event loop blocked for %.0f ms so far\n%s", blocked * 1000, stack)
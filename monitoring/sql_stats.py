@@ -0,0 +1,141 @@
+import contextvars
+import logging
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# statements slower than this are logged with the route that ran them
+SLOW_QUERY_SECONDS = 0.1
+# the same statement run this many times in one request is reported as an N+1
+N_PLUS_ONE_THRESHOLD = 5
+SLOWEST_KEPT = 5
+
+current_request_stats = contextvars.ContextVar("current_request_stats", default=None)
+
+
+class RequestSqlStats:
+    def __init__(self):
+        self.query_count = 0
+        self.db_time = 0.0
+        self.statement_counts = {}
+        self.slowest = []
+
+    def record(self, statement, duration):
+        self.query_count += 1
+        self.db_time += duration
+        self.statement_counts[statement] = self.statement_counts.get(statement, 0) + 1
+        self.slowest.append((duration, statement))
+        self.slowest.sort(key=lambda item: item[0], reverse=True)
+        del self.slowest[SLOWEST_KEPT:]
+
+    @property
+    def repeated_statements(self):
+        return {statement: count for statement, count in self.statement_counts.items()
+                if count >= N_PLUS_ONE_THRESHOLD}
+
+
+class RouteSqlStats:
+    def __init__(self):
+        self.requests = 0
+        self.query_count = 0
+        self.db_time = 0.0
+        self.max_query_count = 0
+        self.n_plus_one_requests = 0
+        self.slowest = []
+
+    def add(self, stats: RequestSqlStats):
+        self.requests += 1
+        self.query_count += stats.query_count
+        self.db_time += stats.db_time
+        self.max_query_count = max(self.max_query_count, stats.query_count)
+        if stats.repeated_statements:
+            self.n_plus_one_requests += 1
+        self.slowest = sorted(self.slowest + stats.slowest, key=lambda item: item[0], reverse=True)[:SLOWEST_KEPT]
+
+    def json(self):
+        return {
+            "requests": self.requests,
+            "queries": self.query_count,
+            "queries_per_request": self.query_count / self.requests if self.requests else 0,
+            "max_queries": self.max_query_count,
+            "db_time_ms": round(self.db_time * 1000, 3),
+            "n_plus_one_requests": self.n_plus_one_requests,
+            "slowest": [{"ms": round(duration * 1000, 3), "statement": statement}
+                        for duration, statement in self.slowest],
+        }
+
+
+route_stats = {}
+
+
+def snapshot():
+    return {route: stats.json() for route, stats in sorted(route_stats.items())}
+
+
+def reset():
+    route_stats.clear()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("sql_stats_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["sql_stats_start"].pop()
+    stats = current_request_stats.get()
+    if stats is not None:
+        stats.record(statement, duration)
+    if duration >= SLOW_QUERY_SECONDS:
+        logger.warning("Slow query %.1fms: %s", duration * 1000, statement)
+
+
+def install_sql_instrumentation():
+    """Time every statement of every engine, including the async engines' sync side"""
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def route_name(scope):
+    endpoint = scope.get("endpoint")
+    router = scope.get("router")
+    if endpoint is not None and router is not None:
+        for route in router.routes:
+            if getattr(route, "endpoint", None) is endpoint:
+                return scope["method"] + " " + route.path
+    return scope["method"] + " <unmatched>"
+
+
+class SqlStatsMiddleware:
+    """Collect the statements each HTTP request runs and report them in headers and per route aggregates"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestSqlStats()
+        token = current_request_stats.set(stats)
+
+        async def send_with_stats(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-db-query-count", str(stats.query_count).encode()))
+                headers.append((b"x-db-time-ms", ("%.3f" % (stats.db_time * 1000)).encode()))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            current_request_stats.reset(token)
+            route = route_name(scope)
+            route_stats.setdefault(route, RouteSqlStats()).add(stats)
+            for statement, count in stats.repeated_statements.items():
+                logger.warning("Possible N+1 on %s, ran %d times: %s", route, count, statement)
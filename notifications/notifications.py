@@ -1,14 +1,36 @@
+import time
+
 from database_models.models import DBNotification, NotificationPriority
-from database_models.db_connector import get_database
 
 
 class Notification:
+    # staged on a session and not committed yet, across all instances
+    queue_depth = 0
 
-    def __init__(self):
-        self.db = get_database()
+    def __init__(self, db):
+        self.db = db
+        self.pending = 0
 
-    def send(self, recipient_id, message, expiration, priority=NotificationPriority.normal):
+    def add(self, recipient_id, message, expiration, priority=NotificationPriority.normal):
+        """Stage a notification on the session, the caller commits"""
         notification = DBNotification(recipient_user_id=recipient_id, message=message, priority=priority,
-                                      expiration=expiration)
+                                      date_sent=int(time.time()), expiration=expiration)
         self.db.add(notification)
-        self.db.commit()
+        self.pending += 1
+        Notification.queue_depth += 1
+
+    async def send(self, recipient_id, message, expiration, priority=NotificationPriority.normal):
+        self.add(recipient_id, message, expiration, priority)
+        await self.commit()
+
+    async def send_many(self, recipient_ids, message, expiration, priority=NotificationPriority.normal):
+        for recipient_id in recipient_ids:
+            self.add(recipient_id, message, expiration, priority)
+        await self.commit()
+
+    async def commit(self):
+        try:
+            await self.db.commit()
+        finally:
+            Notification.queue_depth -= self.pending
+            self.pending = 0
@@ -0,0 +1,302 @@
+"""
+Bulk import of users and bands, for onboarding a partner's roster in one go.
+
+Input is NDJSON or CSV, one record per line with a "type" of user or band:
+    {"type": "user", "first_name": "Ann", "last_name": "Lee", "email": "ann@example.com", "password": "...",
+     "location": "Austin", "talents": ["bass"]}
+    {"type": "band", "name": "The Owls", "location": "Austin", "admin_email": "ann@example.com",
+     "member_emails": ["bo@example.com"], "talents": ["drums"]}
+CSV takes the same fields as columns with list fields separated by ";". A band's admin and members must be
+existing users or users earlier in the import.
+
+Every distinct location is geocoded once, through location_cache. Records are then written IMPORT_BATCH_SIZE
+at a time, one transaction per batch: the passwords of a batch are hashed in parallel on the bcrypt pool and
+the rows go in with executemany core INSERTs. A bad record is reported with its line and skipped, the rest of
+the import goes on.
+
+    python -m onboarding.bulk_import roster.csv --database-url sqlite:///./database.db
+"""
+import argparse
+import asyncio
+import csv
+import hmac
+import io
+import json
+import time
+
+import orjson
+from decouple import config
+from pydantic import ValidationError
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+from auth.claims import bump_roles_version
+from base_models.band_models import ImportUserRecord, ImportBandRecord
+from database_models.db_config import DatabaseConfig
+from database_models.migrations import run_migrations
+from database_models.models import User, Band, BandMember, LookingForBand, LookingForMember, LocationCache
+from geocoding.geocoder import google_geocode
+from security.password_security import hash_password_async
+
+# bulk import endpoint, off while empty
+IMPORT_TOKEN = config("IMPORT_TOKEN", default="")
+# records per transaction, also bounds the IN lists of the per batch lookups
+IMPORT_BATCH_SIZE = 500
+# google geocoding calls in flight at once
+GEOCODE_CONCURRENCY = 8
+RECORD_TYPES = {"user": ImportUserRecord, "band": ImportBandRecord}
+LIST_FIELDS = ("talents", "member_emails")
+
+
+def authorized(token):
+    return bool(IMPORT_TOKEN) and token is not None and hmac.compare_digest(token, IMPORT_TOKEN)
+
+
+def _batched(items, size=IMPORT_BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _validation_message(error):
+    return "; ".join("%s: %s" % (".".join(str(part) for part in detail["loc"]), detail["msg"])
+                     for detail in error.errors())
+
+
+def parse_ndjson(text):
+    """(line, record dict) pairs and (line, error) pairs"""
+    records, errors = [], []
+    for line, raw in enumerate(text.splitlines(), 1):
+        if not raw.strip():
+            continue
+        try:
+            record = orjson.loads(raw)
+        except orjson.JSONDecodeError as error:
+            errors.append((line, "invalid JSON: %s" % error))
+            continue
+        if isinstance(record, dict):
+            records.append((line, record))
+        else:
+            errors.append((line, "record must be a JSON object"))
+    return records, errors
+
+
+def parse_csv(text):
+    """(line, record dict) pairs and (line, error) pairs, empty cells are left out"""
+    records = []
+    reader = csv.DictReader(io.StringIO(text))
+    for row in reader:
+        record = {key: value for key, value in row.items() if key and value not in (None, "")}
+        for field in LIST_FIELDS:
+            if field in record:
+                record[field] = [item.strip() for item in record[field].split(";") if item.strip()]
+        records.append((reader.line_num, record))
+    return records, []
+
+
+PARSERS = {"ndjson": parse_ndjson, "csv": parse_csv}
+
+
+class BulkImport:
+    def __init__(self, db, geocode=None):
+        self.db = db
+        self.geocode = geocode or google_geocode
+        self.created = {"user": 0, "band": 0, "band_member": 0, "looking_for_band": 0, "looking_for_member": 0}
+        self.errors = []
+        self.locations = {"cached": 0, "geocoded": 0}
+
+    def error(self, line, message):
+        self.errors.append({"line": line, "error": message})
+
+    def report(self):
+        self.errors.sort(key=lambda error: error["line"])
+        return {"created": self.created, "locations": self.locations, "errors": self.errors}
+
+    def validate(self, records):
+        """Typed records in input order, each user email only once"""
+        valid = []
+        emails = set()
+        for line, record in records:
+            record_type = RECORD_TYPES.get(record.pop("type", None))
+            if record_type is None:
+                self.error(line, "type must be one of: %s" % ", ".join(RECORD_TYPES))
+                continue
+            try:
+                record = record_type.parse_obj(record)
+            except ValidationError as error:
+                self.error(line, _validation_message(error))
+                continue
+            if isinstance(record, ImportUserRecord):
+                if record.email in emails:
+                    self.error(line, "duplicate email in import")
+                    continue
+                emails.add(record.email)
+            valid.append((line, record))
+        return valid
+
+    async def geocode_locations(self, locations):
+        """Lowercased location -> (lng, lat), or None when the geocoder does not know it"""
+        coordinates = {}
+        for batch in _batched(sorted(locations)):
+            for location, lng, lat in (await self.db.execute(select(
+                    LocationCache.location, LocationCache.lng, LocationCache.lat).where(
+                    LocationCache.location.in_(batch)))).all():
+                coordinates[location] = (lng, lat)
+        self.locations["cached"] = len(coordinates)
+        missing = [location for location in locations if location not in coordinates]
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(GEOCODE_CONCURRENCY)
+
+        async def lookup(location):
+            async with semaphore:
+                try:
+                    return await loop.run_in_executor(None, self.geocode, location)
+                except Exception:
+                    return None
+
+        found = await asyncio.gather(*(lookup(location) for location in missing))
+        new_rows = []
+        for location, result in zip(missing, found):
+            coordinates[location] = (result["lng"], result["lat"]) if result else None
+            if result:
+                new_rows.append({"location": location, "lng": result["lng"], "lat": result["lat"]})
+        if new_rows:
+            await self.db.execute(insert(LocationCache), new_rows)
+            await self.db.commit()
+        self.locations["geocoded"] = len(new_rows)
+        return coordinates
+
+    async def _user_ids(self, emails):
+        if not emails:
+            return {}
+        return {email: user_id for user_id, email in (await self.db.execute(
+            select(User.id, User.email).where(User.email.in_(emails)))).all()}
+
+    async def _write_users(self, users, coordinates):
+        existing = await self._user_ids([record.email for _, record in users])
+        for line, record in users:
+            if record.email in existing:
+                self.error(line, "email already exists")
+        users = [(line, record) for line, record in users if record.email not in existing]
+        hashes = await asyncio.gather(*(hash_password_async(record.password) for _, record in users
+                                        if record.password_hash is None))
+        hashes = iter(hashes)
+        rows = []
+        for _, record in users:
+            lng, lat = coordinates[record.location.lower()] if record.location else (None, None)
+            rows.append({"first_name": record.first_name, "last_name": record.last_name, "email": record.email,
+                         "password_hash": record.password_hash.encode() if record.password_hash else next(hashes),
+                         "location": record.location, "longitude": lng, "latitude": lat})
+        if not rows:
+            return {}
+        await self.db.execute(insert(User), rows)
+        user_ids = await self._user_ids([record.email for _, record in users])
+        talents = [{"user_id": user_ids[record.email], "talent": talent}
+                   for _, record in users for talent in record.talents]
+        if talents:
+            await self.db.execute(insert(LookingForBand), talents)
+        return {"user": len(rows), "looking_for_band": len(talents)}
+
+    async def _write_bands(self, bands, coordinates):
+        user_ids = await self._user_ids(list({email for _, record in bands
+                                              for email in [record.admin_email, *record.member_emails]}))
+        members, talents = [], []
+        created = 0
+        for line, record in bands:
+            unknown = [email for email in [record.admin_email, *record.member_emails] if email not in user_ids]
+            if unknown:
+                self.error(line, "unknown user email: %s" % ", ".join(unknown))
+                continue
+            lng, lat = coordinates[record.location.lower()]
+            band_id = (await self.db.execute(insert(Band).values(
+                name=record.name, location=record.location, longitude=lng, latitude=lat))).inserted_primary_key[0]
+            created += 1
+            members.append({"band_id": band_id, "user_id": user_ids[record.admin_email], "admin": True})
+            members.extend({"band_id": band_id, "user_id": user_ids[email], "admin": False}
+                           for email in dict.fromkeys(record.member_emails) if email != record.admin_email)
+            talents.extend({"band_id": band_id, "talent": talent} for talent in record.talents)
+        if members:
+            await self.db.execute(insert(BandMember), members)
+            # existing users' tokens do not name the new bands yet
+            await self.db.execute(bump_roles_version(list({member["user_id"] for member in members})))
+        if talents:
+            await self.db.execute(insert(LookingForMember), talents)
+        return {"band": created, "band_member": len(members), "looking_for_member": len(talents)}
+
+    async def write_batch(self, batch, coordinates):
+        """One transaction, users first so the batch's bands can name them"""
+        located = []
+        for line, record in batch:
+            if record.location and coordinates.get(record.location.lower()) is None:
+                self.error(line, "location could not be geocoded")
+            else:
+                located.append((line, record))
+        users = [(line, record) for line, record in located if isinstance(record, ImportUserRecord)]
+        bands = [(line, record) for line, record in located if isinstance(record, ImportBandRecord)]
+        errors = len(self.errors)
+        try:
+            created = {}
+            if users:
+                created.update(await self._write_users(users, coordinates))
+            if bands:
+                created.update(await self._write_bands(bands, coordinates))
+            await self.db.commit()
+        except SQLAlchemyError as error:
+            await self.db.rollback()
+            del self.errors[errors:]
+            for line, _ in located:
+                self.error(line, "batch not imported: %s" % error.__class__.__name__)
+            return
+        for table, count in created.items():
+            self.created[table] += count
+
+    async def run(self, records):
+        valid = self.validate(records)
+        coordinates = await self.geocode_locations({record.location.lower() for _, record in valid
+                                                    if record.location})
+        for batch in _batched(valid):
+            await self.write_batch(batch, coordinates)
+        return self.report()
+
+
+async def import_records(db, text, fmt="ndjson", geocode=None):
+    """Import NDJSON or CSV text, returns rows created per table, location cache use and per line errors"""
+    bulk_import = BulkImport(db, geocode)
+    records, errors = PARSERS[fmt](text)
+    for line, message in errors:
+        bulk_import.error(line, message)
+    return await bulk_import.run(records)
+
+
+async def _import_file(db_config, path, fmt):
+    engine = create_async_engine(db_config.async_url, **db_config.engine_options(is_async=True))
+    db_config.install(engine.sync_engine)
+    try:
+        with open(path, encoding="utf-8") as file:
+            text = file.read()
+        async with AsyncSession(engine, expire_on_commit=False) as db:
+            return await import_records(db, text, fmt)
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=PARSERS, help="defaults to csv for .csv files, ndjson otherwise")
+    parser.add_argument("--database-url", help="defaults to DATABASE_URL")
+    args = parser.parse_args()
+
+    db_config = DatabaseConfig(url=args.database_url) if args.database_url else DatabaseConfig.from_env()
+    engine = create_engine(db_config.url, **db_config.engine_options())
+    run_migrations(engine)
+    engine.dispose()
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+    start = time.perf_counter()
+    report = asyncio.run(_import_file(db_config, args.path, fmt))
+    report["seconds"] = round(time.perf_counter() - start, 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
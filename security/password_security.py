@@ -1,5 +1,15 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import bcrypt
 
+# bcrypt releases the GIL, so hashing on a small pool keeps it off the event loop
+BCRYPT_WORKERS = os.cpu_count() or 1
+bcrypt_pool = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+# submitted to the pool and not finished yet, running or queued
+bcrypt_jobs = 0
+
 
 def hash_password(password):
     return bcrypt.hashpw(bytes(password, encoding='utf-8'), bcrypt.gensalt(rounds=12))
@@ -7,3 +17,24 @@ def hash_password(password):
 
 def verify_password(password, hashed):
     return bcrypt.checkpw(bytes(password, encoding='utf-8'), bytes(hashed))
+
+
+async def _run_on_bcrypt_pool(function, *args):
+    global bcrypt_jobs
+    bcrypt_jobs += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(bcrypt_pool, function, *args)
+    finally:
+        bcrypt_jobs -= 1
+
+
+async def hash_password_async(password):
+    return await _run_on_bcrypt_pool(hash_password, password)
+
+
+async def verify_password_async(password, hashed):
+    return await _run_on_bcrypt_pool(verify_password, password, hashed)
+
+
+def bcrypt_pool_utilization():
+    return min(bcrypt_jobs, BCRYPT_WORKERS) / BCRYPT_WORKERS
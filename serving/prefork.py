@@ -0,0 +1,132 @@
+"""
+Serve the app from several processes that share one preloaded copy of it.
+
+The parent binds the socket, imports the app, checks the schema and maps a snapshot of location_cache, then
+forks --workers processes that accept on the same socket. The code, the models and the snapshot are shared
+copy-on-write. gc.freeze() before forking keeps the collector from writing to every preloaded object, which
+would copy their pages into each worker.
+
+Nothing in the parent holds a connection or a thread when it forks: importing main opens nothing, and the
+engine used for the schema check and the snapshot is disposed first. Each worker runs the startup hooks
+itself (engines, token revocations, scheduler). Leader only jobs still run once per interval across the
+workers, the entity cache, metrics and websockets are per worker.
+
+A worker that dies is replaced. SIGTERM or SIGINT stops the workers and waits for them to finish.
+
+    python -m serving.prefork --workers 4 --port 8000
+"""
+import argparse
+import gc
+import logging
+import os
+import signal
+import time
+
+import uvicorn
+from sqlalchemy import create_engine
+
+from caching import location_snapshot
+from caching.location_snapshot import LocationSnapshot
+from database_models.db_connector import get_db_config
+from database_models.migrations import ensure_schema
+
+logger = logging.getLogger(__name__)
+
+# a worker that fails its startup exits with this and stops the server instead of being restarted forever
+STARTUP_FAILURE = 3
+
+
+def preload():
+    """Schema check and location snapshot, on an engine that is gone before the fork"""
+    db_config = get_db_config()
+    engine = create_engine(db_config.url, **db_config.engine_options())
+    try:
+        ensure_schema(engine)
+        with engine.connect() as conn:
+            snapshot = LocationSnapshot.from_database(conn)
+    finally:
+        engine.dispose()
+    location_snapshot.activate(snapshot)
+    logger.info("Preloaded app, %d locations in the shared snapshot", len(snapshot))
+
+
+class PreforkServer:
+    def __init__(self, config, workers):
+        self.config = config
+        self.workers = workers
+        self.socket = None
+        self.children = set()
+        self.stopping = False
+        self.failed = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+        # the parent's handlers signal every worker, uvicorn installs its own on the worker's loop
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        server = uvicorn.Server(self.config)
+        try:
+            server.run(sockets=[self.socket])
+        except Exception:
+            logger.exception("Worker %d crashed", os.getpid())
+        finally:
+            os._exit(0 if server.started else STARTUP_FAILURE)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        self.config.load()
+        self.socket = self.config.bind_socket()
+        preload()
+        # everything allocated so far is shared with the workers, the collector leaves it alone from now on
+        gc.freeze()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            self.children.discard(pid)
+            if self.stopping:
+                continue
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == STARTUP_FAILURE:
+                logger.error("Worker %d failed to start, stopping", pid)
+                self.failed = True
+                self.stop()
+                continue
+            logger.warning("Worker %d exited with status %d, starting another", pid, status)
+            # a worker dying right away should not turn into a fork loop
+            time.sleep(1)
+            self.spawn()
+        self.socket.close()
+        return not self.failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    from main import app
+    config = uvicorn.Config(app, host=args.host, port=args.port, log_level=args.log_level)
+    if not PreforkServer(config, args.workers).run():
+        raise SystemExit(STARTUP_FAILURE)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,59 @@
+import asyncio
 import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
 import time
 import pytest
+import requests
 
 from unittest.mock import patch
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select, or_, and_
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import exc
 from sqlalchemy.orm import sessionmaker
-from auth.jwt_handler import sign_jwt
-from database_models.models import User, EmailVerification, Base, Band, BandMember, BandInvite
+from auth.claims import role_checks
+from auth.jwt_handler import sign_jwt, decode_jwt
+from auth.revocation import TokenRevocationList
+from database_models.db_config import DatabaseConfig
+from database_models.migrations import run_migrations, applied_versions, pending_migrations, ensure_schema, MIGRATIONS
+from database_models.search import install_full_text_search
+from database_models import archive
+from database_models.models import User, EmailVerification, Base, Band, BandMember, BandInvite, DBNotification, \
+    BandInviteByEmail, DBMessage, LocationCache, NotificationPriority, MessageArchiveBlock
 from main import get_database, app
-from security.password_security import hash_password
+from monitoring import sql_stats
+from monitoring.sql_stats import RequestSqlStats, current_request_stats, N_PLUS_ONE_THRESHOLD
+from monitoring.metrics import Registry
+from maintenance import jobs
+from maintenance.scheduler import Scheduler, job_runs
+from monitoring import profiler
+from monitoring.profiler import LoopWatchdog
+from security.password_security import hash_password, verify_password
+from benchmarks import dataset, http_suite
+from benchmarks.harness import process_stats, free_port
+from caching import location_snapshot
+from caching.location_snapshot import LocationSnapshot
+from caching.entity_cache import EntityCache, entity_cache
+from onboarding import bulk_import
+from base_models.response_models import UserOut, MessageOut
 
 DATABASE_URL = "sqlite:///./test_database.db"
-engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}
-)
+db_config = DatabaseConfig(url=DATABASE_URL)
+# tests leak sessions through next(override_get_db()), so the sync engine keeps the unbounded NullPool
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+db_config.install(engine)
+async_engine = create_async_engine(db_config.async_url, **db_config.engine_options(is_async=True))
+db_config.install(async_engine.sync_engine)
 
 Base.metadata.drop_all(bind=engine)
 Base.metadata.create_all(bind=engine)
 DbSession = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncDbSession = sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
 
 client = TestClient(app)
 
@@ -32,7 +66,12 @@ def override_get_db():
         db.close()
 
 
-app.dependency_overrides[get_database] = override_get_db
+async def override_get_async_db():
+    async with AsyncDbSession() as db:
+        yield db
+
+
+app.dependency_overrides[get_database] = override_get_async_db
 
 valid_data = {
     "first_name": "Jason",
@@ -84,6 +123,19 @@ def test_bad_db_register_user():
         assert len(db.query(User).all()) == 4
 
 
+@pytest.fixture(scope="session", autouse=True)
+def dispose_test_engines():
+    yield
+    asyncio.run(async_engine.dispose())
+    engine.dispose()
+
+
+@pytest.fixture(autouse=True)
+def clear_entity_cache():
+    # tests change rows directly through sessions, which the cache cannot see
+    entity_cache.clear()
+
+
 @pytest.fixture(scope="session", autouse=True)
 def populate_db():
     Base.metadata.drop_all(bind=engine)
@@ -354,3 +406,772 @@ def test_send_invite():
 def test_user_login():
     # TODO test invalid credentials
     pass
+
+
+def test_logout_revokes_token():
+    db = next(override_get_db())
+    token = sign_jwt(db.query(User).where(User.id == 3).first())
+    header = {
+        "Authorization": "Bearer " + token
+    }
+    resp = client.post("/logout", headers=header)
+    assert resp.status_code == 200
+    resp = client.post("/logout", headers=header)
+    assert resp.status_code == 401
+    # other sessions of the same user stay valid
+    other_header = {
+        "Authorization": "Bearer " + sign_jwt(db.query(User).where(User.id == 3).first())
+    }
+    resp = client.get("/verify_band_code/1/none", headers=other_header)
+    assert resp.status_code == 404
+
+
+def test_logout_all_revokes_older_tokens():
+    db = next(override_get_db())
+    user = db.query(User).where(User.id == 1).first()
+    header = {
+        "Authorization": "Bearer " + sign_jwt(user)
+    }
+    resp = client.post("/logout_all", headers=header)
+    assert resp.status_code == 200
+    resp = client.get("/verify_band_code/1/none", headers=header)
+    assert resp.status_code == 401
+    fresh_header = {
+        "Authorization": "Bearer " + sign_jwt(user)
+    }
+    resp = client.get("/verify_band_code/1/none", headers=fresh_header)
+    assert resp.status_code == 404
+
+
+async def refresh_revocations(revocations):
+    async with AsyncDbSession() as db:
+        await revocations.refresh(db)
+
+
+def test_token_revocations_refresh_from_db():
+    db = next(override_get_db())
+    user = db.query(User).where(User.id == 3).first()
+    token = sign_jwt(user)
+    client.post("/logout", headers={"Authorization": "Bearer " + token})
+
+    # a fresh worker only learns about the revocation from the database
+    revocations = TokenRevocationList()
+    payload = decode_jwt(token)
+    assert not revocations.is_revoked(payload)
+    asyncio.run(refresh_revocations(revocations))
+    assert revocations.is_revoked(payload)
+    assert not revocations.is_revoked(decode_jwt(sign_jwt(user)))
+
+
+def test_delete_band_removes_members_and_notifies_them():
+    db = next(override_get_db())
+    admin = db.query(User).where(User.id == 3).first()
+    band = Band(name="Short Lived", location="MN")
+    db.add(band)
+    db.flush()
+    db.add_all([BandMember(band_id=band.id, user_id=3, admin=True), BandMember(band_id=band.id, user_id=2),
+                BandInviteByEmail(email="later@gmail.com", band_id=band.id, expiration=time.time() + 600)])
+    db.commit()
+    band_id = band.id
+    header = {
+        "Authorization": "Bearer " + sign_jwt(admin)
+    }
+    resp = client.delete("/delete_band", json={"id": band_id, "name": "Short Lived", "location": "MN"},
+                         headers=header)
+    assert resp.status_code == 200
+    assert resp.json()["deleted"] == {"notifications_sent": 2, "band_member": 2, "band_invite": 0,
+                                      "band_invite_by_email": 1, "looking_for_member": 0, "band": 1}
+    db = next(override_get_db())
+    assert db.query(Band).where(Band.id == band_id).first() is None
+    assert db.query(BandMember).where(BandMember.band_id == band_id).all() == []
+    # memberships in other bands are untouched
+    assert len(db.query(BandMember).where(BandMember.band_id == 1).all()) == 2
+    notified = {n.recipient_user_id for n in db.query(DBNotification).where(
+        DBNotification.message.like("Short Lived has been disbanded%")).all()}
+    assert notified == {2, 3}
+
+
+def test_delete_user_removes_user_rows():
+    resp = client.post("/register", json={"first_name": "Gone", "last_name": "Soon",
+                                          "email": "gone@gmail.com", "password": "test"})
+    assert resp.status_code == 200
+    header = {
+        "Authorization": "Bearer " + resp.json()
+    }
+    db = next(override_get_db())
+    user_id = db.query(User.id).where(User.email == "gone@gmail.com").scalar()
+    db.add_all([BandMember(band_id=1, user_id=user_id),
+                DBMessage(sender_user_id=user_id, recipient_user_id=1, message="bye", sent=1)])
+    db.commit()
+    resp = client.delete("/user/", headers=header)
+    assert resp.status_code == 200
+    deleted = resp.json()["deleted"]
+    assert (deleted["user"], deleted["band_member"], deleted["message"], deleted["email_verification"]) == (1, 1, 1, 1)
+    db = next(override_get_db())
+    assert db.query(User).where(User.email == "gone@gmail.com").first() is None
+    assert db.query(BandMember).where(BandMember.user_id == user_id).all() == []
+
+
+def test_password_change_returns_fresh_token():
+    db = next(override_get_db())
+    user = db.query(User).where(User.id == 3).first()
+    old_header = {
+        "Authorization": "Bearer " + sign_jwt(user)
+    }
+    user_req = {
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'email': user.email,
+        'password': 'a new password'
+    }
+    resp = client.put("/update_user", json=user_req, headers=old_header)
+    assert resp.status_code == 200
+    new_header = {
+        "Authorization": "Bearer " + resp.json()
+    }
+    assert client.get("/verify_band_code/1/none", headers=old_header).status_code == 401
+    assert client.get("/verify_band_code/1/none", headers=new_header).status_code == 404
+
+
+def test_revocation_during_refresh_is_kept():
+    revocations = TokenRevocationList()
+    db = next(override_get_db())
+    payload = decode_jwt(sign_jwt(db.query(User).where(User.id == 2).first()))
+
+    class LogoutMidRefresh:
+        # another request logs out after the refresh has read the revoked ids
+        def __init__(self, session):
+            self.session = session
+            self.calls = 0
+
+        async def execute(self, statement):
+            result = await self.session.execute(statement)
+            self.calls += 1
+            if self.calls == 2:
+                async with AsyncDbSession() as other:
+                    await revocations.revoke_token(other, payload)
+            return result
+
+    async def refresh():
+        async with AsyncDbSession() as session:
+            await revocations.refresh(LogoutMidRefresh(session))
+
+    asyncio.run(refresh())
+    assert revocations.is_revoked(payload)
+
+
+def test_migrations_upgrade_existing_database(tmp_path):
+    old_engine = create_engine("sqlite:///" + str(tmp_path / "old.db"))
+    with old_engine.begin() as conn:
+        conn.exec_driver_sql('CREATE TABLE "user" (id INTEGER PRIMARY KEY, first_name VARCHAR, last_name VARCHAR, '
+                             'email VARCHAR)')
+        conn.exec_driver_sql("""INSERT INTO "user" (id, first_name, email) VALUES (1, 'Old', 'old@gmail.com')""")
+        conn.exec_driver_sql("CREATE TABLE location_cache (id INTEGER PRIMARY KEY, lng FLOAT, lat FLOAT, location VARCHAR)")
+        conn.exec_driver_sql("INSERT INTO location_cache (lng, lat, location) VALUES (1, 2, 'Denver')")
+    assert pending_migrations(old_engine) == [1, 2, 3, 4, 5, 6, 7, 8]
+    assert run_migrations(old_engine) == [1, 2, 3, 4, 5, 6, 7, 8]
+    with old_engine.connect() as conn:
+        assert conn.exec_driver_sql('SELECT tokens_valid_after FROM "user"').scalar() == 0
+        assert conn.exec_driver_sql('SELECT version FROM "user"').scalar() == 1
+        assert conn.exec_driver_sql('SELECT roles_version FROM "user"').scalar() == 1
+        assert conn.exec_driver_sql("SELECT count(*) FROM revoked_token").scalar() == 0
+        assert conn.exec_driver_sql("SELECT location FROM location_cache").scalar() == "denver"
+        # rows from before the full text index are indexed by the migration
+        assert conn.exec_driver_sql("SELECT rowid FROM user_fts WHERE user_fts MATCH 'old'").scalar() == 1
+        indexes = {name for name, in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"ix_user_email", "ix_message_sender_recipient_sent", "ix_location_cache_location"} <= indexes
+    # already applied migrations are skipped
+    assert run_migrations(old_engine) == []
+    assert applied_versions(old_engine) == {version for version, _, _ in MIGRATIONS}
+    # startup only checks a current schema
+    assert pending_migrations(old_engine) == [] and ensure_schema(old_engine) == []
+
+
+def explain(statement):
+    compiled = statement.compile(engine, compile_kwargs={"literal_binds": True})
+    with engine.connect() as conn:
+        return [row[-1] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled))]
+
+
+@pytest.mark.parametrize("statement", [
+    select(User).where(User.email == "jason@gmail.com"),
+    select(User.id, User.first_name, User.last_name).where(User.id.in_(
+        select(BandMember.user_id).where(BandMember.band_id == 1))),
+    select(BandMember).where(BandMember.user_id == 1),
+    select(BandInvite).where(BandInvite.code == "ABCD1234").where(BandInvite.user_id == 1),
+    select(EmailVerification).where(EmailVerification.code == "ABCD1234"),
+    select(BandInviteByEmail).where(BandInviteByEmail.email == "invite@gmail.com"),
+    select(BandInviteByEmail.band_id).where(BandInviteByEmail.email == "invite@gmail.com",
+                                            BandInviteByEmail.expiration > 1700000000),
+    select(DBNotification).where(DBNotification.id == 1, DBNotification.recipient_user_id == 1),
+    select(DBNotification).where(DBNotification.recipient_user_id == 1),
+    select(DBMessage).where(or_(and_(DBMessage.recipient_user_id == 1, DBMessage.sender_user_id == 2),
+                                and_(DBMessage.sender_user_id == 1, DBMessage.recipient_user_id == 2))),
+    select(LocationCache).where(LocationCache.location == "denver"),
+])
+def test_endpoint_queries_use_an_index(statement):
+    plan = explain(statement)
+    assert not [step for step in plan if step.startswith("SCAN")], plan
+
+
+def test_sqlite_connections_use_wal():
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        # NORMAL
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == db_config.sqlite_busy_timeout
+
+
+def test_database_config_urls_and_statement_sampling(capsys):
+    assert DatabaseConfig(url="postgresql://u:p@db/band").async_url == "postgresql+asyncpg://u:p@db/band"
+    with pytest.raises(ValueError):
+        DatabaseConfig(url="oracle://u:p@db/band")
+
+    sampled_config = DatabaseConfig(url="sqlite://", log_sample_rate=1.0)
+    sampled_engine = create_engine("sqlite://")
+    sampled_config.install(sampled_engine)
+    with sampled_engine.connect() as conn:
+        conn.exec_driver_sql("SELECT 42")
+    # logged without any logging setup by the caller
+    assert "SELECT 42" in capsys.readouterr().err
+
+
+def test_process_exits_after_app_shutdown(tmp_path):
+    # pooled aiosqlite connections keep a worker thread alive until the engines are disposed
+    script = (
+        "from fastapi.testclient import TestClient\n"
+        "import main\n"
+        "with TestClient(main.app) as c:\n"
+        "    assert c.get('/band/1').status_code == 200\n"
+    )
+    result = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, timeout=60,
+                            env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__))),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    assert result.returncode == 0, result.stderr
+
+
+def test_importing_the_app_needs_no_environment_and_opens_nothing(tmp_path):
+    script = (
+        "import sys\n"
+        "import main\n"
+        "from database_models import db_connector\n"
+        "assert 'googlemaps' not in sys.modules and 'uvicorn' not in sys.modules\n"
+        "assert not db_connector._engines\n"
+        "assert main.create_app() is not main.app\n"
+    )
+    env = {name: value for name, value in os.environ.items()
+           if name not in ("GEOCODE_API_KEY", "JWT_SECRET", "JWT_ALGORITHM", "EMAIL_PASSWORD")}
+    result = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, timeout=60,
+                            env=dict(env, PYTHONPATH=os.path.dirname(os.path.dirname(__file__))),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    assert result.returncode == 0, result.stderr
+    assert not (tmp_path / "database.db").exists()
+
+
+def test_sql_stats_per_request_and_route():
+    sql_stats.reset()
+    resp = client.get("/bandmembers/1")
+    # roster, then its users
+    assert resp.headers["x-db-query-count"] == "2"
+    assert float(resp.headers["x-db-time-ms"]) >= 0
+    assert client.get("/bandmembers/1").headers["x-db-query-count"] == "0"
+    route = client.get("/debug/sql_stats").json()["GET /bandmembers/{band_id}"]
+    assert route["requests"] == 2
+    assert route["queries"] == 2
+    assert route["n_plus_one_requests"] == 0
+    assert any("band_member" in slow["statement"] for slow in route["slowest"])
+
+
+def test_sql_stats_flags_repeated_statements():
+    stats = RequestSqlStats()
+    token = current_request_stats.set(stats)
+    try:
+        with engine.connect() as conn:
+            for user_id in range(N_PLUS_ONE_THRESHOLD):
+                conn.execute(select(User.email).where(User.id == user_id))
+            conn.execute(select(Band.name))
+    finally:
+        current_request_stats.reset(token)
+    assert stats.query_count == N_PLUS_ONE_THRESHOLD + 1
+    assert list(stats.repeated_statements.values()) == [N_PLUS_ONE_THRESHOLD]
+
+
+def test_metrics_endpoint_reports_routes_and_gauges():
+    client.get("/bandmembers/1")
+    body = client.get("/metrics").text
+    assert 'http_request_duration_seconds_bucket{route="GET /bandmembers/{band_id}",le="+Inf"}' in body
+    assert 'http_requests_total{route="GET /bandmembers/{band_id}",status="200"}' in body
+    for gauge in ("websocket_connections", "messages_per_second", "geocode_cache_hit_ratio", "email_queue_depth",
+                  "notification_queue_depth", "bcrypt_pool_utilization"):
+        assert "# TYPE %s gauge" % gauge in body
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "test", labels=("route",), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.observe(value, "GET /")
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{route="GET /",le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{route="GET /",le="1"} 3' in lines
+    assert 'latency_seconds_bucket{route="GET /",le="+Inf"} 4' in lines
+    assert 'latency_seconds_count{route="GET /"} 4' in lines
+
+
+def test_profile_request_with_header(monkeypatch):
+    monkeypatch.setattr(profiler, "PROFILER_TOKEN", "secret")
+    assert "x-profile-id" not in client.get("/bandmembers/1").headers
+    resp = client.get("/bandmembers/1", headers={"X-Profile": "secret"})
+    profile_id = resp.headers["x-profile-id"]
+    assert client.get("/debug/profile/" + profile_id).status_code == 403
+    resp = client.get("/debug/profile/" + profile_id, headers={"X-Profile-Token": "secret"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+
+
+def test_profiler_collapses_busy_thread_stacks():
+    def busy_loop():
+        end = time.time() + 0.1
+        while time.time() < end:
+            pass
+
+    profile = profiler.profiler.start()
+    worker = threading.Thread(target=busy_loop, name="busy")
+    worker.start()
+    worker.join()
+    profiler.profiler.stop(profile)
+    busy = [line for line in profile.collapsed().splitlines() if line.startswith("busy;")]
+    assert busy and "busy_loop (test_main.py:" in busy[0]
+
+
+def test_loop_watchdog_logs_blocking_call(caplog):
+    async def block_the_loop():
+        watchdog = LoopWatchdog(threshold=0.05)
+        await watchdog.start()
+        await asyncio.sleep(0.05)
+        time.sleep(0.3)
+        await asyncio.sleep(0.05)
+        await watchdog.stop()
+        return watchdog
+
+    with caplog.at_level(logging.WARNING, logger="monitoring.profiler"):
+        watchdog = asyncio.run(block_the_loop())
+    assert watchdog.stalls == 1
+    assert "block_the_loop" in caplog.text
+
+
+def test_dataset_generator_builds_consistent_rows(tmp_path):
+    generated = create_engine("sqlite:///" + str(tmp_path / "generated.db"))
+    run_migrations(generated)
+    inserted = dataset.generate(generated, users=300, bands=40, messages=200, notifications=100, seed=1)
+    assert inserted["user"] == 300 and inserted["band"] == 40 and inserted["message"] == 200
+    with generated.connect() as conn:
+        admins = conn.execute(select(BandMember.band_id).where(BandMember.admin == True)).scalars().all()
+        assert sorted(admins) == list(range(1, 41))
+        cities = set(conn.execute(select(LocationCache.location)).scalars())
+        assert set(conn.execute(select(User.location)).scalars()) <= {city.title() for city in cities}
+        # band members and message partners are drawn from the same city
+        assert conn.execute(select(BandMember).join(Band, Band.id == BandMember.band_id).join(
+            User, User.id == BandMember.user_id).where(User.location != Band.location)).first() is None
+        password_hash = conn.execute(select(User.password_hash)).scalar()
+    assert verify_password("password", password_hash)
+    # a second run appends after the existing ids
+    assert dataset.generate(generated, users=10, bands=1, messages=0, notifications=0)["location_cache"] == 0
+    generated.dispose()
+
+
+def test_http_suite_compare_reports_relative_change():
+    baseline = {"endpoints": {"GET /band/{id}": {"p50": 10.0, "p95": 20.0, "p99": 40.0, "throughput": 100.0}}}
+    results = {"endpoints": {"GET /band/{id}": {"p50": 5.0, "p95": 25.0, "p99": None, "throughput": 150.0},
+                             "GET /new": {"p50": 1.0, "p95": 1.0, "p99": 1.0, "throughput": 1.0}}}
+    assert http_suite.compare(baseline, results) == {"GET /band/{id}": {"p50": -50.0, "p95": 25.0, "throughput": 50.0}}
+
+
+def test_process_stats_reads_memory_and_cpu():
+    rss, cpu = process_stats(os.getpid())
+    assert rss > 1024 * 1024
+    assert 0 < cpu <= time.process_time() + 0.1
+
+
+def test_entity_cache_serves_reads_until_a_write_invalidates():
+    db = next(override_get_db())
+    user = db.query(User).where(User.id == 1).first()
+    header = {"Authorization": "Bearer " + sign_jwt(user)}
+    assert client.get("/band/1").headers["x-db-query-count"] == "1"
+    resp = client.get("/band/1")
+    assert resp.headers["x-db-query-count"] == "0"
+    band = resp.json()
+    assert client.get("/user/1").json()["email"] == "jason@gmail.com"
+    assert client.get("/user/1").headers["x-db-query-count"] == "0"
+
+    renamed = {"id": 1, "name": "Renamed", "location": band["location"]}
+    assert client.put("/update_band", json=renamed, headers=header).status_code == 200
+    assert client.get("/band/1").json()["name"] == "Renamed"
+    client.put("/update_band", json=dict(renamed, name=band["name"]), headers=header)
+
+
+def test_entity_cache_drops_reads_that_raced_an_invalidation():
+    cache = EntityCache()
+    invalidations = cache.bands.invalidations
+    cache.invalidate_band(1)
+    cache.bands.set(1, {"id": 1, "name": "stale"}, invalidations)
+    assert cache.bands.get(1) is None
+    cache.bands.set(1, {"id": 1, "name": "fresh"}, cache.bands.invalidations)
+    assert cache.bands.get(1)["name"] == "fresh"
+
+
+def test_conditional_get_returns_304_until_the_resource_changes():
+    db = next(override_get_db())
+    user = db.query(User).where(User.id == 1).first()
+    header = {"Authorization": "Bearer " + sign_jwt(user)}
+    for path in ("/band/1", "/user/1", "/bandmembers/1"):
+        resp = client.get(path)
+        etag = resp.headers["etag"]
+        not_modified = client.get(path, headers={"If-None-Match": "W/" + etag})
+        assert not_modified.status_code == 304
+        assert not_modified.content == b""
+        assert not_modified.headers["etag"] == etag
+
+    band_etag = client.get("/band/1").headers["etag"]
+    roster_etag = client.get("/bandmembers/1").headers["etag"]
+    band = client.get("/band/1").json()
+    client.put("/update_band", json={"id": 1, "name": band["name"], "location": band["location"]}, headers=header)
+    assert client.get("/band/1", headers={"If-None-Match": band_etag}).status_code == 200
+    # a member's profile change shows in the roster view
+    profile = {"first_name": "Jason", "last_name": "Renamed", "email": "jason@gmail.com", "password": ""}
+    assert client.put("/update_user", json=profile, headers=header).status_code == 200
+    resp = client.get("/bandmembers/1", headers={"If-None-Match": roster_etag})
+    assert resp.status_code == 200
+    assert resp.headers["etag"] != roster_etag
+    client.put("/update_user", json=dict(profile, last_name="Bourne"), headers=header)
+
+
+def test_responses_follow_response_models():
+    users = client.get("/users").json()["items"]
+    assert users and set(users[0]) == set(UserOut.__fields__)
+    assert "password_hash" not in client.get("/user/1").json()
+    db = next(override_get_db())
+    db.add(DBMessage(sender_user_id=1, recipient_user_id=2, message="hi"))
+    db.commit()
+    user = db.query(User).where(User.id == 2).first()
+    messages = client.get("/messages/1", headers={"Authorization": "Bearer " + sign_jwt(user)}).json()
+    assert set(messages[-1]) == set(MessageOut.__fields__)
+    assert isinstance(messages[-1]["sent"], int)
+
+
+def test_batch_returns_users_bands_and_rosters_with_one_query_each():
+    resp = client.get("/batch?user_ids=3&user_ids=999&band_ids=1&band_ids=1&band_ids=998&rosters=true")
+    assert resp.status_code == 200
+    assert resp.headers["x-db-query-count"] == "3"
+    body = resp.json()
+    assert [band["id"] for band in body["bands"]] == [1]
+    members = {member["user_id"]: member["admin"] for member in body["rosters"][0]["members"]}
+    assert members == {1: True, 2: False}
+    assert [user["id"] for user in body["users"]] == [3, 1, 2]
+    assert "password_hash" not in body["users"][0]
+    # everything is cached now
+    assert client.get("/batch?user_ids=3&band_ids=1&rosters=true").headers["x-db-query-count"] == "0"
+    too_many = "&".join("user_ids=%d" % i for i in range(201))
+    assert client.get("/batch?" + too_many).status_code == 400
+
+
+@pytest.mark.parametrize("name, model", [("users", User), ("band_members", BandMember)])
+def test_keyset_pages_cover_the_table_once(name, model):
+    db = next(override_get_db())
+    expected = db.query(model).count()
+    seen, after = [], None
+    while True:
+        page = client.get("/" + name, params={"limit": 2, "after": after} if after else {"limit": 2}).json()
+        seen.extend(page["items"])
+        after = page["next"]
+        if after is None:
+            break
+    keys = [tuple(item[column.key] for column in model.__table__.primary_key.columns) for item in seen]
+    assert len(keys) == expected
+    assert keys == sorted(set(keys))
+    assert client.get("/" + name, params={"after": "x,y,z"}).status_code == 400
+
+
+def test_export_streams_ndjson():
+    db = next(override_get_db())
+    resp = client.get("/export/users")
+    assert resp.headers["content-type"] == "application/x-ndjson"
+    lines = resp.text.splitlines()
+    assert len(lines) == db.query(User).count()
+    assert "password_hash" not in json.loads(lines[0])
+    assert client.get("/export/password_hashes").status_code == 404
+
+
+def test_bulk_import_reports_bad_rows_and_geocodes_each_location_once(monkeypatch):
+    monkeypatch.setattr(bulk_import, "IMPORT_TOKEN", "secret")
+    lookups = []
+
+    def geocode(location):
+        lookups.append(location)
+        return None if location == "atlantis" else {"lng": -97.7, "lat": 30.3}
+
+    body = "\n".join(json.dumps(record) for record in [
+        {"type": "user", "first_name": "Ann", "last_name": "Lee", "email": "Ann@import.com", "password": "pw",
+         "location": "Austin", "talents": ["bass", "vocals"]},
+        {"type": "user", "first_name": "Bo", "last_name": "Ray", "email": "bo@import.com",
+         "password_hash": hash_password("pw").decode(), "location": "austin"},
+        {"type": "user", "first_name": "Ann", "last_name": "Again", "email": "ann@import.com", "password": "pw"},
+        {"type": "user", "first_name": "Jason", "last_name": "Bourne", "email": "jason@gmail.com", "password": "pw"},
+        {"type": "user", "first_name": "Cy", "last_name": "Sea", "email": "cy@import.com", "password": "pw",
+         "location": "Atlantis"},
+        {"type": "band", "name": "Imported", "location": "Austin", "admin_email": "ann@import.com",
+         "member_emails": ["bo@import.com"], "talents": ["drums"]},
+        {"type": "band", "name": "Orphans", "location": "Austin", "admin_email": "nobody@import.com"},
+        {"type": "venue"},
+    ]) + "\n{not json"
+    assert client.post("/import", data=body).status_code == 403
+    with patch.object(bulk_import, "google_geocode", geocode):
+        report = client.post("/import", data=body, headers={"X-Import-Token": "secret"}).json()
+    assert sorted(lookups) == ["atlantis", "austin"]
+    assert report["created"] == {"user": 2, "band": 1, "band_member": 2, "looking_for_band": 2,
+                                 "looking_for_member": 1}
+    assert [error["line"] for error in report["errors"]] == [3, 4, 5, 7, 8, 9]
+
+    db = next(override_get_db())
+    ann = db.query(User).filter(User.email == "ann@import.com").one()
+    assert (ann.longitude, ann.latitude) == (-97.7, 30.3)
+    assert verify_password("pw", ann.password_hash)
+    bo = db.query(User).filter(User.email == "bo@import.com").one()
+    assert verify_password("pw", bo.password_hash)
+    band = db.query(Band).filter(Band.name == "Imported").one()
+    roster = {member.user_id: member.admin for member in db.query(BandMember).filter(BandMember.band_id == band.id)}
+    assert roster == {ann.id: True, bo.id: False}
+    assert db.query(LocationCache).filter(LocationCache.location == "austin").count() == 1
+
+    csv_body = "type,first_name,last_name,email,password,talents\nuser,Di,Vo,di@import.com,pw,keys;dj\n"
+    with patch.object(bulk_import, "google_geocode", geocode):
+        report = client.post("/import", data=csv_body, headers={"X-Import-Token": "secret",
+                                                                 "Content-Type": "text/csv"}).json()
+    assert report["created"]["user"] == 1 and report["created"]["looking_for_band"] == 2
+
+
+def test_send_invites_skips_members_and_pending_invites():
+    db = next(override_get_db())
+    user = db.query(User).filter(User.email == "jason@gmail.com").first()
+    stranger = User(first_name="Bulk", last_name="Invitee", email="bulk.invitee@gmail.com")
+    db.add(stranger)
+    db.commit()
+    headers = {"Authorization": "Bearer " + sign_jwt(user)}
+    body = {"band_id": 1, "user_ids": [2, stranger.id, 999, stranger.id],
+            "emails": ["New.Person@gmail.com", "dexter@gmail.com"]}
+    with patch("emails.Email.send_emails") as send_emails:
+        resp = client.post("/send_invites", json=body, headers=headers)
+    assert resp.status_code == 200
+    assert resp.json() == {"invited_user_ids": [stranger.id], "invited_emails": ["new.person@gmail.com"],
+                           "already_members": [2], "already_invited": [], "unknown_user_ids": [999]}
+    assert [to for to, _, _ in send_emails.call_args.args[0]] == ["new.person@gmail.com"]
+    assert db.query(BandInvite).filter(BandInvite.user_id == stranger.id).count() == 1
+    assert db.query(BandInviteByEmail).filter(BandInviteByEmail.email == "new.person@gmail.com").count() == 1
+    assert db.query(DBNotification).filter(DBNotification.recipient_user_id == stranger.id).count() == 1
+
+    resp = client.post("/send_invites", json=body, headers=headers)
+    assert resp.json()["invited_user_ids"] == [] and resp.json()["invited_emails"] == []
+    assert resp.json()["already_invited"] == [stranger.id, "new.person@gmail.com"]
+    not_admin = {"Authorization": "Bearer " + sign_jwt(stranger)}
+    assert client.post("/send_invites", json=body, headers=not_admin).status_code == 400
+
+
+def test_register_redeems_unexpired_email_invites():
+    db = next(override_get_db())
+    other_band = Band(name="Expired", location="Nowhere")
+    db.add(other_band)
+    db.flush()
+    now = time.time()
+    db.add_all([BandInviteByEmail(email="invited@gmail.com", band_id=1, expiration=now + 60),
+                BandInviteByEmail(email="invited@gmail.com", band_id=1, expiration=now + 120),
+                BandInviteByEmail(email="invited@gmail.com", band_id=other_band.id, expiration=now - 60)])
+    db.commit()
+    resp = client.post("/register", json={"first_name": "In", "last_name": "Vited", "email": "Invited@gmail.com",
+                                          "password": "test123"})
+    assert resp.status_code == 200
+    user = db.query(User).filter(User.email == "invited@gmail.com").one()
+    assert [(member.band_id, member.admin) for member in
+            db.query(BandMember).filter(BandMember.user_id == user.id)] == [(1, False)]
+    assert db.query(BandInviteByEmail).filter(BandInviteByEmail.email == "invited@gmail.com").count() == 0
+
+
+def test_scheduler_purges_expired_rows_on_the_leader_only():
+    db = next(override_get_db())
+    now = time.time()
+    db.add_all([DBNotification(recipient_user_id=1, message="old", date_sent=0, expiration=now - 10,
+                               priority=NotificationPriority.normal) for _ in range(5)] +
+               [DBNotification(recipient_user_id=1, message="new", date_sent=0, expiration=now + 3600,
+                               priority=NotificationPriority.normal),
+                LocationCache(location="stale town", lng=1, lat=2, cached_at=0)])
+    db.commit()
+    leader, follower = Scheduler(AsyncDbSession, owner="leader"), Scheduler(AsyncDbSession, owner="follower")
+    for scheduler in (leader, follower):
+        jobs.add_maintenance_jobs(scheduler, is_sqlite=True)
+
+    async def run(scheduler, name):
+        return await scheduler.run(name)
+
+    assert asyncio.run(run(leader, "purge_notifications")) == "ok"
+    assert asyncio.run(run(follower, "purge_notifications")) == "not_leader"
+    assert job_runs.get("purge_notifications", "not_leader") >= 1
+    assert db.query(DBNotification).filter(DBNotification.message == "old").count() == 0
+    assert db.query(DBNotification).filter(DBNotification.message == "new").count() == 1
+    assert asyncio.run(run(leader, "purge_location_cache")) == "ok"
+    assert db.query(LocationCache).filter(LocationCache.location == "stale town").count() == 0
+    assert asyncio.run(run(leader, "analyze")) == "ok"
+    assert asyncio.run(run(leader, "vacuum")) == "ok"
+
+
+def test_purge_batches_stop_at_the_deadline():
+    db = next(override_get_db())
+    db.add_all([BandInviteByEmail(email="purge%d@gmail.com" % i, band_id=1, expiration=i) for i in range(5)])
+    db.commit()
+
+    async def purge(deadline):
+        async with AsyncDbSession() as session:
+            return await jobs.purge_older_than(session, BandInviteByEmail, BandInviteByEmail.expiration, 100,
+                                               deadline, batch_size=2)
+
+    # a spent budget still deletes one batch
+    assert asyncio.run(purge(0)) == 2
+    assert asyncio.run(purge(time.monotonic() + 10)) == 3
+
+
+def test_full_text_search_finds_prefixes_and_stays_in_sync():
+    with engine.begin() as conn:
+        install_full_text_search(conn)
+    db = next(override_get_db())
+    db.add_all([Band(name="Green Day Tribute", location="Oakland"), Band(name="Greenhouse Effect", location="LA")])
+    db.add_all([DBMessage(sender_user_id=1, recipient_user_id=2, message="rehearsal moved to Thursday"),
+                DBMessage(sender_user_id=2, recipient_user_id=3, message="rehearsal is private")])
+    db.commit()
+
+    names = [band["name"] for band in client.get("/search/bands", params={"q": "gree"}).json()["items"]]
+    assert sorted(names) == ["Green Day Tribute", "Greenhouse Effect"]
+    assert [band["name"] for band in client.get("/search/bands", params={"q": "green da"}).json()["items"]] \
+        == ["Green Day Tribute"]
+    first = client.get("/search/bands", params={"q": "gree", "limit": 1}).json()
+    second = client.get("/search/bands", params={"q": "gree", "limit": 1, "after": first["next"]}).json()
+    assert {first["items"][0]["name"], second["items"][0]["name"]} == set(names)
+    # FTS syntax in the input is only searched for as words
+    assert client.get("/search/bands", params={"q": '"green" OR NEAR('}).status_code == 200
+    assert client.get("/search/bands", params={"q": "  "}).status_code == 400
+
+    band = db.query(Band).filter(Band.name == "Greenhouse Effect").one()
+    band.name = "Glasshouse"
+    db.commit()
+    assert [band["name"] for band in client.get("/search/bands", params={"q": "glass"}).json()["items"]] \
+        == ["Glasshouse"]
+    assert client.get("/search/users", params={"q": "bour"}).json()["items"][0]["email"] == "jason@gmail.com"
+
+    user = db.query(User).filter(User.id == 1).one()
+    headers = {"Authorization": "Bearer " + sign_jwt(user)}
+    found = client.get("/search/messages", params={"q": "rehears"}, headers=headers).json()["items"]
+    assert [message["message"] for message in found] == ["rehearsal moved to Thursday"]
+
+
+def test_old_messages_are_archived_and_paged_back_transparently(monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_BLOCK_MESSAGES", 2)
+    db = next(override_get_db())
+    old = int(time.time()) - 100 * 24 * 3600
+    db.query(DBMessage).delete()
+    db.add_all([DBMessage(sender_user_id=1 + i % 2 * 2, recipient_user_id=3 - i % 2 * 2, message="msg %d" % i,
+                          sent=old + i if i < 5 else int(time.time())) for i in range(7)] +
+               [DBMessage(sender_user_id=1, recipient_user_id=2, message="other", sent=old)])
+    db.commit()
+    ids = [message.id for message in db.query(DBMessage).filter(DBMessage.message.like("msg %")).order_by(DBMessage.id)]
+
+    async def archive_messages():
+        async with AsyncDbSession() as session:
+            return await archive.archive_old_messages(session, time.monotonic() + 10, retention_days=90,
+                                                      batch_size=2)
+
+    # the "other" message was sent after the first recent one, archiving stops at the boundary
+    assert asyncio.run(archive_messages()) == 5
+    assert db.query(DBMessage).count() == 3
+    assert [block.count for block in db.query(MessageArchiveBlock).filter(
+        MessageArchiveBlock.user_low == 1, MessageArchiveBlock.user_high == 3)] == [2, 2, 1]
+
+    headers = {"Authorization": "Bearer " + sign_jwt(db.query(User).get(1))}
+    history = client.get("/messages/3", headers=headers).json()
+    assert [message["id"] for message in history] == ids
+    assert history[0]["message"] == "msg 0" and history[0]["sender_user_id"] == 1
+    page = client.get("/messages/3", params={"limit": 3}, headers=headers).json()
+    assert [message["id"] for message in page] == ids[4:]
+    page = client.get("/messages/3", params={"limit": 3, "before": page[0]["id"]}, headers=headers).json()
+    assert [message["id"] for message in page] == ids[1:4]
+
+    # deleting a user drops their archived conversations too
+    db.execute(archive.delete_user_archive(3))
+    assert db.query(MessageArchiveBlock).filter(MessageArchiveBlock.user_high == 3).count() == 0
+    db.rollback()
+
+
+def test_location_snapshot_serves_geocodes_without_the_database(monkeypatch):
+    now = time.time()
+    snapshot = LocationSnapshot.from_rows([("Snapshot Town", 1.5, 2.5, now), ("ürümqi", 3.0, 4.0, now),
+                                           ("old town", 5.0, 6.0, now - 3600), ("old town", 7.0, 8.0, now)])
+    assert len(snapshot) == 3
+    assert snapshot.get("snapshot town") == (1.5, 2.5) and snapshot.get("ÜRÜMQI") == (3.0, 4.0)
+    # the latest geocode of a location wins
+    assert snapshot.get("old town") == (7.0, 8.0)
+    assert snapshot.get("nowhere") is None and snapshot.get("zzz") is None
+    assert LocationSnapshot.from_rows([("stale", 1, 2, now - 100)]).get("stale", max_age=10) is None
+
+    monkeypatch.setattr(location_snapshot, "active", snapshot)
+    resp = client.get("/search", params={"location": "Snapshot Town", "type": "Band", "distance": 10,
+                                         "roles": "bass"})
+    assert resp.status_code == 200
+    # only the band query, no location_cache lookup and no geocoding call
+    assert resp.headers["x-db-query-count"] == "1"
+
+
+def test_prefork_server_serves_from_workers_and_stops_on_sigterm(tmp_path):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, "-m", "serving.prefork", "--workers", "2", "--port", str(port),
+                                "--log-level", "warning"], cwd=tmp_path, stderr=subprocess.PIPE,
+                               env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__))))
+    try:
+        for _ in range(100):
+            try:
+                if requests.get("http://127.0.0.1:%d/" % port, timeout=1).status_code == 200:
+                    break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        else:
+            pytest.fail("prefork server did not start")
+        assert requests.get("http://127.0.0.1:%d/band/1" % port).status_code == 200
+    finally:
+        process.send_signal(signal.SIGTERM)
+        _, stderr = process.communicate(timeout=30)
+    assert process.returncode == 0, stderr
+
+
+def test_band_role_claims_are_trusted_until_memberships_change():
+    db = next(override_get_db())
+    owner = User(first_name="Claims", last_name="Owner", email="claims.owner@gmail.com")
+    db.add(owner)
+    db.commit()
+    assert client.post("/band", json={"name": "Claimed", "location": "MN"},
+                       headers={"Authorization": "Bearer " + sign_jwt(owner)}).status_code == 200
+    band_id = db.query(BandMember.band_id).filter(BandMember.user_id == owner.id).scalar()
+
+    token = client.post("/refresh_token", headers={"Authorization": "Bearer " + sign_jwt(owner)}).json()
+    assert decode_jwt(token)["roles"] == {"v": 2, "a": [band_id], "m": []}
+    headers = {"Authorization": "Bearer " + token}
+    renamed = {"id": band_id, "name": "Claimed Again", "location": "MN"}
+    claims, roster = role_checks.get("claims"), role_checks.get("roster")
+    assert client.put("/update_band", json=renamed, headers=headers).status_code == 200
+    assert (role_checks.get("claims"), role_checks.get("roster")) == (claims + 1, roster)
+
+    # joining another band makes the token's claims stale, checks go back to the roster
+    db.add(BandInvite(band_id=1, user_id=owner.id, code="CLAIMS01", expiration=time.time() + 60))
+    db.commit()
+    assert client.post("/accept_invite", json={"code": "CLAIMS01"}, headers=headers).status_code == 200
+    assert client.put("/update_band", json=renamed, headers=headers).status_code == 200
+    assert role_checks.get("roster") == roster + 1
+    # stale claims never grant a role the roster does not
+    stale = {"Authorization": "Bearer " + sign_jwt(owner, {"v": 2, "a": [1], "m": []})}
+    assert client.post("/send_invite", json={"band_id": 1, "user_id": 3}, headers=stale).status_code == 400
+    fresh = decode_jwt(client.post("/refresh_token", headers=headers).json())["roles"]
+    assert fresh == {"v": 3, "a": [band_id], "m": [1]}